@@ -0,0 +1,322 @@
+"""
+Account Deletion for Poetry Vault
+Background jobs that remove a user and everything attached to them with set-based batches
+"""
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, tuple_
+from models import (db, User, Poem, Comment, Like, SavedPoem, Notification, Follow, TimelineEntry,
+                    Highlight, HighlightPoem, Collection, CollectionPoem, UserActivity, UserAnalytics,
+                    DeletionJob, COUNTER_COLUMNS)
+from search_index import search_index
+from timeline import timeline
+from data_protection import data_protection
+
+logger = logging.getLogger(__name__)
+
+
+class AccountDeletion:
+    """
+    Queued account deletions
+
+    A request locks the account and records a DeletionJob; a background worker then
+    runs each step below in order. Every step deletes at most batch_size rows per
+    transaction with one DELETE ... WHERE ... IN (subquery), and the job row is
+    updated in the same transaction, so progress is visible while it runs. Steps
+    only ever delete what is still there, which makes a job safe to re-run from
+    the top after a failure or a crashed worker.
+
+    Bulk deletes skip the ORM hooks, so the steps that remove likes, comments, saves
+    and unread notifications recount the affected poems' and recipients' counters,
+    and poem deletion drops the poems from the search index.
+    """
+
+    # Dependency order: rows referencing the user's poems, highlights and collections go first
+    STEPS = (
+        'timeline', 'highlight_poems', 'highlights', 'collection_poems', 'collections',
+        'notifications', 'comments', 'likes', 'saved_poems', 'follows',
+        'user_analytics', 'user_activities', 'poems', 'user'
+    )
+
+    def __init__(self):
+        self.app = None
+        self.batch_size = 500
+        self.asynchronous = True
+        self.stale_seconds = 300
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = int(app.config.get('ACCOUNT_DELETION_BATCH_SIZE', 500))
+        self.asynchronous = bool(app.config.get('ACCOUNT_DELETION_ASYNC', True))
+        self.stale_seconds = int(app.config.get('ACCOUNT_DELETION_STALE_SECONDS', 300))
+
+    # Requests
+
+    def enqueue(self, user, requested_by=None):
+        """
+        Lock the account and queue its deletion
+
+        Returns:
+            DeletionJob: The new job, or the user's unfinished one (a failed job is retried)
+        """
+        job = DeletionJob.query.filter(DeletionJob.user_id == user.id, DeletionJob.status != 'done').first()
+        if job is None:
+            job = DeletionJob(user_id=user.id, username=user.username, requested_by=requested_by)
+            db.session.add(job)
+        elif job.status == 'failed':
+            job.status = 'pending'
+        # Locked accounts cannot log in or post while their data is being removed
+        user.is_banned = True
+        user.ban_reason = 'Account deletion in progress'
+        db.session.commit()
+        self.submit(job.id)
+        return job
+
+    def progress(self, job):
+        """Job state for status endpoints"""
+        state = job.to_dict()
+        state['steps_total'] = len(self.STEPS)
+        state['steps_done'] = (len(self.STEPS) if job.status == 'done'
+                               else self.STEPS.index(job.step) if job.step in self.STEPS else 0)
+        return state
+
+    def resume(self):
+        """Queue pending jobs and running ones whose worker stopped updating them (scheduler job)"""
+        stale = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        job_ids = [job_id for job_id, in db.session.query(DeletionJob.id).filter(db.or_(
+            DeletionJob.status == 'pending',
+            db.and_(DeletionJob.status == 'running', DeletionJob.updated_at < stale)
+        )).order_by(DeletionJob.id)]
+        for job_id in job_ids:
+            self.submit(job_id)
+        return len(job_ids)
+
+    # Job
+
+    def _claim(self, job_id):
+        """Mark a job running and return its user id (None if it is not ours to run)"""
+        # A running job is only taken over once its heartbeat is stale
+        jobs = DeletionJob.__table__
+        now = datetime.utcnow()
+        with db.engine.begin() as connection:
+            claimed = connection.execute(jobs.update().where(
+                jobs.c.id == job_id,
+                db.or_(jobs.c.status == 'pending',
+                       db.and_(jobs.c.status == 'running', jobs.c.updated_at < now - timedelta(seconds=self.stale_seconds)))
+            ).values(status='running', error=None, updated_at=now)).rowcount
+            if claimed != 1:
+                return None
+            return connection.execute(select(jobs.c.user_id).where(jobs.c.id == job_id)).scalar()
+
+    def run(self, job_id):
+        """
+        Run one job to completion (call inside an app context)
+
+        Returns:
+            DeletionJob, or None if another process holds the job or it is finished
+        """
+        user_id = self._claim(job_id)
+        if user_id is None:
+            return None
+        jobs = DeletionJob.__table__
+        step = None
+        try:
+            for step in self.STEPS:
+                delete_batch = getattr(self, f'_delete_{step}')
+                deleted_in_step = 0
+                while True:
+                    with db.engine.begin() as connection:
+                        deleted = delete_batch(connection, user_id)
+                        connection.execute(jobs.update().where(jobs.c.id == job_id).values(
+                            step=step, rows_deleted=jobs.c.rows_deleted + deleted, updated_at=datetime.utcnow()
+                        ))
+                    deleted_in_step += deleted
+                    if not deleted:
+                        break
+                if deleted_in_step:
+                    logger.info(f"Deletion job {job_id}: {step} removed {deleted_in_step} rows")
+            with db.engine.begin() as connection:
+                connection.execute(jobs.update().where(jobs.c.id == job_id).values(
+                    status='done', finished_at=datetime.utcnow(), updated_at=datetime.utcnow()
+                ))
+            data_protection.invalidate_privacy_settings(user_id)
+            logger.info(f"Deletion job {job_id}: user {user_id} deleted")
+        except Exception as e:
+            logger.error(f"Deletion job {job_id} failed at {step}: {e}")
+            with db.engine.begin() as connection:
+                connection.execute(jobs.update().where(jobs.c.id == job_id).values(
+                    status='failed', error=str(e)[:1000], updated_at=datetime.utcnow()
+                ))
+        job = db.session.get(DeletionJob, job_id)
+        db.session.refresh(job)
+        return job
+
+    # Steps - each deletes one batch and returns the number of rows removed
+
+    def _delete_where(self, connection, table, *conditions):
+        batch = select(table.c.id).where(*conditions).limit(self.batch_size)
+        return connection.execute(table.delete().where(table.c.id.in_(batch))).rowcount
+
+    @staticmethod
+    def _owned_poems(user_id):
+        return select(Poem.id).where(Poem.user_id == user_id)
+
+    def _delete_timeline(self, connection, user_id):
+        # Composite key: pick a batch of (owner, poem) pairs from the user's timeline and their poems in others'
+        entries = TimelineEntry.__table__
+        pairs = connection.execute(select(entries.c.user_id, entries.c.poem_id).where(
+            db.or_(entries.c.user_id == user_id, entries.c.author_id == user_id)
+        ).limit(self.batch_size)).all()
+        if not pairs:
+            return 0
+        return connection.execute(entries.delete().where(
+            tuple_(entries.c.user_id, entries.c.poem_id).in_([tuple(pair) for pair in pairs])
+        )).rowcount
+
+    def _delete_highlight_poems(self, connection, user_id):
+        return self._delete_where(connection, HighlightPoem.__table__, db.or_(
+            HighlightPoem.poem_id.in_(self._owned_poems(user_id)),
+            HighlightPoem.highlight_id.in_(select(Highlight.id).where(Highlight.user_id == user_id))
+        ))
+
+    def _delete_highlights(self, connection, user_id):
+        return self._delete_where(connection, Highlight.__table__, Highlight.user_id == user_id)
+
+    def _delete_collection_poems(self, connection, user_id):
+        return self._delete_where(connection, CollectionPoem.__table__, db.or_(
+            CollectionPoem.poem_id.in_(self._owned_poems(user_id)),
+            CollectionPoem.collection_id.in_(select(Collection.id).where(Collection.user_id == user_id))
+        ))
+
+    def _delete_collections(self, connection, user_id):
+        return self._delete_where(connection, Collection.__table__, Collection.user_id == user_id)
+
+    def _delete_notifications(self, connection, user_id):
+        notifications = Notification.__table__
+        rows = connection.execute(select(notifications.c.id, notifications.c.user_id, notifications.c.is_read).where(
+            db.or_(notifications.c.user_id == user_id, notifications.c.poem_id.in_(self._owned_poems(user_id)))
+        ).limit(self.batch_size)).all()
+        if not rows:
+            return 0
+        deleted = connection.execute(notifications.delete().where(
+            notifications.c.id.in_([row.id for row in rows])
+        )).rowcount
+        recipients = {row.user_id for row in rows if not row.is_read and row.user_id != user_id}
+        if recipients:
+            users = User.__table__
+            unread = select(db.func.count()).where(
+                notifications.c.user_id == users.c.id, notifications.c.is_read.is_(False)
+            ).scalar_subquery()
+            connection.execute(users.update().where(users.c.id.in_(recipients)).values(unread_notification_count=unread))
+        return deleted
+
+    def _delete_poem_children(self, connection, user_id, model):
+        # The user's own rows plus everyone's rows on the user's poems; surviving poems are recounted
+        table = model.__table__
+        rows = connection.execute(select(table.c.id, table.c.poem_id).where(
+            db.or_(table.c.user_id == user_id, table.c.poem_id.in_(self._owned_poems(user_id)))
+        ).limit(self.batch_size)).all()
+        if not rows:
+            return 0
+        deleted = connection.execute(table.delete().where(table.c.id.in_([row.id for row in rows]))).rowcount
+        poems = Poem.__table__
+        count = select(db.func.count()).where(table.c.poem_id == poems.c.id).scalar_subquery()
+        connection.execute(poems.update().where(
+            poems.c.id.in_({row.poem_id for row in rows}), poems.c.user_id != user_id
+        ).values({COUNTER_COLUMNS[model]: count}))
+        return deleted
+
+    def _delete_comments(self, connection, user_id):
+        return self._delete_poem_children(connection, user_id, Comment)
+
+    def _delete_likes(self, connection, user_id):
+        return self._delete_poem_children(connection, user_id, Like)
+
+    def _delete_saved_poems(self, connection, user_id):
+        return self._delete_poem_children(connection, user_id, SavedPoem)
+
+    def _delete_follows(self, connection, user_id):
+        follows = Follow.__table__
+        rows = connection.execute(select(follows.c.id, follows.c.followed_id).where(
+            db.or_(follows.c.follower_id == user_id, follows.c.followed_id == user_id)
+        ).limit(self.batch_size)).all()
+        if not rows:
+            return 0
+        deleted = connection.execute(follows.delete().where(follows.c.id.in_([row.id for row in rows]))).rowcount
+        followed = {row.followed_id for row in rows if row.followed_id != user_id}
+        if followed:
+            users = User.__table__
+            count = select(db.func.count()).where(follows.c.followed_id == users.c.id).scalar_subquery()
+            connection.execute(users.update().where(users.c.id.in_(followed)).values(follower_count=count))
+            # Authors this unfollow took back below the pull threshold get their recent poems pushed
+            for author_id in timeline.demoted(connection, followed):
+                timeline.backfill_author(connection, author_id)
+        return deleted
+
+    def _delete_user_analytics(self, connection, user_id):
+        analytics = UserAnalytics.__table__
+        connection.execute(analytics.update().where(
+            analytics.c.user_id != user_id, analytics.c.most_popular_poem_id.in_(self._owned_poems(user_id))
+        ).values(most_popular_poem_id=None))
+        return self._delete_where(connection, analytics, analytics.c.user_id == user_id)
+
+    def _delete_user_activities(self, connection, user_id):
+        return self._delete_where(connection, UserActivity.__table__, UserActivity.user_id == user_id)
+
+    def _delete_poems(self, connection, user_id):
+        poems = Poem.__table__
+        poem_ids = connection.execute(
+            select(poems.c.id).where(poems.c.user_id == user_id).limit(self.batch_size)
+        ).scalars().all()
+        if not poem_ids:
+            return 0
+        search_index.remove_poems(connection, poem_ids)
+        return connection.execute(poems.delete().where(poems.c.id.in_(poem_ids))).rowcount
+
+    def _delete_user(self, connection, user_id):
+        users = User.__table__
+        return connection.execute(users.delete().where(users.c.id == user_id)).rowcount
+
+    # Background worker
+
+    def submit(self, job_id):
+        if not self.asynchronous or self.app is None:
+            self.run(job_id)
+            return
+        self._ensure_worker()
+        self._queue.put(job_id)
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            return
+        with self._worker_lock:
+            if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+                return
+            self._worker = threading.Thread(target=self._work, name='account-deletion', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                with self.app.app_context():
+                    self.run(job_id)
+            except Exception as e:
+                # The job stays pending or running and is picked up again by resume()
+                logger.error(f"Deletion job {job_id} could not run: {e}")
+            finally:
+                self._queue.task_done()
+
+
+# Global account deletion queue
+account_deletion = AccountDeletion()
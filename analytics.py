@@ -3,38 +3,264 @@ Enhanced Analytics Tracking System
 Comprehensive visitor tracking, user activity logging, and analytics reporting
 """
 from flask import request
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from models import db, UserActivity, Visitor
+from data_protection import data_protection
+from rollups import analytics_rollups
+from hyperloglog import HyperLogLog, unique_sketches
+from source_classifier import source_classifier
 from flask_login import current_user
 from datetime import datetime, timedelta
 from functools import wraps
+from collections import deque
+import atexit
 import logging
+import os
+import threading
+import time
 
 # Setup logger
 logger = logging.getLogger(__name__)
 
 
-class AnalyticsTracker:
-    """Centralized analytics tracking with enhanced features"""
+class AnalyticsWriter:
+    """
+    Buffered background writer for visitor and activity tracking
     
-    # Source detection patterns
-    SOCIAL_PATTERNS = {
-        'instagram': ['instagram.com', 'ig.me', 'instagram'],
-        'facebook': ['facebook.com', 'fb.com', 'fb.me', 'facebook'],
-        'twitter': ['twitter.com', 't.co', 'x.com', 'twitter'],
-        'linkedin': ['linkedin.com', 'lnkd.in', 'linkedin'],
-        'pinterest': ['pinterest.com', 'pin.it', 'pinterest'],
-        'reddit': ['reddit.com', 'redd.it', 'reddit'],
-        'tiktok': ['tiktok.com', 'tiktok'],
-        'youtube': ['youtube.com', 'youtu.be', 'youtube']
-    }
+    Requests only append to an in-memory ring buffer (bounded; the oldest events are
+    dropped and counted when it is full). A flush thread drains it every
+    flush_interval seconds, or as soon as batch_size events are waiting, and writes
+    each batch in one transaction with executemany inserts/updates.
+    """
     
-    SEARCH_PATTERNS = {
-        'google': ['google.com', 'google'],
-        'bing': ['bing.com', 'bing'],
-        'yahoo': ['yahoo.com', 'yahoo'],
-        'duckduckgo': ['duckduckgo.com', 'ddg']
+    # Source values that never overwrite a more specific stored source
+    GENERIC_SOURCES = ('direct', 'other')
+    
+    # Dialects with INSERT ... ON CONFLICT DO UPDATE
+    UPSERT_DIALECTS = {
+        'sqlite': sqlite_insert,
+        'postgresql': postgresql_insert
     }
     
+    def __init__(self, max_events=10000, batch_size=500, flush_interval=0.5):
+        self.app = None
+        self.enabled = True
+        self.asynchronous = True
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._events = deque(maxlen=max_events)
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self.metrics = {'enqueued': 0, 'visits': 0, 'activities': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'flushes': 0, 'last_flush_ms': 0.0}
+    
+    def init_app(self, app):
+        """Read buffer settings from the app config"""
+        self.app = app
+        self.enabled = app.config.get('ANALYTICS_ENABLED', True)
+        self.asynchronous = app.config.get('ANALYTICS_ASYNC', True)
+        self.max_events = int(app.config.get('ANALYTICS_BUFFER_SIZE', 10000))
+        self.batch_size = int(app.config.get('ANALYTICS_BATCH_SIZE', 500))
+        self.flush_interval = int(app.config.get('ANALYTICS_FLUSH_INTERVAL_MS', 500)) / 1000.0
+        self._events = deque(self._events, maxlen=self.max_events)
+    
+    def submit(self, kind, event):
+        """Queue a 'visit' or 'activity' event; never touches the database"""
+        if not self.enabled:
+            return
+        if len(self._events) >= self.max_events:
+            # deque(maxlen) discards the oldest entry on append
+            self.metrics['dropped'] += 1
+        self._events.append((kind, event))
+        self.metrics['enqueued'] += 1
+        self.metrics['visits' if kind == 'visit' else 'activities'] += 1
+        
+        if not self.asynchronous or self.app is None:
+            self.flush()
+            return
+        self._ensure_thread()
+        if len(self._events) >= self.batch_size:
+            self._wake.set()
+    
+    def stats(self):
+        """Counters for monitoring plus the current buffer depth"""
+        return dict(self.metrics, pending=len(self._events))
+    
+    def _ensure_thread(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._flush_lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='analytics-writer', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+    
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+    
+    def flush(self):
+        """Write everything buffered so far; returns the number of events written"""
+        with self._flush_lock:
+            written = 0
+            while self._events:
+                batch = []
+                while self._events and len(batch) < self.batch_size:
+                    batch.append(self._events.popleft())
+                written += self._write(batch)
+            return written
+    
+    def _write(self, batch):
+        started = time.perf_counter()
+        activities = [event for kind, event in batch if kind == 'activity']
+        visits = [event for kind, event in batch if kind == 'visit']
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    if activities:
+                        connection.execute(UserActivity.__table__.insert(), activities)
+                    if visits:
+                        self._upsert_visitors(connection, visits)
+                        analytics_rollups.count_visits(connection, len(visits))
+        except Exception as e:
+            self.metrics['failed'] += len(batch)
+            logger.error(f"Error writing {len(batch)} analytics events: {e}")
+            return 0
+        self._count_uniques(activities, visits)
+        self.metrics['written'] += len(batch)
+        self.metrics['flushes'] += 1
+        self.metrics['last_flush_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return len(batch)
+    
+    def _count_uniques(self, activities, visits, force=False):
+        """Feed written events into the per-day unique sketches and persist them periodically"""
+        for activity in activities:
+            unique_sketches.add('active_users', activity['created_at'].date(), activity['user_id'])
+        for visit in visits:
+            unique_sketches.add('visitors', visit['last_visit'].date(), visit['visitor_key'])
+        if not force and not unique_sketches.persist_due():
+            return
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    unique_sketches.persist(connection, force=force)
+        except Exception as e:
+            logger.error(f"Error persisting unique sketches: {e}")
+    
+    def _upsert_visitors(self, connection, visits):
+        """Fold a batch of visits per visitor key, then one executemany INSERT ... ON CONFLICT DO UPDATE"""
+        by_key = {}
+        for visit in visits:
+            # Visits without a key (no remote address) cannot be merged
+            fold_key = visit['visitor_key'] or id(visit)
+            folded = by_key.get(fold_key)
+            if folded is None:
+                by_key[fold_key] = dict(visit, visits=1)
+                continue
+            folded['visits'] += 1
+            folded['last_visit'] = visit['last_visit']
+            folded['nickname'] = folded['nickname'] or visit['nickname']
+            if visit['source_update']:
+                folded['source_update'] = visit['source_update']
+                folded['source_if_direct'] = visit['source_if_direct']
+                # A visitor first seen in this batch gets later updates applied in order
+                if not visit['source_if_direct'] or folded['source'] == 'direct':
+                    folded['source'] = visit['source_update']
+        
+        rows = [
+            {
+                'visitor_key': folded['visitor_key'],
+                'nickname': folded['nickname'],
+                'source': folded['source'],
+                'ip_address': folded['ip_address'],
+                'user_agent': folded['user_agent'],
+                'referrer': folded['referrer'],
+                'first_visit': folded['first_visit'],
+                'last_visit': folded['last_visit'],
+                'visit_count': folded['visits'],
+                'new_source': folded['source_update'],
+                'if_direct': folded['source_if_direct']
+            }
+            for folded in by_key.values()
+        ]
+        
+        visitors = Visitor.__table__
+        # Applied to an existing visitor: specific sources win, 'if_direct' ones only replace 'direct'
+        source_update = db.case(
+            (db.and_(db.bindparam('new_source').isnot(None),
+                     db.or_(db.bindparam('if_direct').is_(False), visitors.c.source == 'direct')),
+             db.bindparam('new_source')),
+            else_=visitors.c.source
+        )
+        
+        upsert = self.UPSERT_DIALECTS.get(connection.dialect.name)
+        if upsert is None:
+            self._update_or_insert_visitors(connection, rows, source_update)
+            return
+        
+        statement = upsert(visitors)
+        statement = statement.on_conflict_do_update(
+            index_elements=[visitors.c.visitor_key],
+            set_={
+                'visit_count': visitors.c.visit_count + statement.excluded.visit_count,
+                'last_visit': statement.excluded.last_visit,
+                'nickname': db.func.coalesce(visitors.c.nickname, statement.excluded.nickname),
+                'source': source_update
+            }
+        )
+        connection.execute(statement, rows)
+    
+    def _update_or_insert_visitors(self, connection, rows, source_update):
+        """Portable fallback for databases without ON CONFLICT: bulk UPDATE by key, then bulk INSERT the rest"""
+        visitors = Visitor.__table__
+        keys = [row['visitor_key'] for row in rows if row['visitor_key']]
+        existing = {key for (key,) in connection.execute(
+            db.select(visitors.c.visitor_key).where(visitors.c.visitor_key.in_(keys))
+        )} if keys else set()
+        
+        updates = [dict(row, key=row['visitor_key']) for row in rows if row['visitor_key'] in existing]
+        if updates:
+            connection.execute(
+                visitors.update().where(visitors.c.visitor_key == db.bindparam('key')).values(
+                    visit_count=visitors.c.visit_count + db.bindparam('visit_count'),
+                    last_visit=db.bindparam('last_visit'),
+                    nickname=db.func.coalesce(visitors.c.nickname, db.bindparam('nickname')),
+                    source=source_update
+                ),
+                updates
+            )
+        inserts = [row for row in rows if row['visitor_key'] not in existing]
+        if inserts:
+            connection.execute(visitors.insert(), inserts)
+    
+    def shutdown(self, timeout=5.0):
+        """Stop the flush thread and write whatever is still buffered"""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._thread.join(timeout)
+        if self.app is not None and self._events:
+            self.flush()
+        if self.app is not None:
+            self._count_uniques([], [], force=True)
+
+
+# Global analytics writer
+analytics_writer = AnalyticsWriter()
+atexit.register(analytics_writer.shutdown)
+
+
+class AnalyticsTracker:
+    """Centralized analytics tracking with enhanced features"""
+    
     @staticmethod
     def get_source_from_referrer(referrer='', user_agent=''):
         """
@@ -47,32 +273,7 @@ class AnalyticsTracker:
         Returns:
             str: Detected source (instagram, facebook, google, direct, etc.)
         """
-        if not referrer:
-            # Check user agent for app signatures
-            if user_agent:
-                user_agent_lower = user_agent.lower()
-                for source, patterns in AnalyticsTracker.SOCIAL_PATTERNS.items():
-                    if any(pattern in user_agent_lower for pattern in patterns):
-                        return source
-            return 'direct'
-        
-        referrer_lower = referrer.lower()
-        
-        # Check social media sources
-        for source, patterns in AnalyticsTracker.SOCIAL_PATTERNS.items():
-            if any(pattern in referrer_lower for pattern in patterns):
-                return source
-        
-        # Check search engines
-        for source, patterns in AnalyticsTracker.SEARCH_PATTERNS.items():
-            if any(pattern in referrer_lower for pattern in patterns):
-                return source
-        
-        # Check if it's from same domain (internal navigation)
-        if 'poetryvault' in referrer_lower or 'poetry-vault' in referrer_lower:
-            return 'internal'
-        
-        return 'other'
+        return source_classifier.classify(referrer, user_agent)
     
     @staticmethod
     def extract_nickname_from_params():
@@ -110,55 +311,79 @@ class AnalyticsTracker:
             nickname = AnalyticsTracker.extract_nickname_from_params()
             
             # Determine source
-            if nickname:
-                # Check if nickname hints at source
-                nickname_lower = nickname.lower()
-                source = None
-                
-                for src, patterns in AnalyticsTracker.SOCIAL_PATTERNS.items():
-                    if any(pattern in nickname_lower for pattern in patterns):
-                        source = src
-                        break
-                
-                if not source:
-                    source = AnalyticsTracker.get_source_from_referrer(referrer, user_agent)
-            else:
-                source = AnalyticsTracker.get_source_from_referrer(referrer, user_agent)
-            
-            # Check if visitor exists (by IP)
-            visitor = Visitor.query.filter_by(ip_address=ip_address).first()
-            
-            if visitor:
-                # Update existing visitor
-                visitor.last_visit = datetime.utcnow()
-                visitor.visit_count += 1
-                
-                # Update nickname if provided and not already set
-                if nickname and not visitor.nickname:
-                    visitor.nickname = nickname
-                
-                # Update source if it's more specific than current
-                if source != 'direct' and source != 'other':
-                    visitor.source = source
-            else:
-                # Create new visitor
-                visitor = Visitor(
-                    nickname=nickname,
-                    source=source,
-                    ip_address=ip_address,
-                    user_agent=user_agent,
-                    referrer=referrer[:255] if referrer else None
-                )
-                db.session.add(visitor)
+            # A nickname such as ?from=instagram hints at the source before the referrer does
+            source = (source_classifier.match('social', nickname)
+                      or AnalyticsTracker.get_source_from_referrer(referrer, user_agent))
             
-            db.session.commit()
+            # Existing visitors get a more specific source; new ones keep whatever was detected
+            specific = source not in AnalyticsWriter.GENERIC_SOURCES
+            AnalyticsTracker.record_visit(ip_address, user_agent, referrer, nickname, source,
+                                          source_update=source if specific else None)
             return True
             
         except Exception as e:
             logger.error(f"Error tracking visitor: {e}", exc_info=True)
-            db.session.rollback()
             return False
     
+    @staticmethod
+    def record_visit(ip_address, user_agent, referrer, nickname, source, source_update=None, source_if_direct=False):
+        """
+        Queue a visit for the background writer
+        
+        Args:
+            source: Source stored for a first-time visitor
+            source_update: Source written onto an existing visitor (None keeps theirs)
+            source_if_direct: Only apply source_update when the stored source is 'direct'
+        """
+        now = datetime.utcnow()
+        analytics_writer.submit('visit', {
+            'visitor_key': AnalyticsTracker.visitor_key(ip_address),
+            'ip_address': ip_address,
+            'user_agent': user_agent,
+            'referrer': referrer[:255] if referrer else None,
+            'nickname': nickname,
+            'source': source,
+            'source_update': source_update,
+            'source_if_direct': source_if_direct,
+            'first_visit': now,
+            'last_visit': now
+        })
+    
+    @staticmethod
+    def visitor_key(ip_address):
+        """Stable salted hash identifying a visitor (the unique upsert key)"""
+        return data_protection.hash_user_identifier(ip_address) if ip_address else None
+    
+    @staticmethod
+    def backfill_visitor_keys():
+        """
+        Give pre-existing visitors a visitor_key, merging rows that share an IP
+        
+        Older versions could create several rows per IP; they are folded into the
+        oldest one (visit counts summed) so the unique key can be assigned.
+        
+        Returns:
+            int: Number of visitors keyed
+        """
+        rows = db.session.query(Visitor).filter(Visitor.visitor_key.is_(None), Visitor.ip_address.isnot(None)).order_by(Visitor.id).all()
+        keepers = {}
+        for visitor in rows:
+            keeper = keepers.get(visitor.ip_address)
+            if keeper is None:
+                keepers[visitor.ip_address] = visitor
+                continue
+            keeper.visit_count = (keeper.visit_count or 0) + (visitor.visit_count or 0)
+            keeper.first_visit = min(filter(None, [keeper.first_visit, visitor.first_visit]), default=None)
+            keeper.last_visit = max(filter(None, [keeper.last_visit, visitor.last_visit]), default=None)
+            keeper.nickname = keeper.nickname or visitor.nickname
+            db.session.delete(visitor)
+        db.session.flush()
+        
+        for ip_address, visitor in keepers.items():
+            visitor.visitor_key = AnalyticsTracker.visitor_key(ip_address)
+        db.session.commit()
+        return len(keepers)
+    
     @staticmethod
     def log_activity(activity_type, description=None, user_id=None):
         """
@@ -182,23 +407,20 @@ class AnalyticsTracker:
             user_agent = request.headers.get('User-Agent', '')[:255]
             referrer = request.referrer or ''
             
-            # Create activity record
-            activity = UserActivity(
-                user_id=user_id,
-                activity_type=activity_type,
-                description=description[:255] if description else None,
-                ip_address=ip_address,
-                user_agent=user_agent,
-                referrer=referrer[:255] if referrer else None
-            )
-            
-            db.session.add(activity)
-            db.session.commit()
+            # Queue the activity record for the background writer
+            analytics_writer.submit('activity', {
+                'user_id': user_id,
+                'activity_type': activity_type,
+                'description': description[:255] if description else None,
+                'ip_address': ip_address,
+                'user_agent': user_agent,
+                'referrer': referrer[:255] if referrer else None,
+                'created_at': datetime.utcnow()
+            })
             return True
             
         except Exception as e:
             logger.error(f"Error logging activity: {e}", exc_info=True)
-            db.session.rollback()
             return False
     
     @staticmethod
@@ -215,27 +437,16 @@ class AnalyticsTracker:
         try:
             cutoff_date = datetime.utcnow() - timedelta(days=days)
             
-            # Total visitors
-            total_visitors = Visitor.query.count()
+            # Totals and source breakdown from the rollup snapshot (plus visitors since)
+            total_visitors = analytics_rollups.gauge('total_visitors')['']
+            source_breakdown = dict(analytics_rollups.gauge('visitors_by_source'))
+            total_visits = analytics_rollups.gauge('total_visits')['']
             
-            # Recent visitors
+            # Recent visitors (last_visit changes on every visit, so this stays a live count)
             recent_visitors = Visitor.query.filter(
                 Visitor.last_visit >= cutoff_date
             ).count()
             
-            # Source breakdown
-            sources = db.session.query(
-                Visitor.source,
-                db.func.count(Visitor.id)
-            ).group_by(Visitor.source).all()
-            
-            source_breakdown = {source: count for source, count in sources}
-            
-            # Total visits
-            total_visits = db.session.query(
-                db.func.sum(Visitor.visit_count)
-            ).scalar() or 0
-            
             return {
                 'total_visitors': total_visitors,
                 'recent_visitors': recent_visitors,
@@ -262,28 +473,12 @@ class AnalyticsTracker:
         try:
             cutoff_date = datetime.utcnow() - timedelta(days=days)
             
-            # Total activities
-            total_activities = UserActivity.query.filter(
-                UserActivity.created_at >= cutoff_date
-            ).count()
-            
-            # Activity type breakdown
-            activities = db.session.query(
-                UserActivity.activity_type,
-                db.func.count(UserActivity.id)
-            ).filter(
-                UserActivity.created_at >= cutoff_date
-            ).group_by(UserActivity.activity_type).all()
-            
-            activity_breakdown = {activity: count for activity, count in activities}
+            # Activity type breakdown from daily/hourly rollups (whole days from the cutoff)
+            activity_breakdown = dict(analytics_rollups.totals('activity', cutoff_date))
+            total_activities = sum(activity_breakdown.values())
             
-            # Unique active users
-            active_users = db.session.query(
-                UserActivity.user_id
-            ).filter(
-                UserActivity.created_at >= cutoff_date,
-                UserActivity.user_id.isnot(None)
-            ).distinct().count()
+            # Unique active users from the per-day sketches (same whole days as the breakdown)
+            active_users = unique_sketches.unique('active_users', days + 1)
             
             return {
                 'total_activities': total_activities,
@@ -296,6 +491,27 @@ class AnalyticsTracker:
             logger.error(f"Error getting activity stats: {e}", exc_info=True)
             return {}
 
+    
+    @staticmethod
+    def get_unique_stats(exact=False):
+        """
+        Daily/weekly/monthly unique active users and visitors
+        
+        Args:
+            exact: Count with DISTINCT over the raw rows instead of the sketches (slow; for verification)
+        
+        Returns:
+            dict: Counts per window plus the relative standard error of the estimates
+        """
+        count = unique_sketches.unique_exact if exact else unique_sketches.unique
+        windows = {'daily': 1, 'weekly': 7, 'monthly': 30}
+        return {
+            'active_users': {name: count('active_users', days) for name, days in windows.items()},
+            'visitors': {name: count('visitors', days) for name, days in windows.items()},
+            'exact': exact,
+            'standard_error': 0.0 if exact else round(HyperLogLog(unique_sketches.precision).error_bound, 4)
+        }
+
 
 def track_visitor():
     """Convenience function for visitor tracking"""
@@ -348,6 +564,8 @@ def track_action(action_name):
 
 # Export main functions
 __all__ = [
+    'AnalyticsWriter',
+    'analytics_writer',
     'AnalyticsTracker',
     'track_visitor',
     'log_activity',
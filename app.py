@@ -1,17 +1,39 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, jsonify, Response, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from config import Config
-from models import db, User, Poem, Comment
+from models import db, User, Poem, Comment, DeletionJob, SpamRescoreJob
 import requests
-from analytics import track_visitor, log_activity
+from analytics import track_visitor, log_activity, analytics_writer, AnalyticsTracker
 from datetime import datetime
 import logging
 import traceback
 import os
+import click
+import hmac
 
 # Import security middleware
 from security_middleware import security_manager, require_permission, validate_content_input, protect_user_data
 from data_protection import data_protection
+from search_index import search_index
+from pagination import keyset_paginate, next_page_url, InvalidCursor
+from schema import ensure_schema, ensure_model_indexes, migration_lock, check_query_plans
+from feed_loader import FeedLoader
+from timeline import timeline
+from notification_stream import notification_hub, serialize as serialize_notification
+from rollups import analytics_rollups
+from hyperloglog import unique_sketches
+from source_classifier import source_classifier
+from spam_filter import spam_filter
+from key_rotation import key_rotation
+from account_deletion import account_deletion
+from backup_manager import backup_manager
+from sqlite_profile import sqlite_profile
+from read_replicas import replica_router, read_only
+from query_stats import query_stats
+from metrics import metrics
+from privacy_routes import privacy_bp
+from scheduler import job_scheduler
+from sqlalchemy.orm import joinedload, contains_eager
 
 # Configure logging
 logging.basicConfig(
@@ -30,6 +52,9 @@ def create_app():
     login_manager.init_app(app)
     login_manager.login_view = 'login'
     
+    # Privacy dashboard, data download and content protection routes
+    app.register_blueprint(privacy_bp)
+    
     @login_manager.user_loader
     def load_user(user_id):
         try:
@@ -70,6 +95,204 @@ def create_app():
         db.session.rollback()
         return jsonify({'status': 'error', 'message': 'An unexpected error occurred'}), 500
     
+    def home_feed_page(cursor):
+        """One page of the viewer's home feed (followed users, or everyone if following nobody)"""
+        per_page = app.config['POEMS_PER_PAGE']
+        
+        # Poems from followed users come from the materialized timeline
+        page = timeline.page(current_user, cursor, per_page)
+        if page is not None:
+            return page
+        # If not following anyone, show all user poems (not classic) to help discover
+        return keyset_paginate(Poem.query.filter_by(is_classic=False), [Poem.created_at, Poem.id],
+                               cursor, per_page)
+    
+    def build_search_query(query, mood_filter, theme_filter, category_filter, poet_filter, sort_by):
+        """
+        Build the filtered search query and its pagination key
+        
+        Returns:
+            tuple: (query, keyset columns, descending, key function or None)
+        """
+        search_query = Poem.query.join(User).options(contains_eager(Poem.author))
+        ranked = None
+        
+        # Text search
+        if query:
+            if sort_by == 'relevance':
+                # Joining the ranked matches also restricts results to them
+                ranked = search_index.ranked(query)
+                search_query = search_query.join(ranked, Poem.id == ranked.c.poem_id)
+            else:
+                search_query = search_query.filter(search_index.match(query))
+        
+        # Mood filter
+        if mood_filter:
+            search_query = search_query.filter(Poem.mood.ilike(f'%{mood_filter}%'))
+        
+        # Theme filter
+        if theme_filter:
+            search_query = search_query.filter(Poem.theme.ilike(f'%{theme_filter}%'))
+        
+        # Category filter
+        if category_filter:
+            search_query = search_query.filter(Poem.category.ilike(f'%{category_filter}%'))
+        
+        # Poet filter
+        if poet_filter:
+            search_query = search_query.filter(User.username.ilike(f'%{poet_filter}%'))
+        
+        # Sorting
+        if ranked is not None:
+            search_query = search_query.add_columns(ranked.c.score)
+            return search_query, [ranked.c.score, Poem.id], True, lambda row: [row.score, row.Poem.id]
+        elif sort_by == 'popular':
+            return search_query, [Poem.like_count, Poem.id], True, None
+        elif sort_by == 'oldest':
+            return search_query, [Poem.created_at, Poem.id], False, None
+        else:  # recent
+            return search_query, [Poem.created_at, Poem.id], True, None
+    
+    def run_search(args):
+        """Run a search from request args, returning (poems, page or None, normalized params)"""
+        params = {
+            'query': args.get('q', '').strip()[:200],
+            'mood_filter': args.get('mood', '').strip(),
+            'theme_filter': args.get('theme', '').strip(),
+            'category_filter': args.get('category', '').strip(),
+            'poet_filter': args.get('poet', '').strip()
+        }
+        # relevance, recent, popular, oldest - text queries default to relevance
+        params['sort_by'] = args.get('sort', 'relevance' if params['query'] else 'recent')
+        
+        if not any(value for key, value in params.items() if key != 'sort_by'):
+            return [], None, params
+        
+        search_query, columns, descending, key = build_search_query(**params)
+        page = keyset_paginate(search_query, columns, args.get('cursor'),
+                               app.config['SEARCH_RESULTS_LIMIT'], descending, key)
+        poems = [row.Poem if key else row for row in page.items]
+        return poems, page, params
+    
+    @app.cli.command('reconcile-counters')
+    def reconcile_counters_command():
+        """Recompute denormalized poem like/comment/save, unread notification and follower counters"""
+        fixed = Poem.reconcile_counters()
+        print(f"Reconciled counters: {fixed} poems corrected")
+        fixed = User.reconcile_unread_counts()
+        print(f"Reconciled unread notification counts: {fixed} users corrected")
+        fixed = User.reconcile_follower_counts()
+        print(f"Reconciled follower counts: {fixed} users corrected")
+    
+    @app.cli.command('rollup-analytics')
+    def rollup_analytics_command():
+        """Aggregate complete hours/days into the analytics rollup tables"""
+        result = analytics_rollups.run()
+        print(f"Rolled up {result['hours']} hours and {result['days']} days")
+    
+    @app.cli.command('maintain-sketches')
+    def maintain_sketches_command():
+        """Backfill missing unique-count sketches and compact old shards"""
+        result = unique_sketches.maintain()
+        print(f"Backfilled {result['backfilled']} day sketches, compacted {result['compacted']}")
+    
+    @app.cli.command('rescore-spam')
+    def rescore_spam_command():
+        """Recompute spam scores for all poems and comments"""
+        for table, counts in spam_filter.rescore().items():
+            print(f"{table}: {counts['scored']} scored, {counts['flagged']} at or above {spam_filter.threshold}")
+    
+    @app.cli.command('add-encryption-key')
+    def add_encryption_key_command():
+        """Make a new encryption key primary (old keys still decrypt)"""
+        fingerprint = data_protection.add_key()
+        print(f"New primary key {fingerprint}. Restart the app so every worker encrypts with it, then run rotate-encryption.")
+    
+    @app.cli.command('rotate-encryption')
+    def rotate_encryption_command():
+        """Re-encrypt stored data under the primary key (resumes after interruption)"""
+        result = key_rotation.run(restart=os.environ.get('KEY_ROTATION_RESTART', '').lower() == 'true')
+        print(f"Rotated {result['rotated']} rows ({result['skipped']} changed meanwhile, {result['failed']} undecryptable) "
+              f"in {result['seconds']}s, {result['rows_per_second']} rows/s")
+        print(f"Rotated {result['backups']} account backups ({result['backups_failed']} undecryptable)")
+    
+    @app.cli.command('retire-encryption-keys')
+    def retire_encryption_keys_command():
+        """Remove old encryption keys once rotate-encryption has completed"""
+        if not key_rotation.is_complete():
+            print("Rotation to the current primary key has not completed; run rotate-encryption first.")
+            return
+        stale = key_rotation.stale_backups()
+        if stale:
+            print(f"{len(stale)} account backups are still encrypted with an old key (e.g. {stale[0]}); "
+                  f"run rotate-encryption with KEY_ROTATION_RESTART=true first.")
+            return
+        print(f"Retired {data_protection.retire_old_keys()} old keys")
+    
+    @app.cli.command('run-deletions')
+    def run_deletions_command():
+        """Run queued, interrupted and failed account deletions to completion in this process"""
+        DeletionJob.query.filter_by(status='failed').update({'status': 'pending'})
+        db.session.commit()
+        job_ids = [job_id for job_id, in db.session.query(DeletionJob.id).filter(
+            DeletionJob.status.in_(('pending', 'running'))
+        ).order_by(DeletionJob.id)]
+        for job_id in job_ids:
+            job = account_deletion.run(job_id)
+            if job is None:
+                print(f"Deletion job {job_id}: running in another process")
+            else:
+                print(f"Deletion job {job_id} ({job.username}): {job.status}, {job.rows_deleted} rows deleted"
+                      + (f" - {job.error}" if job.error else ''))
+    
+    @app.cli.command('backup-database')
+    def backup_database_command():
+        """Back up the SQLite database now and verify the backup (BACKUP_FULL=true starts a new chain)"""
+        name, entry = backup_manager.backup(full=os.environ.get('BACKUP_FULL', '').lower() == 'true', verify=False)
+        print(f"{name}: {entry['kind']}, {entry['pages_written']}/{entry['page_count']} pages, "
+              f"{entry['size']} bytes for a {entry['db_size']} byte database in {entry['seconds']}s")
+        problems = backup_manager.verify(name)
+        print("Verified" if not problems else f"Verification failed: {'; '.join(problems)}")
+    
+    @app.cli.command('verify-backups')
+    def verify_backups_command():
+        """Restore every backup to a scratch file and check it"""
+        for backup in backup_manager.list_backups():
+            if backup['exists']:
+                problems = backup_manager.verify(backup['name'])
+                print(f"{backup['name']}: {'ok' if not problems else '; '.join(problems)}")
+    
+    @app.cli.command('restore-backup')
+    @click.argument('name')
+    @click.argument('target')
+    def restore_backup_command(name, target):
+        """Rebuild backup NAME as a database file at TARGET (swap it in with the app stopped)"""
+        backup_manager.restore(name, target)
+        print(f"Restored {name} to {target}")
+    
+    @app.cli.command('create-indexes')
+    def create_indexes_command():
+        """Build model indexes missing from the database and rebuild invalid ones (run on deploy)"""
+        result = ensure_model_indexes()
+        print(f"Created {len(result['created'])} indexes, rebuilt {len(result['rebuilt'])} invalid: "
+              f"{', '.join(result['created'] + result['rebuilt']) or 'none needed'}")
+    
+    @app.cli.command('check-query-plans')
+    def check_query_plans_command():
+        """EXPLAIN the hot queries; exits non-zero if any falls back to a full table scan"""
+        failed = 0
+        for name, ok, plan in check_query_plans():
+            print(f"{'ok  ' if ok else 'FAIL'} {name}: {' / '.join(line.strip() for line in plan)}")
+            failed += not ok
+        if failed:
+            raise SystemExit(f"{failed} hot queries scan a whole table")
+    
+    @app.cli.command('rebuild-timelines')
+    def rebuild_timelines_command():
+        """Rebuild the materialized home timelines from follows"""
+        count = timeline.rebuild()
+        print(f"Rebuilt home timelines: {count} entries")
+    
     @app.route('/favicon.ico')
     def favicon():
         return '', 204  # No content response for favicon
@@ -537,30 +760,31 @@ def create_app():
             else:
                 greeting = "Good night"
             
-            # Get IDs of users current user follows
-            following_ids = [f.followed_id for f in Follow.query.filter_by(follower_id=current_user.id).all()]
-            
-            # Show poems from followed users, or all poems if not following anyone yet
-            if following_ids:
-                poems = Poem.query.filter(
-                    Poem.user_id.in_(following_ids),
-                    Poem.is_classic == False
-                ).order_by(Poem.created_at.desc()).limit(50).all()  # Limit for performance
-            else:
-                # If not following anyone, show all user poems (not classic) to help discover
-                poems = Poem.query.filter_by(is_classic=False).order_by(Poem.created_at.desc()).limit(50).all()
-            
-            # Get saved poem IDs for current user
-            saved_poem_ids = [s.poem_id for s in SavedPoem.query.filter_by(user_id=current_user.id).all()]
+            page = home_feed_page(request.args.get('cursor'))
+            # Authors and saved state for the page in a fixed number of queries
+            feed = FeedLoader(current_user).for_poems(page.items)
+            poems = feed.poems
+            saved_poem_ids = feed.saved_ids
             
             # Check if user should see tutorial
             show_tutorial = not current_user.has_seen_tutorial
             
-            return render_template('home.html', poems=poems, greeting=greeting, saved_poem_ids=saved_poem_ids, show_tutorial=show_tutorial)
+            return render_template('home.html', poems=poems, greeting=greeting, saved_poem_ids=saved_poem_ids, show_tutorial=show_tutorial,
+                                   next_page_url=next_page_url(page))
         except Exception as e:
             logger.error(f"Error in home route: {str(e)}")
             return render_template('home.html', poems=[], greeting="Hello", saved_poem_ids=[], show_tutorial=False, error='Failed to load home page')
     
+    @app.route('/api/feed')
+    @login_required
+    def api_feed():
+        """Load-more endpoint for the home feed"""
+        try:
+            page = home_feed_page(request.args.get('cursor'))
+            return jsonify({'poems': FeedLoader(current_user).for_poems(page.items).to_dicts(), 'next_cursor': page.next_cursor})
+        except InvalidCursor as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+    
     @app.route('/new-poem', methods=['GET', 'POST'])
     @login_required
     @require_permission('create_poem')
@@ -637,6 +861,7 @@ def create_app():
             return render_template('new_poem.html', error='Failed to create poem. Please try again.')
     
     @app.route('/users')
+    @read_only
     @login_required
     def users():
         try:
@@ -787,41 +1012,21 @@ def create_app():
     @app.route('/settings/delete-account', methods=['POST'])
     @login_required
     def delete_account():
-        """Permanently delete user account and all associated data"""
+        """Permanently delete user account and all associated data (in the background)"""
         try:
-            from models import Notification, Follow
-            
-            user_id = current_user.id
-            
-            # Delete all user's poems (this will cascade delete comments via relationship)
-            user_poems = Poem.query.filter_by(user_id=user_id).all()
-            for poem in user_poems:
-                db.session.delete(poem)
+            job = account_deletion.enqueue(current_user, requested_by=current_user.id)
             
-            # Delete all notifications for this user
-            Notification.query.filter_by(user_id=user_id).delete()
-            
-            # Delete all follow relationships (following and followers)
-            Follow.query.filter_by(follower_id=user_id).delete()
-            Follow.query.filter_by(followed_id=user_id).delete()
-            
-            # Delete all comments by this user
-            Comment.query.filter_by(user_id=user_id).delete()
-            
-            # Finally, delete the user account
-            db.session.delete(current_user)
-            db.session.commit()
-            
-            # Log out the user
+            # Log out the user - the account is locked until the job removes it
             logout_user()
             
-            return jsonify({'status': 'success', 'message': 'Account deleted successfully'})
+            return jsonify({'status': 'success', 'message': 'Account deletion started', 'job_id': job.id}), 202
         except Exception as e:
             db.session.rollback()
             print(f"Error deleting account: {e}")
             return jsonify({'status': 'error', 'message': str(e)}), 500
     
     @app.route('/admin')
+    @read_only
     @login_required
     def admin():
         try:
@@ -831,26 +1036,29 @@ def create_app():
             from models import UserActivity, Visitor
             from datetime import datetime, timedelta
             
-            total_users = User.query.count()
-            total_poems = Poem.query.count()
-            total_comments = Comment.query.count()
+            # Totals come from the latest rollup snapshot plus rows created since
+            total_users = analytics_rollups.gauge('total_users')['']
+            total_poems = analytics_rollups.gauge('total_poems')['']
+            total_comments = analytics_rollups.gauge('total_comments')['']
             all_users = User.query.order_by(User.created_at.desc()).limit(100).all()  # Limit for performance
             recent_poems = Poem.query.order_by(Poem.created_at.desc()).limit(10).all()
             
             # Analytics data
-            total_visitors = Visitor.query.count()
+            total_visitors = analytics_rollups.gauge('total_visitors')['']
             recent_visitors = Visitor.query.order_by(Visitor.last_visit.desc()).limit(20).all()
-            recent_activities = UserActivity.query.order_by(UserActivity.created_at.desc()).limit(50).all()
+            # Ids grow with time, so the primary key gives the newest rows without a sort
+            recent_activities = UserActivity.query.order_by(UserActivity.id.desc()).limit(50).all()
             
             # Today's stats
             today = datetime.utcnow().date()
             today_start = datetime.combine(today, datetime.min.time())
-            today_activities = UserActivity.query.filter(UserActivity.created_at >= today_start).count()
-            today_visitors = Visitor.query.filter(Visitor.last_visit >= today_start).count()
+            today_activities = sum(analytics_rollups.totals('activity', today_start).values())
+            today_visitors = unique_sketches.unique('visitors')
             
             # Source breakdown
-            instagram_visitors = Visitor.query.filter_by(source='instagram').count()
-            direct_visitors = Visitor.query.filter_by(source='direct').count()
+            visitors_by_source = analytics_rollups.gauge('visitors_by_source')
+            instagram_visitors = visitors_by_source['instagram']
+            direct_visitors = visitors_by_source['direct']
             
             return render_template('admin.html', 
                                  total_users=total_users,
@@ -869,6 +1077,79 @@ def create_app():
             logger.error(f"Error in admin route: {str(e)}")
             abort(500)
     
+    @app.route('/metrics')
+    def prometheus_metrics():
+        """Request latency histograms, DB/template time and app counters for Prometheus"""
+        if not metrics.enabled:
+            abort(404)
+        token = app.config.get('METRICS_TOKEN')
+        if token:
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+                return Response('Unauthorized', 401, {'WWW-Authenticate': 'Bearer'})
+        elif not (request.remote_addr in ('127.0.0.1', '::1')
+                  or (current_user.is_authenticated and current_user.is_admin)):
+            # Without a token only a scraper on this host or an admin may see endpoints and latencies
+            abort(404)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+    
+    @app.route('/admin/latency')
+    @login_required
+    def admin_latency():
+        """p50/p95/p99 request latency per endpoint across all workers"""
+        if not current_user.is_admin:
+            abort(403)
+        return jsonify(metrics.route_latency())
+    
+    @app.route('/admin/analytics-writer')
+    @login_required
+    def admin_analytics_writer():
+        """Buffered analytics writer counters (queued, written, dropped, failed)"""
+        if not current_user.is_admin:
+            abort(403)
+        return jsonify(analytics_writer.stats())
+    
+    @app.route('/admin/unique-stats')
+    @login_required
+    def admin_unique_stats():
+        """DAU/WAU/MAU and unique visitors from sketches (?exact=1 counts raw rows instead)"""
+        if not current_user.is_admin:
+            abort(403)
+        return jsonify(AnalyticsTracker.get_unique_stats(exact=request.args.get('exact') == '1'))
+    
+    @app.route('/admin/spam')
+    @login_required
+    def admin_spam():
+        """Poems and comments whose spam score is at or above the threshold"""
+        if not current_user.is_admin:
+            abort(403)
+        return jsonify({'threshold': spam_filter.threshold, 'items': spam_filter.flagged()})
+    
+    @app.route('/admin/spam/rescore', methods=['GET', 'POST'])
+    @login_required
+    def admin_rescore_spam():
+        """Queue a re-score of every poem and comment (after changing rules or the threshold), or show its progress"""
+        if not current_user.is_admin:
+            abort(403)
+        if request.method == 'POST':
+            return jsonify(spam_filter.enqueue_rescore(requested_by=current_user.id).to_dict()), 202
+        job = SpamRescoreJob.query.order_by(SpamRescoreJob.id.desc()).first()
+        if job is None:
+            return jsonify({'status': 'error', 'message': 'No re-score has been queued'}), 404
+        return jsonify(job.to_dict())
+    
+    @app.route('/admin/backups', methods=['GET', 'POST'])
+    @login_required
+    def admin_backups():
+        """List database backups, or queue one (full=1 starts a new chain)"""
+        if not current_user.is_admin:
+            abort(403)
+        if not backup_manager.available:
+            return jsonify({'status': 'error', 'message': 'Backups need a SQLite file database'}), 400
+        if request.method == 'POST':
+            backup_manager.submit(('backup', request.values.get('full') == '1'))
+            return jsonify({'status': 'success', 'message': 'Backup started'}), 202
+        return jsonify(backup_manager.list_backups())
+    
     @app.route('/admin/delete-user/<int:user_id>', methods=['POST'])
     @login_required
     def admin_delete_user(user_id):
@@ -877,8 +1158,6 @@ def create_app():
             return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
         
         try:
-            from models import Notification, Follow
-            
             user = User.query.get(user_id)
             if not user:
                 return jsonify({'status': 'error', 'message': 'User not found'}), 404
@@ -887,33 +1166,36 @@ def create_app():
             if user.is_admin:
                 return jsonify({'status': 'error', 'message': 'Cannot delete admin accounts'}), 403
             
-            username = user.username
-            
-            # Delete all user's poems (comments will cascade)
-            user_poems = Poem.query.filter_by(user_id=user_id).all()
-            for poem in user_poems:
-                db.session.delete(poem)
-            
-            # Delete all notifications for this user
-            Notification.query.filter_by(user_id=user_id).delete()
-            
-            # Delete all follow relationships
-            Follow.query.filter_by(follower_id=user_id).delete()
-            Follow.query.filter_by(followed_id=user_id).delete()
+            job = account_deletion.enqueue(user, requested_by=current_user.id)
             
-            # Delete all comments
-            Comment.query.filter_by(user_id=user_id).delete()
-            
-            # Delete the user
-            db.session.delete(user)
-            db.session.commit()
-            
-            return jsonify({'status': 'success', 'message': f'User {username} deleted successfully'})
+            return jsonify({
+                'status': 'success',
+                'message': f'Deleting user {job.username}',
+                'job_id': job.id,
+                'status_url': url_for('admin_deletion_job', job_id=job.id)
+            }), 202
         except Exception as e:
             db.session.rollback()
             print(f"Error deleting user: {e}")
             return jsonify({'status': 'error', 'message': str(e)}), 500
     
+    @app.route('/admin/deletion-jobs')
+    @login_required
+    def admin_deletion_jobs():
+        """Recent account deletion jobs with their progress"""
+        if not current_user.is_admin:
+            abort(403)
+        jobs = DeletionJob.query.order_by(DeletionJob.id.desc()).limit(100).all()
+        return jsonify([account_deletion.progress(job) for job in jobs])
+    
+    @app.route('/admin/deletion-jobs/<int:job_id>')
+    @login_required
+    def admin_deletion_job(job_id):
+        """Progress of one account deletion job"""
+        if not current_user.is_admin:
+            abort(403)
+        return jsonify(account_deletion.progress(DeletionJob.query.get_or_404(job_id)))
+    
     @app.route('/admin/reset-password/<int:user_id>', methods=['GET', 'POST'])
     @login_required
     def reset_password(user_id):
@@ -935,7 +1217,15 @@ def create_app():
     def poem_detail(poem_id):
         try:
             from models import Notification, SavedPoem
-            poem = Poem.query.get_or_404(poem_id)
+            poem = Poem.query.options(joinedload(Poem.author)).filter_by(id=poem_id).first_or_404()
+            
+            def render_detail(**context):
+                # Comments with their authors in one query, newest first
+                comments = Comment.query.options(joinedload(Comment.author)).filter_by(
+                    poem_id=poem_id
+                ).order_by(Comment.created_at.desc(), Comment.id.desc()).all()
+                is_saved = SavedPoem.query.filter_by(user_id=current_user.id, poem_id=poem_id).first() is not None
+                return render_template('poem_detail.html', poem=poem, comments=comments, is_saved=is_saved, **context)
             
             if request.method == 'POST':
                 comment_text = request.form.get('comment', '').strip()
@@ -943,8 +1233,7 @@ def create_app():
                 # Validate comment
                 comment_valid, comment_msg = Comment.validate_content(comment_text)
                 if not comment_valid:
-                    is_saved = SavedPoem.query.filter_by(user_id=current_user.id, poem_id=poem_id).first() is not None
-                    return render_template('poem_detail.html', poem=poem, is_saved=is_saved, error=comment_msg)
+                    return render_detail(error=comment_msg)
                 
                 comment = Comment(content=comment_text, user_id=current_user.id, poem_id=poem_id)
                 db.session.add(comment)
@@ -964,10 +1253,7 @@ def create_app():
                 logger.info(f"Comment added by {current_user.username} on poem {poem_id}")
                 return redirect(url_for('poem_detail', poem_id=poem_id))
             
-            # Check if poem is saved by current user
-            is_saved = SavedPoem.query.filter_by(user_id=current_user.id, poem_id=poem_id).first() is not None
-            
-            return render_template('poem_detail.html', poem=poem, is_saved=is_saved)
+            return render_detail()
         except Exception as e:
             logger.error(f"Error in poem_detail route: {str(e)}")
             if request.method == 'POST':
@@ -1059,8 +1345,9 @@ def create_app():
     @login_required
     def saved_poems():
         from models import SavedPoem
-        saved = SavedPoem.query.filter_by(user_id=current_user.id).order_by(SavedPoem.saved_at.desc()).all()
-        poems = [s.poem for s in saved]
+        poems = Poem.query.join(SavedPoem, SavedPoem.poem_id == Poem.id).options(
+            joinedload(Poem.author)
+        ).filter(SavedPoem.user_id == current_user.id).order_by(SavedPoem.saved_at.desc()).all()
         return render_template('saved_poems.html', poems=poems)
     
 
@@ -1092,8 +1379,8 @@ def create_app():
                         db.session.add(notif)
             
             db.session.commit()
-            like_count = Like.query.filter_by(poem_id=poem_id).count()
-            return jsonify({'status': 'success', 'action': action, 'count': like_count})
+            # Counter was bumped in the same transaction; this reloads the poem row
+            return jsonify({'status': 'success', 'action': action, 'count': poem.like_count})
         except Exception as e:
             logger.error(f"Error in toggle_like_poem route: {str(e)}")
             db.session.rollback()
@@ -1119,11 +1406,18 @@ def create_app():
     
 
     @app.route('/user/<int:user_id>')
+    @read_only
     @login_required
     def user_profile(user_id):
         from models import Follow, Highlight
         user = User.query.get_or_404(user_id)
-        poems = Poem.query.filter_by(user_id=user_id, is_classic=False).order_by(Poem.created_at.desc()).all()
+        try:
+            page = keyset_paginate(Poem.query.filter_by(user_id=user_id, is_classic=False),
+                                   [Poem.created_at, Poem.id],
+                                   request.args.get('cursor'), app.config['POEMS_PER_PAGE'])
+        except InvalidCursor:
+            abort(400)
+        poems = page.items
         
         # Check if current user follows this user
         is_following = Follow.query.filter_by(follower_id=current_user.id, followed_id=user_id).first() is not None
@@ -1136,7 +1430,21 @@ def create_app():
         highlights = Highlight.query.filter_by(user_id=user_id).all()
         
         return render_template('user_profile.html', user=user, poems=poems, is_following=is_following, 
-                             followers_count=followers_count, following_count=following_count, highlights=highlights)
+                             followers_count=followers_count, following_count=following_count, highlights=highlights,
+                             poem_count=user.get_poem_count(), next_page_url=next_page_url(page))
+    
+    @app.route('/api/user/<int:user_id>/poems')
+    @login_required
+    def api_user_poems(user_id):
+        """Load-more endpoint for a user's profile poems"""
+        User.query.get_or_404(user_id)
+        try:
+            page = keyset_paginate(Poem.query.filter_by(user_id=user_id, is_classic=False),
+                                   [Poem.created_at, Poem.id],
+                                   request.args.get('cursor'), app.config['POEMS_PER_PAGE'])
+            return jsonify({'poems': FeedLoader(current_user).for_poems(page.items).to_dicts(), 'next_cursor': page.next_cursor})
+        except InvalidCursor as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
     
     @app.route('/user/<int:user_id>/follow', methods=['POST'])
     @login_required
@@ -1209,67 +1517,11 @@ def create_app():
                              current_user_following_ids=current_user_following_ids)
     
     @app.route('/search', methods=['GET'])
+    @read_only
     @login_required
     def search():
         try:
-            query = request.args.get('q', '').strip()
-            mood_filter = request.args.get('mood', '').strip()
-            theme_filter = request.args.get('theme', '').strip()
-            category_filter = request.args.get('category', '').strip()
-            poet_filter = request.args.get('poet', '').strip()
-            sort_by = request.args.get('sort', 'recent')  # recent, popular, oldest
-            
-            poems = []
-            
-            if query or mood_filter or theme_filter or category_filter or poet_filter:
-                # Build query
-                search_query = Poem.query.join(User)
-                
-                # Text search
-                if query:
-                    if len(query) > 200:
-                        query = query[:200]
-                    search_query = search_query.filter(
-                        db.or_(
-                            Poem.title.ilike(f'%{query}%'),
-                            Poem.content.ilike(f'%{query}%'),
-                            User.username.ilike(f'%{query}%')
-                        )
-                    )
-                
-                # Mood filter
-                if mood_filter:
-                    search_query = search_query.filter(Poem.mood.ilike(f'%{mood_filter}%'))
-                
-                # Theme filter
-                if theme_filter:
-                    search_query = search_query.filter(Poem.theme.ilike(f'%{theme_filter}%'))
-                
-                # Category filter
-                if category_filter:
-                    search_query = search_query.filter(Poem.category.ilike(f'%{category_filter}%'))
-                
-                # Poet filter
-                if poet_filter:
-                    search_query = search_query.filter(User.username.ilike(f'%{poet_filter}%'))
-                
-                # Sorting
-                if sort_by == 'popular':
-                    # Sort by like count (requires subquery)
-                    from models import Like
-                    like_counts = db.session.query(
-                        Like.poem_id,
-                        db.func.count(Like.id).label('like_count')
-                    ).group_by(Like.poem_id).subquery()
-                    
-                    search_query = search_query.outerjoin(like_counts, Poem.id == like_counts.c.poem_id)
-                    search_query = search_query.order_by(db.desc(like_counts.c.like_count))
-                elif sort_by == 'oldest':
-                    search_query = search_query.order_by(Poem.created_at.asc())
-                else:  # recent
-                    search_query = search_query.order_by(Poem.created_at.desc())
-                
-                poems = search_query.limit(100).all()
+            poems, page, params = run_search(request.args)
             
             # Get available filter options
             moods = db.session.query(Poem.mood).filter(Poem.mood.isnot(None)).distinct().all()
@@ -1282,54 +1534,77 @@ def create_app():
             
             return render_template('search.html', 
                                  poems=poems, 
-                                 query=query,
-                                 mood_filter=mood_filter,
-                                 theme_filter=theme_filter,
-                                 category_filter=category_filter,
-                                 poet_filter=poet_filter,
-                                 sort_by=sort_by,
+                                 next_page_url=next_page_url(page) if page else None,
                                  moods=moods,
                                  themes=themes,
-                                 categories=categories)
+                                 categories=categories,
+                                 **params)
         except Exception as e:
             logger.error(f"Error in search route: {str(e)}")
             return render_template('search.html', poems=[], query='', error='Search failed')
     
+    @app.route('/api/search')
+    @login_required
+    def api_search():
+        """Load-more endpoint for search results"""
+        try:
+            poems, page, params = run_search(request.args)
+            return jsonify({
+                'poems': FeedLoader(current_user).for_poems(poems).to_dicts(),
+                'next_cursor': page.next_cursor if page else None,
+                'sort': params['sort_by']
+            })
+        except InvalidCursor as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+    
 
     @app.route('/notifications')
     @login_required
     def notifications():
         try:
             from models import Notification
-            notifs = Notification.query.filter_by(
-                user_id=current_user.id
-            ).order_by(Notification.created_at.desc()).limit(100).all()  # Limit for performance
+            page = keyset_paginate(
+                Notification.query.filter_by(user_id=current_user.id),
+                [Notification.created_at, Notification.id],
+                request.args.get('cursor'), app.config['NOTIFICATIONS_PER_PAGE']
+            )
+            notifs = page.items
             
-            # Mark as read
-            for notif in notifs:
-                notif.is_read = True
+            # Viewing the page marks everything read in one UPDATE and resets the badge counter
+            current_user.mark_notifications_read()
             db.session.commit()
             
-            return render_template('notifications.html', notifications=notifs)
+            return render_template('notifications.html', notifications=notifs, next_page_url=next_page_url(page))
         except Exception as e:
             logger.error(f"Error in notifications route: {str(e)}")
             db.session.rollback()
             return render_template('notifications.html', notifications=[], error='Failed to load notifications')
     
+    @app.route('/api/notifications')
+    @login_required
+    def api_notifications():
+        """Load-more endpoint for the notifications list (does not mark them read)"""
+        try:
+            from models import Notification
+            page = keyset_paginate(
+                Notification.query.filter_by(user_id=current_user.id),
+                [Notification.created_at, Notification.id],
+                request.args.get('cursor'), app.config['NOTIFICATIONS_PER_PAGE']
+            )
+            return jsonify({'notifications': [n.to_dict() for n in page.items], 'next_cursor': page.next_cursor})
+        except InvalidCursor as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+    
     @app.route('/notifications/unread-count')
     @login_required
     def unread_notifications_count():
-        from models import Notification
-        count = Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
-        return jsonify({'count': count})
+        # Denormalized counter on the already-loaded user row - no notifications scan
+        return jsonify({'count': current_user.unread_notification_count})
     
     @app.route('/api/track-instagram-visitor', methods=['POST'])
     def track_instagram_visitor():
         """Hidden API endpoint to track Instagram visitors automatically"""
         try:
-            from models import Visitor
-            from datetime import datetime
-            
             data = request.get_json()
             if not data:
                 return jsonify({'status': 'error', 'message': 'Invalid request'}), 400
@@ -1340,33 +1615,12 @@ def create_app():
             nickname = data.get('nickname', '')[:100] if data.get('nickname') else None
             source = 'instagram'
             
-            # Check if visitor exists
-            visitor = Visitor.query.filter_by(ip_address=ip_address).first()
-            
-            if visitor:
-                # Update existing visitor
-                visitor.last_visit = datetime.utcnow()
-                visitor.visit_count += 1
-                if visitor.source == 'direct':  # Update if was previously direct
-                    visitor.source = source
-                if nickname and not visitor.nickname:  # Add nickname if provided
-                    visitor.nickname = nickname
-            else:
-                # Create new visitor
-                visitor = Visitor(
-                    nickname=nickname,
-                    source=source,
-                    ip_address=ip_address,
-                    user_agent=user_agent,
-                    referrer=referrer if referrer else None
-                )
-                db.session.add(visitor)
-            
-            db.session.commit()
+            # Existing visitors only switch to instagram if they were previously direct
+            AnalyticsTracker.record_visit(ip_address, user_agent, referrer, nickname, source,
+                                          source_update=source, source_if_direct=True)
             return jsonify({'status': 'success'})
         except Exception as e:
             logger.error(f"Error tracking Instagram visitor: {str(e)}")
-            db.session.rollback()
             return jsonify({'status': 'error', 'message': 'Tracking failed'}), 500
     
     @app.route('/api/check-new-notifications')
@@ -1395,6 +1649,48 @@ def create_app():
             logger.error(f"Error in check_new_notifications route: {str(e)}")
             return jsonify({'notifications': []}), 500
     
+    @app.route('/api/notifications/stream')
+    @login_required
+    def notification_stream():
+        """Server-Sent Events stream of new notifications (replaces desktop polling)"""
+        from models import Notification
+        
+        # Streams hold a request thread each; past the cap the client polls until Retry-After
+        if not notification_hub.reserve():
+            return Response(notification_hub.format_refusal(), mimetype='text/event-stream',
+                            headers={'Retry-After': str(notification_hub.max_duration), 'Cache-Control': 'no-cache'})
+        
+        user_id = current_user.id
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_event_id = None
+        
+        def load_backlog():
+            if last_event_id is None:
+                # First connection: the latest few unread, like the old polling endpoint
+                missed = Notification.query.filter_by(user_id=user_id, is_read=False).order_by(
+                    Notification.id.desc()
+                ).limit(5).all()[::-1]
+            else:
+                # Reconnection: everything created since the last event the client saw
+                missed = Notification.query.filter(
+                    Notification.user_id == user_id, Notification.id > last_event_id
+                ).order_by(Notification.id).limit(50).all()
+            backlog = [serialize_notification(n) for n in missed]
+            # Return the connection to the pool for the lifetime of the stream
+            db.session.remove()
+            return backlog
+        
+        response = Response(stream_with_context(notification_hub.stream(user_id, load_backlog)),
+                            mimetype='text/event-stream')
+        # Runs when the server closes the response, even if the stream never started
+        response.call_on_close(notification_hub.release)
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (nginx)
+        return response
+    
     @app.route('/mark-tutorial-seen', methods=['POST'])
     @login_required
     def mark_tutorial_seen():
@@ -1410,6 +1706,7 @@ def create_app():
             return jsonify({'status': 'error', 'message': 'Failed to update tutorial status'}), 500
     
     @app.route('/sitemap.xml')
+    @read_only
     def sitemap():
         """Generate sitemap for search engines"""
         try:
@@ -1520,69 +1817,117 @@ Sitemap: {request.url_root}sitemap.xml"""
     
     with app.app_context():
         try:
-            db.create_all()
-            
-            # Initialize database if empty
-            if Poem.query.count() == 0:
-                logger.info("Database is empty. Loading poems...")
-                from seed_poems import FAMOUS_POEMS
-                from seed_poems_part2 import ADDITIONAL_FAMOUS_POEMS
-                from werkzeug.security import generate_password_hash
+            sqlite_profile.init_app(app)
+            # One worker at a time; the rest find the schema already current
+            with migration_lock(app.config.get('SCHEMA_LOCK_FILE', 'instance/schema.lock')):
+                db.create_all()
+                added_columns = ensure_schema()
+                if any(column.endswith('_count') for column in added_columns):
+                    fixed = Poem.reconcile_counters()
+                    logger.info(f"Initialized counters for {fixed} poems")
+                if 'users.unread_notification_count' in added_columns:
+                    fixed = User.reconcile_unread_counts()
+                    logger.info(f"Initialized unread notification counts for {fixed} users")
+                if 'users.follower_count' in added_columns:
+                    fixed = User.reconcile_follower_counts()
+                    logger.info(f"Initialized follower counts for {fixed} users")
+                if 'visitors.visitor_key' in added_columns:
+                    keyed = AnalyticsTracker.backfill_visitor_keys()
+                    logger.info(f"Assigned visitor keys to {keyed} visitors")
+                if 'poems.spam_score' in added_columns or 'comments.spam_score' in added_columns:
+                    # Scoring every row would hold up worker boot; new and edited content is scored as it is saved
+                    logger.info("Added spam_score columns; run `flask rescore-spam` or POST /admin/spam/rescore "
+                                "to score existing poems and comments")
+        except Exception as e:
+            logger.error(f"Error migrating database schema: {str(e)}")
+            db.session.rollback()
+        
+        # Each extension starts on its own so one failure doesn't leave the rest unconfigured
+        for extension in (search_index, timeline, notification_hub, analytics_writer, analytics_rollups,
+                          unique_sketches, source_classifier, security_manager, spam_filter, data_protection,
+                          key_rotation, account_deletion, backup_manager, replica_router, query_stats, metrics):
+            try:
+                extension.init_app(app)
+            except Exception as e:
+                logger.error(f"Error initializing {type(extension).__name__}: {str(e)}")
+                db.session.rollback()
+        
+        try:
+            # Periodic maintenance jobs (one leader process per host)
+            job_scheduler.init_app(app)
+            job_scheduler.every(app.config['ROLLUP_INTERVAL_MINUTES'], analytics_rollups.run, 'analytics_rollups')
+            job_scheduler.every(app.config['ROLLUP_INTERVAL_MINUTES'], unique_sketches.maintain, 'unique_sketches')
+            job_scheduler.every(app.config['ACCOUNT_DELETION_RESUME_MINUTES'], account_deletion.resume, 'account_deletions')
+            if app.config['BACKUP_ENABLED'] and backup_manager.available:
+                job_scheduler.every(app.config['BACKUP_INTERVAL_HOURS'] * 60, backup_manager.run_scheduled, 'database_backup')
+            if app.config['SCHEDULER_ENABLED']:
+                job_scheduler.start()
+        except Exception as e:
+            logger.error(f"Error starting job scheduler: {str(e)}")
+        
+        try:
+            # Initialize database if empty (under the lock so only one worker seeds)
+            with migration_lock(app.config.get('SCHEMA_LOCK_FILE', 'instance/schema.lock')):
+                if Poem.query.count() == 0:
+                    logger.info("Database is empty. Loading poems...")
+                    from seed_poems import FAMOUS_POEMS
+                    from seed_poems_part2 import ADDITIONAL_FAMOUS_POEMS
+                    from werkzeug.security import generate_password_hash
                 
-                # Merge both poem collections
-                all_poems = {**FAMOUS_POEMS, **ADDITIONAL_FAMOUS_POEMS}
+                    # Merge both poem collections
+                    all_poems = {**FAMOUS_POEMS, **ADDITIONAL_FAMOUS_POEMS}
                 
-                for poet_name, poems in all_poems.items():
-                    try:
-                        poet_user = User.query.filter_by(username=poet_name).first()
-                        
-                        if not poet_user:
-                            poet_user = User(
-                                username=poet_name,
-                                email=f'{poet_name.lower().replace(" ", "")}@poetryvault.com',
-                                password_hash=generate_password_hash('classic_poet_2024'),
-                                age=None,
-                                favorite_poet=poet_name,
-                                is_admin=False
-                            )
-                            db.session.add(poet_user)
-                            db.session.flush()
+                    for poet_name, poems in all_poems.items():
+                        try:
+                            poet_user = User.query.filter_by(username=poet_name).first()
                         
-                        for poem_data in poems:
-                            try:
-                                poem = Poem(
-                                    title=poem_data['title'][:200],
-                                    content=poem_data['content'][:50000],
-                                    category=poem_data.get('category', 'general'),
-                                    mood=poem_data.get('mood', 'contemplative'),
-                                    theme=poem_data.get('theme', 'reflection'),
-                                    user_id=poet_user.id,
-                                    is_classic=True
+                            if not poet_user:
+                                poet_user = User(
+                                    username=poet_name,
+                                    email=f'{poet_name.lower().replace(" ", "")}@poetryvault.com',
+                                    password_hash=generate_password_hash('classic_poet_2024'),
+                                    age=None,
+                                    favorite_poet=poet_name,
+                                    is_admin=False
                                 )
-                                db.session.add(poem)
-                            except Exception as e:
-                                logger.error(f"Error adding poem {poem_data.get('title', 'Unknown')}: {str(e)}")
-                                continue
-                    except Exception as e:
-                        logger.error(f"Error processing poet {poet_name}: {str(e)}")
-                        continue
-                
-                db.session.commit()
-                logger.info("Database initialized with poems")
+                                db.session.add(poet_user)
+                                db.session.flush()
+                        
+                            for poem_data in poems:
+                                try:
+                                    poem = Poem(
+                                        title=poem_data['title'][:200],
+                                        content=poem_data['content'][:50000],
+                                        category=poem_data.get('category', 'general'),
+                                        mood=poem_data.get('mood', 'contemplative'),
+                                        theme=poem_data.get('theme', 'reflection'),
+                                        user_id=poet_user.id,
+                                        is_classic=True
+                                    )
+                                    db.session.add(poem)
+                                except Exception as e:
+                                    logger.error(f"Error adding poem {poem_data.get('title', 'Unknown')}: {str(e)}")
+                                    continue
+                        except Exception as e:
+                            logger.error(f"Error processing poet {poet_name}: {str(e)}")
+                            continue
                 
-                # Create default admin user for deployment
-                admin_user = User.query.filter_by(username='admin').first()
-                if not admin_user:
-                    admin_user = User(
-                        username='admin',
-                        email='admin@poetryvault.com',
-                        password_hash=generate_password_hash('admin123'),
-                        is_admin=True,
-                        age=25
-                    )
-                    db.session.add(admin_user)
                     db.session.commit()
-                    logger.info("Admin user created: username=admin")
+                    logger.info("Database initialized with poems")
+                
+                    # Create default admin user for deployment
+                    admin_user = User.query.filter_by(username='admin').first()
+                    if not admin_user:
+                        admin_user = User(
+                            username='admin',
+                            email='admin@poetryvault.com',
+                            password_hash=generate_password_hash('admin123'),
+                            is_admin=True,
+                            age=25
+                        )
+                        db.session.add(admin_user)
+                        db.session.commit()
+                        logger.info("Admin user created: username=admin")
         except Exception as e:
             logger.error(f"Error during database initialization: {str(e)}")
             db.session.rollback()
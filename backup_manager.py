@@ -0,0 +1,517 @@
+"""
+Database Backups for Poetry Vault
+Online SQLite snapshots stored as compressed full or page-diff archives, verified in the background
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:  # gzip only
+    zstandard = None
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+DIFF_MAGIC = b'PVDIFF1\n'
+UINT32 = struct.Struct('>I')
+EXTENSIONS = {'zstd': '.zst', 'gzip': '.gz', None: ''}
+CHUNK_SIZE = 1024 * 1024
+
+
+def open_archive(path, mode, compression):
+    """Streaming binary file object over a zstd, gzip or uncompressed archive ('r' or 'w')"""
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd archive but the zstandard package is not installed")
+        raw = open(path, mode + 'b')
+        if mode == 'w':
+            return zstandard.ZstdCompressor(level=3).stream_writer(raw)
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    if compression == 'gzip':
+        return gzip.open(path, mode + 'b', compresslevel=6)
+    return open(path, mode + 'b')
+
+
+def _read_exact(stream, size):
+    # Decompressing readers may return short reads
+    parts = []
+    while size:
+        part = stream.read(size)
+        if not part:
+            raise ValueError("Truncated backup archive")
+        parts.append(part)
+        size -= len(part)
+    return b''.join(parts)
+
+
+def _file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as database_file:
+        for chunk in iter(lambda: database_file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _page_hash(page):
+    return hashlib.blake2b(page, digest_size=16).digest()
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+class _StepPacer:
+    """Online-backup progress callback: pause between steps, give up after repeated restarts"""
+
+    def __init__(self, pause, max_restarts=3):
+        self.pause = pause
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.remaining = None
+
+    def __call__(self, status, remaining, total):
+        if self.remaining is not None and remaining > self.remaining:
+            self.restarts += 1
+            if self.restarts >= self.max_restarts:
+                raise _TooManyRestarts()
+        self.remaining = remaining
+        if remaining:
+            time.sleep(self.pause)
+
+
+class BackupManager:
+    """
+    SQLite backups without blocking the app
+
+    A snapshot is taken with the online backup API a few hundred pages per step,
+    pausing between steps so writers get the database in between, then streamed into
+    a compressed archive. A full backup starts each chain; later backups in the chain
+    store only the pages whose hash changed since the previous backup (the page
+    hashes of the newest backup are kept beside it). Retention drops whole chains,
+    oldest first. Each new archive is restored and checked (checksum, integrity_check,
+    row counts) on a background thread.
+
+    backup_metadata.json keeps the format of the older full-copy backups - per file:
+    created, size, checksum (MD5 of the restored database), stats, validated - plus
+    the chain fields; entries without a kind are those older plain .db copies.
+    """
+
+    def __init__(self):
+        self.directory = 'instance/backups'
+        self.database_path = None
+        self.compression = 'zstd' if zstandard is not None else 'gzip'
+        self.max_count = 10
+        self.full_every = 7
+        self.pages_per_step = 256
+        self.step_pause = 0.01
+        self.verify_enabled = True
+        self._lock = threading.Lock()
+        self._metadata_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read settings and locate the SQLite file (call inside an app context)"""
+        self.directory = app.config.get('BACKUP_DIR', 'instance/backups')
+        self.max_count = int(app.config.get('BACKUP_MAX_COUNT', 10))
+        self.full_every = max(1, int(app.config.get('BACKUP_FULL_EVERY', 7)))
+        self.pages_per_step = int(app.config.get('BACKUP_PAGES_PER_STEP', 256))
+        self.step_pause = float(app.config.get('BACKUP_STEP_PAUSE', 0.01))
+        self.verify_enabled = bool(app.config.get('BACKUP_VERIFY', True))
+        compression = app.config.get('BACKUP_COMPRESSION', 'auto')
+        if compression == 'auto' or (compression == 'zstd' and zstandard is None):
+            if compression == 'zstd':
+                logger.warning("BACKUP_COMPRESSION=zstd but zstandard is not installed; using gzip")
+            compression = 'zstd' if zstandard is not None else 'gzip'
+        self.compression = compression if compression in EXTENSIONS else 'gzip'
+
+        url = db.engine.url
+        self.database_path = url.database if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:') else None
+        if self.database_path is None:
+            logger.info("Database backups disabled: not a SQLite file database")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def available(self):
+        return self.database_path is not None
+
+    # Metadata
+
+    @property
+    def metadata_path(self):
+        return os.path.join(self.directory, 'backup_metadata.json')
+
+    def load_metadata(self):
+        try:
+            with open(self.metadata_path) as metadata_file:
+                return json.load(metadata_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_metadata(self, metadata):
+        temporary = f'{self.metadata_path}.tmp'
+        with open(temporary, 'w') as metadata_file:
+            json.dump(metadata, metadata_file, indent=2)
+        os.replace(temporary, self.metadata_path)
+
+    def _update_entry(self, name, **fields):
+        with self._metadata_lock:
+            metadata = self.load_metadata()
+            if name in metadata:
+                metadata[name].update(fields)
+                self._save_metadata(metadata)
+
+    def list_backups(self):
+        """Backups newest first, each with its name and whether the file is present"""
+        metadata = self.load_metadata()
+        backups = [dict(entry, name=name, exists=os.path.exists(self._path(name))) for name, entry in metadata.items()]
+        return sorted(backups, key=lambda entry: entry.get('created', ''), reverse=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _chain(metadata, name):
+        """Names from the full backup up to `name` (the first is missing from metadata if the chain is broken)"""
+        chain = [name]
+        while name in metadata and metadata[name].get('base'):
+            name = metadata[name]['base']
+            chain.append(name)
+        return chain[::-1]
+
+    # Backup
+
+    def backup(self, full=False, verify=None):
+        """
+        Take a backup now (full, or a page diff against the newest one when the chain allows)
+
+        Args:
+            full: Start a new chain even if the current one has room
+            verify: Queue background verification (defaults to BACKUP_VERIFY)
+
+        Returns:
+            tuple: (name, metadata entry)
+        """
+        if not self.available:
+            raise RuntimeError("Backups need a SQLite file database")
+        with self._lock:
+            started = time.perf_counter()
+            created = datetime.utcnow()
+            fd, snapshot = tempfile.mkstemp(prefix='.snapshot-', suffix='.db', dir=self.directory)
+            os.close(fd)
+            page_size, stats = self._snapshot(snapshot)
+
+            with self._metadata_lock:
+                metadata = self.load_metadata()
+            head = self._head(metadata)
+            base_hashes = None
+            if not full and head is not None and metadata[head].get('page_size') == page_size \
+                    and len(self._chain(metadata, head)) < self.full_every:
+                base_hashes = self._load_hashes(head)
+
+            stem = os.path.splitext(os.path.basename(self.database_path))[0]
+            suffix = '.db' if base_hashes is None else '.diff'
+            name = f"{stem}_{created.strftime('%Y%m%d_%H%M%S')}{suffix}{EXTENSIONS[self.compression]}"
+            counter = 1
+            while name in metadata or os.path.exists(self._path(name)):
+                name = f"{stem}_{created.strftime('%Y%m%d_%H%M%S')}_{counter}{suffix}{EXTENSIONS[self.compression]}"
+                counter += 1
+
+            try:
+                checksum, hashes, pages_written = self._write_archive(snapshot, name, page_size, base_hashes)
+                db_size = os.path.getsize(snapshot)
+            finally:
+                os.remove(snapshot)
+            self._save_hashes(name, hashes)
+
+            entry = {
+                'created': created.isoformat(),
+                'size': os.path.getsize(self._path(name)),
+                'checksum': checksum,
+                'stats': stats,
+                'validated': False,
+                'kind': 'full' if base_hashes is None else 'incremental',
+                'base': None if base_hashes is None else head,
+                'compression': self.compression,
+                'db_size': db_size,
+                'page_size': page_size,
+                'page_count': len(hashes),
+                'pages_written': pages_written,
+                'seconds': round(time.perf_counter() - started, 3)
+            }
+            with self._metadata_lock:
+                metadata = self.load_metadata()
+                metadata[name] = entry
+                self._save_metadata(metadata)
+            if head is not None:
+                self._remove_hashes(head)
+            logger.info(f"Backup {name}: {entry['kind']}, {pages_written}/{len(hashes)} pages, "
+                        f"{entry['size']} bytes on disk for a {db_size} byte database in {entry['seconds']}s")
+
+            self.prune()
+        if self.verify_enabled if verify is None else verify:
+            self.submit(('verify', name))
+        return name, entry
+
+    def _snapshot(self, target):
+        """Copy the live database into `target` with the online backup API; returns (page_size, row counts)"""
+        source = sqlite3.connect(self.database_path, timeout=30)
+        destination = sqlite3.connect(target)
+        try:
+            # Each step holds the source's read lock for pages_per_step pages only, and the
+            # pause lets writers in. A write from another connection restarts the copy, so
+            # under steady writes it finishes in one step after a few restarts instead.
+            try:
+                source.backup(destination, pages=self.pages_per_step, progress=_StepPacer(self.step_pause))
+            except _TooManyRestarts:
+                logger.info("Backup restarted by concurrent writes; copying in one step")
+                source.backup(destination)
+            page_size = destination.execute('PRAGMA page_size').fetchone()[0]
+            stats = self._row_counts(destination)
+        finally:
+            destination.close()
+            source.close()
+        return page_size, stats
+
+    @staticmethod
+    def _row_counts(connection):
+        present = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        return {
+            table.name: connection.execute(f'SELECT COUNT(*) FROM "{table.name}"').fetchone()[0]
+            for table in db.metadata.sorted_tables if table.name in present
+        }
+
+    def _write_archive(self, snapshot, name, page_size, base_hashes):
+        """
+        Stream the snapshot into an archive: every page for a full backup, otherwise a
+        diff of (page number, page) records for pages whose hash differs from the base
+
+        Returns:
+            tuple: (MD5 of the snapshot, page hashes, pages written)
+        """
+        checksum = hashlib.md5()
+        hashes = []
+        pages_written = 0
+        temporary = self._path(name + '.tmp')
+        with open(snapshot, 'rb') as source, open_archive(temporary, 'w', self.compression) as archive:
+            if base_hashes is not None:
+                header = json.dumps({'page_size': page_size, 'page_count': os.path.getsize(snapshot) // page_size}).encode()
+                archive.write(DIFF_MAGIC + UINT32.pack(len(header)) + header)
+            for page in iter(lambda: source.read(page_size), b''):
+                checksum.update(page)
+                digest = _page_hash(page)
+                hashes.append(digest)
+                if base_hashes is None:
+                    archive.write(page)
+                elif len(hashes) > len(base_hashes) or base_hashes[len(hashes) - 1] != digest:
+                    archive.write(UINT32.pack(len(hashes)) + page)
+                else:
+                    continue
+                pages_written += 1
+            if base_hashes is not None:
+                archive.write(UINT32.pack(0))
+        os.replace(temporary, self._path(name))
+        return checksum.hexdigest(), hashes, pages_written
+
+    def _head(self, metadata):
+        """Newest chained backup whose page hashes are still on disk (None starts a new chain)"""
+        if not metadata:
+            return None
+        name = max(metadata, key=lambda name: metadata[name].get('created', ''))
+        entry = metadata[name]
+        if 'kind' not in entry or entry.get('error') or not os.path.exists(self._path(name)):
+            return None
+        return name if os.path.exists(self._path(name + '.hashes')) else None
+
+    def _save_hashes(self, name, hashes):
+        with open(self._path(name + '.hashes'), 'wb') as hashes_file:
+            hashes_file.write(b''.join(hashes))
+
+    def _load_hashes(self, name):
+        with open(self._path(name + '.hashes'), 'rb') as hashes_file:
+            data = hashes_file.read()
+        return [data[i:i + 16] for i in range(0, len(data), 16)]
+
+    def _remove_hashes(self, name):
+        try:
+            os.remove(self._path(name + '.hashes'))
+        except OSError:
+            pass
+
+    # Restore and verification
+
+    def restore(self, name, target):
+        """
+        Rebuild the database file of backup `name` at `target` (full backup plus its diffs)
+
+        Restore into a new path and swap it in with the app stopped.
+        """
+        metadata = self.load_metadata()
+        if name not in metadata:
+            raise KeyError(f"Unknown backup {name}")
+        chain = self._chain(metadata, name)
+        if chain[0] not in metadata:
+            raise KeyError(f"Backup {name} needs {chain[0]}, which no longer exists")
+        first = metadata[chain[0]]
+        with open_archive(self._path(chain[0]), 'r', first.get('compression')) as archive, open(target, 'wb') as database_file:
+            shutil.copyfileobj(archive, database_file, CHUNK_SIZE)
+        for diff_name in chain[1:]:
+            self._apply_diff(diff_name, metadata[diff_name], target)
+
+    def _apply_diff(self, name, entry, target):
+        with open_archive(self._path(name), 'r', entry.get('compression')) as archive, open(target, 'r+b') as database_file:
+            if _read_exact(archive, len(DIFF_MAGIC)) != DIFF_MAGIC:
+                raise ValueError(f"{name} is not a page diff")
+            header = json.loads(_read_exact(archive, UINT32.unpack(_read_exact(archive, UINT32.size))[0]))
+            page_size = header['page_size']
+            while True:
+                page_number = UINT32.unpack(_read_exact(archive, UINT32.size))[0]
+                if page_number == 0:
+                    break
+                database_file.seek((page_number - 1) * page_size)
+                database_file.write(_read_exact(archive, page_size))
+            database_file.truncate(header['page_count'] * page_size)
+
+    def verify(self, name):
+        """
+        Restore a backup to a scratch file and check its checksum, integrity and row counts
+
+        Returns:
+            list: Problems found (empty if the backup is good); recorded in the metadata
+        """
+        entry = self.load_metadata().get(name)
+        if entry is None:
+            return [f"Unknown backup {name}"]
+        fd, scratch = tempfile.mkstemp(suffix='.db', dir=self.directory)
+        os.close(fd)
+        problems = []
+        try:
+            self.restore(name, scratch)
+            if _file_md5(scratch) != entry.get('checksum'):
+                problems.append("checksum mismatch")
+            connection = sqlite3.connect(scratch)
+            try:
+                integrity = connection.execute('PRAGMA integrity_check').fetchone()[0]
+                if integrity != 'ok':
+                    problems.append(f"integrity_check: {integrity}")
+                counts = self._row_counts(connection)
+            finally:
+                connection.close()
+            problems.extend(
+                f"{table}: {counts.get(table)} rows, expected {expected}"
+                for table, expected in (entry.get('stats') or {}).items() if counts.get(table) != expected
+            )
+        except Exception as e:
+            problems.append(str(e))
+        finally:
+            os.remove(scratch)
+
+        self._update_entry(name, validated=not problems, verified_at=datetime.utcnow().isoformat(),
+                           error='; '.join(problems) or None)
+        if problems:
+            logger.error(f"Backup {name} failed verification: {'; '.join(problems)}")
+        else:
+            logger.info(f"Backup {name} verified")
+        return problems
+
+    # Retention
+
+    def prune(self):
+        """
+        Keep at most max_count backups, deleting whole chains oldest first (the newest
+        chain is always kept); entries whose file is gone are dropped from the metadata
+
+        Returns:
+            list: Names removed
+        """
+        with self._metadata_lock:
+            metadata = self.load_metadata()
+            missing = [name for name in metadata if not os.path.exists(self._path(name))]
+            for name in missing:
+                del metadata[name]
+            # A diff whose chain lost a link cannot be restored either
+            broken = [name for name in metadata if any(link not in metadata for link in self._chain(metadata, name))]
+            for name in broken:
+                del metadata[name]
+
+            chains = {}
+            for name in sorted(metadata, key=lambda name: metadata[name].get('created', '')):
+                chains.setdefault(self._chain(metadata, name)[0], []).append(name)
+            ordered = sorted(chains.values(), key=lambda names: metadata[names[-1]].get('created', ''))
+
+            removed = []
+            total = len(metadata)
+            for names in ordered[:-1]:
+                if total <= self.max_count:
+                    break
+                for name in names:
+                    del metadata[name]
+                    self._remove_hashes(name)
+                    os.remove(self._path(name))
+                    removed.append(name)
+                total -= len(names)
+            for name in broken:
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+                self._remove_hashes(name)
+            if removed or missing or broken:
+                self._save_metadata(metadata)
+        if removed:
+            logger.info(f"Removed {len(removed)} old backups")
+        return removed
+
+    # Background work
+
+    def run_scheduled(self):
+        """Scheduler job: back up, letting the chain decide full or incremental"""
+        if self.available:
+            self.backup()
+
+    def submit(self, job):
+        """Queue ('backup', full) or ('verify', name) on this process's backup thread"""
+        self._ensure_worker()
+        self._queue.put(job)
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            return
+        with self._worker_lock:
+            if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+                return
+            self._worker = threading.Thread(target=self._work, name='database-backup', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def _work(self):
+        while True:
+            kind, argument = self._queue.get()
+            try:
+                if kind == 'backup':
+                    self.backup(full=argument)
+                else:
+                    self.verify(argument)
+            except Exception as e:
+                logger.error(f"Backup {kind} failed: {e}")
+            finally:
+                self._queue.task_done()
+
+
+# Global backup manager
+backup_manager = BackupManager()
@@ -41,15 +41,48 @@ class Config:
     
     SQLALCHEMY_DATABASE_URI = DATABASE_URL
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ECHO = os.environ.get('SQLALCHEMY_ECHO', 'False').lower() == 'true'
+    SQLALCHEMY_ECHO = os.environ.get('SQLALCHEMY_ECHO', 'False').lower() == 'true'  # Every statement; query stats below are usually enough
     
-    # Connection pool settings for production
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
-        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 3600)),
-        'pool_pre_ping': True,  # Verify connections before using
-        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20))
-    }
+    # Query statistics (per-request counts and DB time, slow-query log)
+    QUERY_STATS_ENABLED = os.environ.get('QUERY_STATS_ENABLED', 'True').lower() == 'true'
+    QUERY_STATS_HEADERS = os.environ.get('QUERY_STATS_HEADERS', 'False').lower() == 'true'  # X-Query-Count etc. (always on in debug)
+    QUERY_STATS_SLOWEST = int(os.environ.get('QUERY_STATS_SLOWEST', 5))  # Slowest statements kept per request
+    SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))  # Statements at or over this are logged
+    QUERY_COUNT_WARN = int(os.environ.get('QUERY_COUNT_WARN', 50))  # Requests issuing more are logged (N+1 loops)
+    
+    # Read replicas (comma-separated URLs); @read_only views read from one that is keeping up
+    READ_REPLICA_URLS = [
+        url.strip().replace('postgres://', 'postgresql://', 1)
+        for url in os.environ.get('READ_REPLICA_URLS', '').split(',') if url.strip()
+    ]
+    READ_REPLICA_MAX_LAG_SECONDS = float(os.environ.get('READ_REPLICA_MAX_LAG_SECONDS', 5))  # Further behind reads from the primary
+    READ_REPLICA_CHECK_SECONDS = float(os.environ.get('READ_REPLICA_CHECK_SECONDS', 5))
+    READ_REPLICA_STICKY_SECONDS = int(os.environ.get('READ_REPLICA_STICKY_SECONDS', 10))  # Primary reads after a user's own write
+    READ_REPLICA_ROUTE_GETS = os.environ.get('READ_REPLICA_ROUTE_GETS', 'False').lower() == 'true'  # Every GET, not just @read_only views
+    
+    # SQLite profile (applied by sqlite_profile when the database is SQLite)
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')  # Durable at WAL checkpoints
+    SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 16384))  # Page cache per connection
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+    SQLITE_SERIALIZE_WRITES = os.environ.get('SQLITE_SERIALIZE_WRITES', 'True').lower() == 'true'  # One writer at a time across workers
+    SQLITE_WRITER_LOCK_FILE = os.environ.get('SQLITE_WRITER_LOCK_FILE', 'instance/sqlite_writer.lock')
+    SQLITE_WRITER_TIMEOUT = float(os.environ.get('SQLITE_WRITER_TIMEOUT', 10))  # Seconds to queue before writing unqueued
+    
+    if DATABASE_URL.startswith('sqlite'):
+        # A server pool makes no sense for a file: keep the driver defaults, wait on locks instead of failing
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000}
+        }
+    else:
+        # Connection pool settings for production
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 3600)),
+            'pool_pre_ping': True,  # Verify connections before using
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20))
+        }
     
     # Session Settings
     SESSION_COOKIE_SECURE = os.environ.get('SESSION_COOKIE_SECURE', 'False').lower() == 'true'
@@ -78,11 +111,62 @@ class Config:
     # Backup Settings
     BACKUP_ENABLED = os.environ.get('BACKUP_ENABLED', 'True').lower() == 'true'
     BACKUP_INTERVAL_HOURS = int(os.environ.get('BACKUP_INTERVAL_HOURS', 6))
-    BACKUP_MAX_COUNT = int(os.environ.get('BACKUP_MAX_COUNT', 10))
+    BACKUP_MAX_COUNT = int(os.environ.get('BACKUP_MAX_COUNT', 10))  # Oldest full+incremental chains are dropped beyond this
+    BACKUP_DIR = os.environ.get('BACKUP_DIR', 'instance/backups')
+    BACKUP_COMPRESSION = os.environ.get('BACKUP_COMPRESSION', 'auto')  # auto (zstd if the zstandard package is installed, else gzip), zstd, gzip
+    BACKUP_FULL_EVERY = int(os.environ.get('BACKUP_FULL_EVERY', 7))  # Backups per chain; the rest are page diffs
+    BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 256))  # Pages copied per online-backup step
+    BACKUP_STEP_PAUSE = float(os.environ.get('BACKUP_STEP_PAUSE', 0.01))  # Seconds writers get between steps
+    BACKUP_VERIFY = os.environ.get('BACKUP_VERIFY', 'True').lower() == 'true'
     
     # Analytics Settings
     ANALYTICS_ENABLED = os.environ.get('ANALYTICS_ENABLED', 'True').lower() == 'true'
     TRACK_VISITORS = os.environ.get('TRACK_VISITORS', 'True').lower() == 'true'
+    ANALYTICS_ASYNC = os.environ.get('ANALYTICS_ASYNC', 'True').lower() == 'true'  # Buffer writes on a background thread
+    ANALYTICS_BUFFER_SIZE = int(os.environ.get('ANALYTICS_BUFFER_SIZE', 10000))  # Max queued events before the oldest are dropped
+    ANALYTICS_BATCH_SIZE = int(os.environ.get('ANALYTICS_BATCH_SIZE', 500))
+    ANALYTICS_FLUSH_INTERVAL_MS = int(os.environ.get('ANALYTICS_FLUSH_INTERVAL_MS', 500))
+    ROLLUP_INTERVAL_MINUTES = int(os.environ.get('ROLLUP_INTERVAL_MINUTES', 5))
+    ROLLUP_GRACE_SECONDS = int(os.environ.get('ROLLUP_GRACE_SECONDS', 120))  # Wait for late events before closing an hour
+    ROLLUP_HOURLY_RETENTION_DAYS = int(os.environ.get('ROLLUP_HOURLY_RETENTION_DAYS', 14))
+    ROLLUP_BACKFILL_DAYS = int(os.environ.get('ROLLUP_BACKFILL_DAYS', 90))
+    ROLLUP_GAUGE_RECOUNT_HOURS = int(os.environ.get('ROLLUP_GAUGE_RECOUNT_HOURS', 24))  # Full table recounts for the dashboard totals
+    HLL_PRECISION = int(os.environ.get('HLL_PRECISION', 14))  # 2**p registers; standard error 1.04/sqrt(2**p)
+    HLL_PERSIST_SECONDS = int(os.environ.get('HLL_PERSIST_SECONDS', 30))
+    TRAFFIC_SOURCES_FILE = os.environ.get('TRAFFIC_SOURCES_FILE')  # JSON {"social": {"mastodon": ["mastodon."]}, "search": {...}}
+    TRAFFIC_SOURCES = os.environ.get('TRAFFIC_SOURCES')  # Same shape, inline JSON
+    TRAFFIC_SOURCE_CACHE_SIZE = int(os.environ.get('TRAFFIC_SOURCE_CACHE_SIZE', 4096))
+    
+    # Background Jobs
+    SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'True').lower() == 'true'
+    SCHEDULER_LOCK_FILE = os.environ.get('SCHEDULER_LOCK_FILE', 'instance/scheduler.lock')
+    SCHEMA_LOCK_FILE = os.environ.get('SCHEMA_LOCK_FILE', 'instance/schema.lock')  # Serializes startup migrations (SQLite; PostgreSQL uses an advisory lock)
+    
+    # Spam Scoring
+    SPAM_SCORE_THRESHOLD = float(os.environ.get('SPAM_SCORE_THRESHOLD', 5.0))  # e.g. two links, or a link plus a long run of one character
+    SPAM_RESCORE_ASYNC = os.environ.get('SPAM_RESCORE_ASYNC', 'True').lower() == 'true'  # False re-scores within the admin request
+    SPAM_RESCORE_STALE_SECONDS = int(os.environ.get('SPAM_RESCORE_STALE_SECONDS', 300))  # Running job with no progress is taken over
+    
+    # Privacy
+    PRIVACY_CACHE_SIZE = int(os.environ.get('PRIVACY_CACHE_SIZE', 10000))  # Users whose decrypted settings stay cached
+    KEY_ROTATION_CHECKPOINT = os.environ.get('KEY_ROTATION_CHECKPOINT', 'instance/key_rotation.json')
+    KEY_ROTATION_BATCH_SIZE = int(os.environ.get('KEY_ROTATION_BATCH_SIZE', 2000))
+    KEY_ROTATION_WORKERS = int(os.environ.get('KEY_ROTATION_WORKERS', os.cpu_count() or 1))  # 0 rotates in-process
+    ACCOUNT_DELETION_ASYNC = os.environ.get('ACCOUNT_DELETION_ASYNC', 'True').lower() == 'true'  # False deletes within the request
+    ACCOUNT_DELETION_BATCH_SIZE = int(os.environ.get('ACCOUNT_DELETION_BATCH_SIZE', 500))  # Rows per DELETE transaction
+    ACCOUNT_DELETION_STALE_SECONDS = int(os.environ.get('ACCOUNT_DELETION_STALE_SECONDS', 300))  # Running job with no progress is taken over
+    ACCOUNT_DELETION_RESUME_MINUTES = int(os.environ.get('ACCOUNT_DELETION_RESUME_MINUTES', 5))
+    
+    # Metrics (/metrics in Prometheus text format, merged across workers)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'
+    METRICS_DIR = os.environ.get('METRICS_DIR', 'instance/metrics')  # Shared by the workers on a host; clear on deploy
+    METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))  # How stale other workers' numbers may be
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # Bearer token required by /metrics; unset, only localhost and admins are served
+    
+    # Rate Limiting
+    RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'sqlite')  # 'sqlite' (shared by workers on a host) or 'memory'
+    RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', 'instance/rate_limits.db')
+    RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
     
     # Email Settings (for future password reset feature)
     MAIL_SERVER = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
@@ -107,6 +191,27 @@ class Config:
     POEMS_PER_PAGE = int(os.environ.get('POEMS_PER_PAGE', 20))
     USERS_PER_PAGE = int(os.environ.get('USERS_PER_PAGE', 20))
     COMMENTS_PER_PAGE = int(os.environ.get('COMMENTS_PER_PAGE', 10))
+    NOTIFICATIONS_PER_PAGE = int(os.environ.get('NOTIFICATIONS_PER_PAGE', 50))
+    
+    # Search Settings
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')  # auto (FTS5/tsvector by database), like
+    SEARCH_RESULTS_LIMIT = int(os.environ.get('SEARCH_RESULTS_LIMIT', 100))  # Results per page
+    SEARCH_TITLE_BOOST = float(os.environ.get('SEARCH_TITLE_BOOST', 10.0))
+    SEARCH_AUTHOR_BOOST = float(os.environ.get('SEARCH_AUTHOR_BOOST', 4.0))
+    SEARCH_CONTENT_BOOST = float(os.environ.get('SEARCH_CONTENT_BOOST', 1.0))
+    
+    # Home Timeline Settings
+    TIMELINE_FANOUT_ASYNC = os.environ.get('TIMELINE_FANOUT_ASYNC', 'True').lower() == 'true'
+    TIMELINE_FANOUT_THRESHOLD = int(os.environ.get('TIMELINE_FANOUT_THRESHOLD', 5000))  # Followers before an author is pulled at read time
+    TIMELINE_BACKFILL_LIMIT = int(os.environ.get('TIMELINE_BACKFILL_LIMIT', 100))  # Recent poems copied on follow
+    
+    # Notification Stream Settings (Server-Sent Events)
+    NOTIFICATION_STREAM_BACKEND = os.environ.get('NOTIFICATION_STREAM_BACKEND', 'database')  # database (multi-worker), local (single process)
+    NOTIFICATION_STREAM_POLL_SECONDS = float(os.environ.get('NOTIFICATION_STREAM_POLL_SECONDS', 2.0))
+    NOTIFICATION_STREAM_HEARTBEAT = int(os.environ.get('NOTIFICATION_STREAM_HEARTBEAT', 20))
+    NOTIFICATION_STREAM_MAX_SECONDS = int(os.environ.get('NOTIFICATION_STREAM_MAX_SECONDS', 300))
+    NOTIFICATION_STREAM_RETRY_MS = int(os.environ.get('NOTIFICATION_STREAM_RETRY_MS', 5000))
+    NOTIFICATION_STREAM_MAX_OPEN = int(os.environ.get('NOTIFICATION_STREAM_MAX_OPEN', 8))  # Per process; keep well below gunicorn --threads
     
     # Content Limits
     MAX_POEM_TITLE_LENGTH = int(os.environ.get('MAX_POEM_TITLE_LENGTH', 200))
@@ -155,7 +260,7 @@ class DevelopmentConfig(Config):
     """Development-specific configuration"""
     DEBUG = True
     TESTING = False
-    SQLALCHEMY_ECHO = True  # Log all SQL queries
+    QUERY_STATS_HEADERS = True  # Query count and DB time on every response; set SQLALCHEMY_ECHO for full SQL
 
 
 class ProductionConfig(Config):
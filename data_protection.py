@@ -5,33 +5,87 @@ Encrypts sensitive data and provides privacy controls
 
 import hashlib
 import json
+import threading
+import zlib
+from collections import OrderedDict
 from datetime import datetime
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
 from flask import current_app
 from models import db, User, Poem, Comment
+from data_export import export_user_data
 import os
 
+def key_fingerprint(key):
+    """Short, non-secret identifier for an encryption key"""
+    return hashlib.sha256(key).hexdigest()[:16]
+
 class DataProtectionManager:
     """Manages encryption and protection of user data"""
     
-    def __init__(self):
-        self.encryption_key = self._get_or_create_key()
-        self.cipher = Fernet(self.encryption_key)
-    
-    def _get_or_create_key(self):
-        """Get or create encryption key"""
-        key_file = 'instance/encryption.key'
-        
-        if os.path.exists(key_file):
-            with open(key_file, 'rb') as f:
-                return f.read()
-        else:
-            # Create new key
-            key = Fernet.generate_key()
-            os.makedirs('instance', exist_ok=True)
-            with open(key_file, 'wb') as f:
-                f.write(key)
-            return key
+    def __init__(self, key_file='instance/encryption.key'):
+        self.key_file = key_file
+        self.user_backup_dir = 'instance/user_backups'
+        self._load_keys()
+        self.privacy_cache_size = 10000
+        self.privacy_cache_stats = {'hits': 0, 'misses': 0}
+        self._privacy_cache = OrderedDict()
+        self._privacy_lock = threading.Lock()
+    
+    def _load_keys(self):
+        """
+        Load the key file: one key per line, newest (primary) first
+        
+        New data is encrypted with the primary key; any listed key can decrypt, so
+        older ciphertexts keep working until rotate-encryption re-encrypts them.
+        """
+        self.keys = self._get_or_create_keys()
+        self.encryption_key = self.keys[0]
+        self.cipher = MultiFernet([Fernet(key) for key in self.keys])
+    
+    def _get_or_create_keys(self):
+        """Get or create encryption keys"""
+        if os.path.exists(self.key_file):
+            with open(self.key_file, 'rb') as f:
+                keys = [line.strip() for line in f.read().splitlines() if line.strip()]
+            if keys:
+                return keys
+        
+        # Create new key
+        key = Fernet.generate_key()
+        self._write_keys([key])
+        return [key]
+    
+    def _write_keys(self, keys):
+        # Write a sibling file and rename it so a crash never leaves a truncated key file
+        os.makedirs(os.path.dirname(self.key_file) or '.', exist_ok=True)
+        temporary = f'{self.key_file}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(b'\n'.join(keys) + b'\n')
+        os.chmod(temporary, 0o600)
+        os.replace(temporary, self.key_file)
+    
+    def add_key(self):
+        """
+        Make a new key primary, keeping the old ones for decryption
+        
+        Returns:
+            str: Fingerprint of the new primary key
+        """
+        key = Fernet.generate_key()
+        self._write_keys([key] + self.keys)
+        self._load_keys()
+        return key_fingerprint(key)
+    
+    def retire_old_keys(self):
+        """Drop every key but the primary (only once rotation has re-encrypted all data)"""
+        retired = len(self.keys) - 1
+        self._write_keys(self.keys[:1])
+        self._load_keys()
+        return retired
+    
+    def init_app(self, app):
+        """Read cache settings from the app config"""
+        self.privacy_cache_size = int(app.config.get('PRIVACY_CACHE_SIZE', 10000))
     
     def encrypt_sensitive_data(self, data):
         """Encrypt sensitive user data"""
@@ -56,6 +110,45 @@ class DataProtectionManager:
         except Exception:
             return None
     
+    def decrypt_privacy_settings(self, user_id, encrypted_settings):
+        """
+        Decrypted privacy settings, cached per user in an LRU
+        
+        Each entry is versioned by a hash of the ciphertext it came from, so a changed
+        (re-encrypted or rotated) value is a miss even in processes that never saw the
+        update. Returns a copy that callers may modify.
+        """
+        version = hashlib.blake2b(encrypted_settings.encode(), digest_size=16).digest()
+        with self._privacy_lock:
+            cached = self._privacy_cache.get(user_id)
+            if cached is not None and cached[0] == version:
+                self._privacy_cache.move_to_end(user_id)
+                self.privacy_cache_stats['hits'] += 1
+                return dict(cached[1])
+        
+        decrypted = self.decrypt_sensitive_data(encrypted_settings)
+        if not decrypted:
+            # Not cached: a key that cannot decrypt now may be fixed by a key change
+            return {}
+        settings = json.loads(decrypted)
+        with self._privacy_lock:
+            self.privacy_cache_stats['misses'] += 1
+            self._privacy_cache[user_id] = (version, settings)
+            self._privacy_cache.move_to_end(user_id)
+            while len(self._privacy_cache) > self.privacy_cache_size:
+                self._privacy_cache.popitem(last=False)
+        return dict(settings)
+    
+    def privacy_cache_info(self):
+        """Cache hits, misses and current entries"""
+        with self._privacy_lock:
+            return dict(self.privacy_cache_stats, size=len(self._privacy_cache))
+    
+    def invalidate_privacy_settings(self, user_id):
+        """Drop a user's cached settings (after they change)"""
+        with self._privacy_lock:
+            self._privacy_cache.pop(user_id, None)
+    
     def hash_user_identifier(self, identifier):
         """Create anonymous hash of user identifier"""
         salt = current_app.config.get('SECRET_KEY', 'default_salt')
@@ -98,55 +191,25 @@ class DataProtectionManager:
         return encrypted_settings
     
     def backup_user_data(self, user_id):
-        """Create encrypted backup of user's data"""
+        """
+        Create encrypted backup of user's data
+        
+        Streams the gzip NDJSON export to disk; each line of the file is a Fernet token
+        for one compressed block, so memory stays at one block however large the export.
+        """
         try:
-            user = User.query.get(user_id)
-            if not user:
+            if db.session.get(User, user_id) is None:
                 return None
             
-            # Collect all user data
-            user_poems = Poem.query.filter_by(user_id=user_id).all()
-            user_comments = Comment.query.filter_by(user_id=user_id).all()
-            
-            backup_data = {
-                'user_info': {
-                    'username': user.username,
-                    'email': user.email,
-                    'age': user.age,
-                    'favorite_poet': user.favorite_poet,
-                    'created_at': user.created_at.isoformat() if user.created_at else None
-                },
-                'poems': [
-                    {
-                        'title': poem.title,
-                        'content': poem.content,
-                        'category': poem.category,
-                        'mood': poem.mood,
-                        'theme': poem.theme,
-                        'created_at': poem.created_at.isoformat() if poem.created_at else None
-                    }
-                    for poem in user_poems
-                ],
-                'comments': [
-                    {
-                        'content': comment.content,
-                        'poem_id': comment.poem_id,
-                        'created_at': comment.created_at.isoformat() if comment.created_at else None
-                    }
-                    for comment in user_comments
-                ],
-                'backup_created': datetime.now().isoformat()
-            }
-            
-            # Encrypt the backup
-            encrypted_backup = self.encrypt_sensitive_data(backup_data)
+            backup_filename = os.path.join(self.user_backup_dir,
+                                           f"user_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.backup")
+            os.makedirs(self.user_backup_dir, exist_ok=True)
             
-            # Save to file
-            backup_filename = f"instance/user_backups/user_{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.backup"
-            os.makedirs('instance/user_backups', exist_ok=True)
-            
-            with open(backup_filename, 'w') as f:
-                f.write(encrypted_backup)
+            with open(f'{backup_filename}.tmp', 'wb') as f:
+                for block in export_user_data(user_id):
+                    if block:
+                        f.write(self.cipher.encrypt(block) + b'\n')
+            os.replace(f'{backup_filename}.tmp', backup_filename)
             
             return backup_filename
             
@@ -154,26 +217,36 @@ class DataProtectionManager:
             current_app.logger.error(f"Error creating user backup: {str(e)}")
             return None
     
+    def read_user_backup(self, backup_filename):
+        """Yield the records (dicts) of a backup written by backup_user_data"""
+        decompressor = zlib.decompressobj(31)
+        buffered = b''
+        with open(backup_filename, 'rb') as f:
+            for token in f:
+                buffered += decompressor.decompress(self.cipher.decrypt(token.strip()))
+                *lines, buffered = buffered.split(b'\n')
+                for line in lines:
+                    yield json.loads(line)
+        buffered += decompressor.flush()
+        if buffered.strip():
+            yield json.loads(buffered)
+    
     def delete_user_data(self, user_id, keep_backup=True):
-        """Safely delete user data with optional backup"""
+        """Safely delete user data with optional backup (the deletion itself runs as a background job)"""
+        from account_deletion import account_deletion
         try:
             if keep_backup:
                 backup_file = self.backup_user_data(user_id)
                 if not backup_file:
                     return False, "Failed to create backup"
             
-            # Delete user's poems
-            Poem.query.filter_by(user_id=user_id).delete()
-            
-            # Delete user's comments
-            Comment.query.filter_by(user_id=user_id).delete()
-            
-            # Delete the user
-            User.query.filter_by(id=user_id).delete()
+            user = User.query.get(user_id)
+            if not user:
+                return False, "User not found"
             
-            db.session.commit()
+            job = account_deletion.enqueue(user, requested_by=user_id)
             
-            return True, "User data deleted successfully"
+            return True, f"User data deletion started (job {job.id})"
             
         except Exception as e:
             db.session.rollback()
@@ -0,0 +1,76 @@
+"""
+Batched Feed Loading for Poetry Vault
+Loads a page of poems with authors and the viewer's like/save/follow state in a fixed number of queries
+"""
+from sqlalchemy.orm.attributes import set_committed_value
+from models import db, User, Like, SavedPoem, Follow
+
+
+class FeedPage:
+    """Poems in display order plus the viewer's state for each of them"""
+
+    def __init__(self, poems, liked_ids=None, saved_ids=None, following_ids=None):
+        self.poems = poems
+        self.liked_ids = liked_ids or set()
+        self.saved_ids = saved_ids or set()
+        self.following_ids = following_ids or set()
+
+    def __iter__(self):
+        return iter(self.poems)
+
+    def __len__(self):
+        return len(self.poems)
+
+    def to_dicts(self):
+        """Serialize poems for JSON endpoints, including viewer state"""
+        results = []
+        for poem in self.poems:
+            data = poem.to_dict()
+            data['liked'] = poem.id in self.liked_ids
+            data['saved'] = poem.id in self.saved_ids
+            data['following_author'] = not poem.is_anonymous and poem.user_id in self.following_ids
+            results.append(data)
+        return results
+
+
+class FeedLoader:
+    """
+    Batch loader for feed rendering
+
+    Every page costs the same number of queries regardless of its size:
+    poems (with authors), the viewer's likes, saves and follows - one IN query each.
+    Comment and like counts come from the denormalized counters on Poem.
+    """
+
+    def __init__(self, viewer):
+        self.viewer = viewer
+
+    def for_poems(self, poems):
+        """Attach authors and viewer state to poems that were already loaded (e.g. a keyset page)"""
+        poems = list(poems)
+        if not poems:
+            return FeedPage([])
+
+        # One IN query for all authors, attached without marking the poems dirty
+        authors = {user.id: user for user in User.query.filter(User.id.in_({poem.user_id for poem in poems}))}
+        for poem in poems:
+            set_committed_value(poem, 'author', authors.get(poem.user_id))
+        return self._with_viewer_state(poems)
+
+    def _with_viewer_state(self, poems):
+        if not self.viewer or not getattr(self.viewer, 'is_authenticated', False):
+            return FeedPage(poems)
+
+        poem_ids = [poem.id for poem in poems]
+        author_ids = {poem.user_id for poem in poems}
+
+        liked_ids = {row[0] for row in db.session.query(Like.poem_id).filter(
+            Like.user_id == self.viewer.id, Like.poem_id.in_(poem_ids)
+        )}
+        saved_ids = {row[0] for row in db.session.query(SavedPoem.poem_id).filter(
+            SavedPoem.user_id == self.viewer.id, SavedPoem.poem_id.in_(poem_ids)
+        )}
+        following_ids = {row[0] for row in db.session.query(Follow.followed_id).filter(
+            Follow.follower_id == self.viewer.id, Follow.followed_id.in_(author_ids)
+        )}
+        return FeedPage(poems, liked_ids, saved_ids, following_ids)
@@ -0,0 +1,250 @@
+"""
+HyperLogLog Unique Counting for Poetry Vault
+Per-day mergeable sketches for DAU/WAU/MAU and unique visitors in constant memory
+"""
+import hashlib
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from models import db, UserActivity, Visitor, UniqueSketch
+
+logger = logging.getLogger(__name__)
+
+
+class HyperLogLog:
+    """
+    HyperLogLog cardinality sketch (Flajolet et al.) over a 64-bit hash
+
+    With precision p there are m = 2**p one-byte registers and the relative standard
+    error is 1.04 / sqrt(m): p=14 uses 16 KiB and is accurate to about 0.81%
+    (so within ±1.6% about 95% of the time). Sketches with the same precision merge
+    losslessly by taking the register-wise maximum.
+    """
+
+    def __init__(self, precision=14, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError("HyperLogLog precision must be between 4 and 18")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers) if registers is not None else bytearray(self.m)
+        if len(self.registers) != self.m:
+            raise ValueError("Register count does not match precision")
+
+    @property
+    def error_bound(self):
+        """Relative standard error of count()"""
+        return 1.04 / math.sqrt(self.m)
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        # Position of the leftmost 1-bit in the remaining 64-p bits
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Fold another sketch into this one (union of the counted sets)"""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches with different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Estimated number of distinct values added"""
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # Small-range correction: linear counting is more accurate while registers are empty
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data, precision=14):
+        return cls(precision, zlib.decompress(data))
+
+
+class SketchStore:
+    """
+    Per-day HyperLogLog sketches persisted in unique_sketches
+
+    Each process keeps its own sketches for the days it has seen and periodically
+    merges them into its own shard row, so writers never contend. Reads merge every
+    shard for the requested days; the scheduled compaction folds old shards together.
+    """
+
+    METRICS = ('active_users', 'visitors')
+
+    def __init__(self):
+        self.precision = 14
+        self.persist_seconds = 30
+        self._sketches = {}
+        self._dirty = set()
+        self._last_persist = time.monotonic()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.precision = int(app.config.get('HLL_PRECISION', 14))
+        self.persist_seconds = int(app.config.get('HLL_PERSIST_SECONDS', 30))
+
+    @property
+    def shard(self):
+        # Merging is idempotent, so a reused pid after a restart only re-merges into its old row
+        return f'{socket.gethostname()}-{os.getpid()}'
+
+    # Writes (called from the analytics writer thread)
+
+    def add(self, metric, day, value):
+        if value is None:
+            return
+        key = (metric, day)
+        with self._lock:
+            sketch = self._sketches.get(key)
+            if sketch is None:
+                sketch = self._sketches[key] = HyperLogLog(self.precision)
+            sketch.add(value)
+            self._dirty.add(key)
+
+    def persist_due(self):
+        return bool(self._dirty) and time.monotonic() - self._last_persist >= self.persist_seconds
+
+    def persist(self, connection, force=False):
+        """Merge dirty in-memory sketches into this process's shard rows"""
+        if not force and not self.persist_due():
+            return 0
+        with self._lock:
+            dirty = [(key, HyperLogLog(self.precision, self._sketches[key].registers)) for key in self._dirty]
+            self._dirty.clear()
+            # Days other than today and yesterday will not receive more events
+            oldest = datetime.utcnow().date() - timedelta(days=1)
+            for key in [key for key in self._sketches if key[1] < oldest and key not in self._dirty]:
+                del self._sketches[key]
+        self._last_persist = time.monotonic()
+
+        table = UniqueSketch.__table__
+        for (metric, day), sketch in dirty:
+            where = db.and_(table.c.metric == metric, table.c.day == day, table.c.shard == self.shard)
+            stored = connection.execute(db.select(table.c.registers).where(where)).scalar()
+            if stored is None:
+                connection.execute(table.insert().values(
+                    metric=metric, day=day, shard=self.shard, precision=self.precision,
+                    registers=sketch.to_bytes(), updated_at=datetime.utcnow()
+                ))
+            else:
+                sketch.merge(HyperLogLog.from_bytes(stored, self.precision))
+                connection.execute(table.update().where(where).values(
+                    registers=sketch.to_bytes(), updated_at=datetime.utcnow()
+                ))
+        return len(dirty)
+
+    # Reads
+
+    def unique(self, metric, days=1, end=None, include_local=True):
+        """
+        Estimated distinct ids for `metric` over the `days` days ending on `end` (default today)
+
+        Returns:
+            int: Estimated count (relative standard error HyperLogLog.error_bound)
+        """
+        end = end or datetime.utcnow().date()
+        start = end - timedelta(days=days - 1)
+        total = HyperLogLog(self.precision)
+        rows = db.session.query(UniqueSketch.registers).filter(
+            UniqueSketch.metric == metric, UniqueSketch.day >= start, UniqueSketch.day <= end,
+            UniqueSketch.precision == self.precision
+        )
+        for (registers,) in rows:
+            total.merge(HyperLogLog.from_bytes(registers, self.precision))
+        if include_local:
+            # Events this process has counted but not persisted yet
+            with self._lock:
+                local = [sketch for (name, day), sketch in self._sketches.items() if name == metric and start <= day <= end]
+            for sketch in local:
+                total.merge(sketch)
+        return total.count()
+
+    def unique_exact(self, metric, days=1):
+        """
+        Exact distinct count for the trailing `days` days, for verifying estimates
+
+        Scans raw rows, so use it sparingly. Visitors are exact because a visitor seen
+        since the window start is exactly one whose last_visit is inside it.
+        """
+        start = datetime.combine(datetime.utcnow().date() - timedelta(days=days - 1), datetime.min.time())
+        if metric == 'active_users':
+            return db.session.query(db.func.count(db.distinct(UserActivity.user_id))).filter(
+                UserActivity.created_at >= start, UserActivity.user_id.isnot(None)
+            ).scalar()
+        return db.session.query(db.func.count(db.distinct(Visitor.visitor_key))).filter(
+            Visitor.last_visit >= start
+        ).scalar()
+
+    # Maintenance
+
+    def compact(self, before_days=2):
+        """Merge all shards of days older than `before_days` into a single row per day"""
+        cutoff = datetime.utcnow().date() - timedelta(days=before_days)
+        groups = db.session.query(UniqueSketch.metric, UniqueSketch.day).filter(
+            UniqueSketch.day < cutoff
+        ).group_by(UniqueSketch.metric, UniqueSketch.day).having(db.func.count(UniqueSketch.id) > 1).all()
+
+        table = UniqueSketch.__table__
+        for metric, day in groups:
+            merged = HyperLogLog(self.precision)
+            for (registers,) in db.session.query(UniqueSketch.registers).filter_by(metric=metric, day=day, precision=self.precision):
+                merged.merge(HyperLogLog.from_bytes(registers, self.precision))
+            db.session.execute(table.delete().where(table.c.metric == metric, table.c.day == day))
+            db.session.execute(table.insert().values(
+                metric=metric, day=day, shard='merged', precision=self.precision,
+                registers=merged.to_bytes(), updated_at=datetime.utcnow()
+            ))
+        db.session.commit()
+        return len(groups)
+
+    def backfill(self, days=30):
+        """
+        Build sketches from raw rows for metrics that have none yet (first deployment)
+
+        Overlap with sketches written meanwhile is harmless: merging counts each id once.
+        """
+        start = datetime.combine(datetime.utcnow().date() - timedelta(days=days - 1), datetime.min.time())
+        sources = (
+            ('active_users', UserActivity.created_at, UserActivity.user_id),
+            # Only the latest visit per visitor survives in the visitors table
+            ('visitors', Visitor.last_visit, Visitor.visitor_key),
+        )
+        sketches = {}
+        for metric, timestamp, identity in sources:
+            if db.session.query(UniqueSketch.id).filter_by(metric=metric).first() is not None:
+                continue
+            for moment, value in db.session.query(timestamp, identity).filter(timestamp >= start, identity.isnot(None)):
+                sketches.setdefault((metric, moment.date()), HyperLogLog(self.precision)).add(value)
+
+        if sketches:
+            db.session.execute(UniqueSketch.__table__.insert(), [
+                {'metric': metric, 'day': day, 'shard': 'backfill', 'precision': self.precision,
+                 'registers': sketch.to_bytes(), 'updated_at': datetime.utcnow()}
+                for (metric, day), sketch in sketches.items()
+            ])
+        db.session.commit()
+        return len(sketches)
+
+    def maintain(self):
+        """Scheduled job: backfill missing days once, then compact old shards"""
+        return {'backfilled': self.backfill(), 'compacted': self.compact()}
+
+
+# Global sketch store
+unique_sketches = SketchStore()
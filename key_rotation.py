@@ -0,0 +1,234 @@
+"""
+Encryption Key Rotation for Poetry Vault
+Re-encrypts stored ciphertexts and account backups under the primary key in resumable, parallel batches
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from models import db, User
+from data_protection import data_protection, key_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Columns holding Fernet tokens written by DataProtectionManager
+ENCRYPTED_COLUMNS = [
+    (User, User.privacy_settings),
+]
+
+_worker_cipher = None
+
+
+def _init_worker(keys):
+    global _worker_cipher
+    _worker_cipher = MultiFernet([Fernet(key) for key in keys])
+
+
+def _rotate_tokens(tokens, cipher=None):
+    """Re-encrypt tokens under the primary key (None for tokens no known key can decrypt)"""
+    cipher = cipher or _worker_cipher
+    rotated = []
+    for token in tokens:
+        try:
+            rotated.append(cipher.rotate(token.encode()).decode())
+        except InvalidToken:
+            rotated.append(None)
+    return rotated
+
+
+class KeyRotation:
+    """
+    Streaming re-encryption job
+
+    Rows are read in id order, batch_size at a time; each batch is decrypted and
+    re-encrypted across a process pool, then written back in one short transaction
+    whose UPDATE only matches rows still holding the token that was read - a row the
+    app changed meanwhile was already written with the primary key and is skipped.
+    The last committed id per column is checkpointed, so an interrupted run resumes
+    where it stopped (for the same primary key). Account backups written by
+    backup_user_data are then re-encrypted file by file, so retiring the old keys
+    leaves none of them unreadable.
+    """
+
+    def __init__(self):
+        self.checkpoint_path = 'instance/key_rotation.json'
+        self.batch_size = 2000
+        self.chunk_size = 250
+        self.workers = os.cpu_count() or 1
+
+    def init_app(self, app):
+        self.checkpoint_path = app.config.get('KEY_ROTATION_CHECKPOINT', 'instance/key_rotation.json')
+        self.batch_size = int(app.config.get('KEY_ROTATION_BATCH_SIZE', 2000))
+        self.workers = int(app.config.get('KEY_ROTATION_WORKERS', os.cpu_count() or 1))
+
+    # Checkpoint
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return None
+
+    def _save_checkpoint(self, state):
+        temporary = f'{self.checkpoint_path}.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(temporary, self.checkpoint_path)
+
+    def is_complete(self):
+        """True once every row has been re-encrypted under the current primary key"""
+        state = self.load_checkpoint()
+        return bool(state and state.get('completed') and state.get('primary') == key_fingerprint(data_protection.encryption_key))
+
+    # Job
+
+    def run(self, restart=False, workers=None):
+        """
+        Re-encrypt every encrypted column under the primary key
+
+        Args:
+            restart: Ignore an existing checkpoint and start from the first row
+            workers: Process pool size (0 rotates in this process)
+
+        Returns:
+            dict: rotated, skipped (changed concurrently), failed (undecryptable), seconds, rows_per_second
+        """
+        workers = self.workers if workers is None else workers
+        primary = key_fingerprint(data_protection.encryption_key)
+        state = None if restart else self.load_checkpoint()
+        if not state or state.get('primary') != primary:
+            state = {'primary': primary, 'last_ids': {}, 'rotated': 0, 'skipped': 0, 'failed': 0,
+                     'backups': 0, 'backups_failed': 0, 'completed': False}
+        elif state.get('completed'):
+            logger.info(f"Key rotation to {primary} already complete")
+            return self._summary(state, 0, 0.0)
+
+        started = time.perf_counter()
+        processed = 0
+        executor = None
+        if workers > 0:
+            executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(data_protection.keys,))
+        try:
+            for model, column in ENCRYPTED_COLUMNS:
+                name = f'{model.__tablename__}.{column.key}'
+                processed += self._rotate_column(model, column, name, state, executor, started, processed)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self._rotate_backups(state)
+
+        state['completed'] = True
+        self._save_checkpoint(state)
+        summary = self._summary(state, processed, time.perf_counter() - started)
+        logger.info(f"Key rotation to {primary} complete: {summary}")
+        return summary
+
+    def _rotate_column(self, model, column, name, state, executor, started, processed_before):
+        table = model.__table__
+        update = table.update().where(
+            table.c.id == db.bindparam('row_id'), column == db.bindparam('old_token')
+        ).values({column.key: db.bindparam('new_token')})
+        last_id = state['last_ids'].get(name, 0)
+        processed = 0
+
+        while True:
+            rows = db.session.execute(
+                db.select(table.c.id, column).where(table.c.id > last_id, column.isnot(None))
+                .order_by(table.c.id).limit(self.batch_size)
+            ).all()
+            if not rows:
+                break
+            tokens = [token for _, token in rows]
+            if executor is None:
+                rotated = _rotate_tokens(tokens, data_protection.cipher)
+            else:
+                chunks = [tokens[i:i + self.chunk_size] for i in range(0, len(tokens), self.chunk_size)]
+                rotated = [token for chunk in executor.map(_rotate_tokens, chunks) for token in chunk]
+
+            values = [
+                {'row_id': row_id, 'old_token': old, 'new_token': new}
+                for (row_id, old), new in zip(rows, rotated) if new is not None
+            ]
+            written = db.session.execute(update, values).rowcount if values else 0
+            if values and not db.session.get_bind().dialect.supports_sane_multi_rowcount:
+                written = len(values)
+            db.session.commit()
+
+            last_id = rows[-1][0]
+            processed += len(rows)
+            state['last_ids'][name] = last_id
+            state['failed'] += len(rows) - len(values)
+            state['rotated'] += written
+            state['skipped'] += len(values) - written
+            self._save_checkpoint(state)
+
+            elapsed = time.perf_counter() - started
+            logger.info(f"Key rotation {name}: through id {last_id}, "
+                        f"{(processed_before + processed) / max(elapsed, 1e-9):.0f} rows/s")
+        return processed
+
+    def stale_backups(self):
+        """Account backups that still need an old key (checked by their first token)"""
+        primary = Fernet(data_protection.encryption_key)
+        directory = data_protection.user_backup_dir
+        stale = []
+        for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            if not name.endswith('.backup'):
+                continue
+            with open(os.path.join(directory, name), 'rb') as backup_file:
+                token = backup_file.readline().strip()
+            if not token:
+                continue
+            try:
+                primary.decrypt(token)
+            except InvalidToken:
+                try:
+                    data_protection.cipher.decrypt(token)
+                    stale.append(name)
+                except InvalidToken:
+                    pass  # No key reads it; retiring changes nothing
+        return stale
+
+    def _rotate_backups(self, state):
+        # Re-encrypting an already rotated file is harmless, so an interrupted run just starts over here
+        state['backups'] = state['backups_failed'] = 0
+        directory = data_protection.user_backup_dir
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.backup'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                # One Fernet token per line; write a sibling file and swap it in once every token is rotated
+                with open(path, 'rb') as source, open(f'{path}.rotating', 'wb') as target:
+                    for token in source:
+                        target.write(data_protection.cipher.rotate(token.strip()) + b'\n')
+            except InvalidToken:
+                os.remove(f'{path}.rotating')
+                state['backups_failed'] += 1
+                logger.error(f"Key rotation: no key decrypts account backup {name}; left as is")
+                continue
+            os.replace(f'{path}.rotating', path)
+            state['backups'] += 1
+        self._save_checkpoint(state)
+
+    @staticmethod
+    def _summary(state, processed, seconds):
+        return {
+            'rotated': state['rotated'],
+            'skipped': state['skipped'],
+            'failed': state['failed'],
+            'backups': state.get('backups', 0),
+            'backups_failed': state.get('backups_failed', 0),
+            'seconds': round(seconds, 2),
+            'rows_per_second': round(processed / seconds) if seconds else 0
+        }
+
+
+# Global key rotation job
+key_rotation = KeyRotation()
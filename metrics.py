@@ -0,0 +1,427 @@
+"""
+Application Metrics for Poetry Vault
+Request latency histograms, DB and template time, and app counters in Prometheus text format
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import g, request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from models import Like, Comment, Notification
+from analytics import analytics_writer
+from data_protection import data_protection
+from notification_stream import notification_hub
+from query_stats import query_stats
+from read_replicas import replica_router
+from security_middleware import security_manager
+from source_classifier import source_classifier
+from sqlite_profile import sqlite_profile
+
+try:
+    import fcntl
+except ImportError:  # Windows - concurrent scrapes may fold a dead worker's file twice
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; fine steps up to a second so p95/p99 interpolate well
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.35, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+
+# Name -> (type, help)
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint and status'),
+    'http_request_db_seconds': ('histogram', 'Time spent in SQL per request by endpoint'),
+    'http_request_db_queries_total': ('counter', 'SQL statements issued by requests by endpoint'),
+    'template_render_seconds': ('histogram', 'Template render time by template'),
+    'likes_total': ('counter', 'Likes created'),
+    'comments_total': ('counter', 'Comments created'),
+    'notifications_created_total': ('counter', 'Notifications created by type'),
+    'visitor_events_total': ('counter', 'Visitor and activity events queued for the analytics writer by kind'),
+    'analytics_events_total': ('counter', 'Analytics writer events by outcome'),
+    'analytics_buffer_pending': ('gauge', 'Events waiting in the analytics writer buffer'),
+    'rate_limit_keys': ('gauge', 'Keys tracked by the rate limiter store'),
+    'privacy_cache_entries': ('gauge', 'Users with decrypted privacy settings cached'),
+    'privacy_cache_requests_total': ('counter', 'Privacy settings cache lookups by result'),
+    'source_cache_entries': ('gauge', 'Traffic source classifications cached'),
+    'notification_streams_open': ('gauge', 'Open notification event streams'),
+    'db_queries_total': ('counter', 'SQL statements issued, including background jobs'),
+    'db_query_seconds_total': ('counter', 'Time spent in SQL, including background jobs'),
+    'db_slow_queries_total': ('counter', 'Statements over SLOW_QUERY_MS'),
+    'db_replica_lag_seconds': ('gauge', 'Last measured replica lag'),
+    'db_replica_requests_total': ('counter', 'Read-only requests by where they read from'),
+    'sqlite_writer_wait_seconds_total': ('counter', 'Time writers spent queued for the SQLite writer lock'),
+    'sqlite_writer_timeouts_total': ('counter', 'Writers that gave up on the SQLite writer lock'),
+}
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def quantile(q, counts, buckets=BUCKETS):
+    """Estimate a quantile from per-bucket counts (last is +Inf) the way histogram_quantile does"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    for index, count in enumerate(counts):
+        if cumulative + count >= rank and count:
+            if index == len(buckets):
+                return buckets[-1]
+            lower = buckets[index - 1] if index else 0.0
+            return lower + (buckets[index] - lower) * (rank - cumulative) / count
+        cumulative += count
+    return buckets[-1]
+
+
+class Metrics:
+    """
+    In-process metrics, aggregated across gunicorn workers through a shared directory
+
+    Each worker keeps its counters and histograms in memory and writes them to
+    METRICS_DIR/metrics-<pid>.json at most every METRICS_FLUSH_SECONDS (and at exit).
+    A scrape flushes its own worker, then merges every file: counters and histograms
+    are summed over all workers, gauges over live workers only. Files left by workers
+    that have exited are folded into metrics-archive.json, so totals stay monotonic
+    across restarts while the directory stays one file per live worker. Clear the
+    directory on deploy to start from zero.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.flush_seconds = 5.0
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._last_flush = 0.0
+
+    def init_app(self, app):
+        self.enabled = bool(app.config.get('METRICS_ENABLED', True))
+        if not self.enabled:
+            return
+        self.directory = app.config.get('METRICS_DIR', 'instance/metrics')
+        self.flush_seconds = float(app.config.get('METRICS_FLUSH_SECONDS', 5))
+        os.makedirs(self.directory, exist_ok=True)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+        self._register_app_callbacks()
+        atexit.register(self.flush)
+
+    # Recording
+
+    def _check_fork(self):
+        # A forked worker starts from zero; the parent reports its own numbers
+        if self._pid != os.getpid():
+            self._counters.clear()
+            self._histograms.clear()
+            self._pid = os.getpid()
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._check_fork()
+            self._counters[(name, _labels(labels))] += amount
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            self._check_fork()
+            key = (name, _labels(labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            histogram[0][bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+
+    def register_callback(self, name, callback, label=None, mode='livesum'):
+        """
+        Sample a value at flush time
+
+        callback returns a number, or a dict of label value -> number when label is set.
+        Gauges from several workers are summed ('livesum') or, for state the workers
+        share such as the SQLite rate limit store, the largest is reported ('max').
+        """
+        self._callbacks.append((name, callback, label, mode))
+
+    def _register_app_callbacks(self):
+        writer = analytics_writer
+        self.register_callback('visitor_events_total', lambda: {'visit': writer.metrics['visits'],
+                                                                'activity': writer.metrics['activities']}, 'kind')
+        self.register_callback('analytics_events_total', lambda: {outcome: writer.metrics[outcome] for outcome in
+                                                                  ('enqueued', 'written', 'dropped', 'failed')}, 'outcome')
+        self.register_callback('analytics_buffer_pending', lambda: writer.stats()['pending'])
+        store = security_manager.rate_limiter.store
+        self.register_callback('rate_limit_keys', lambda: len(security_manager.rate_limiter.store),
+                               mode='max' if store.name == 'sqlite' else 'livesum')
+        self.register_callback('privacy_cache_entries', lambda: data_protection.privacy_cache_info()['size'])
+        self.register_callback('privacy_cache_requests_total', lambda: {
+            'hit': data_protection.privacy_cache_info()['hits'], 'miss': data_protection.privacy_cache_info()['misses']
+        }, 'result')
+        self.register_callback('source_cache_entries', lambda: source_classifier.cache_info().currsize)
+        self.register_callback('notification_streams_open', notification_hub.open_streams)
+        self.register_callback('db_queries_total', lambda: query_stats.stats()['queries'])
+        self.register_callback('db_query_seconds_total', lambda: query_stats.stats()['seconds'])
+        self.register_callback('db_slow_queries_total', lambda: query_stats.stats()['slow_queries'])
+        if replica_router.enabled:
+            self.register_callback('db_replica_lag_seconds', lambda: {
+                replica['replica']: replica['lag_seconds'] for replica in replica_router.status()
+                if replica['lag_seconds'] is not None
+            }, 'replica', mode='max')
+            self.register_callback('db_replica_requests_total', lambda: dict(replica_router.counts), 'route')
+        if sqlite_profile.writer_lock is not None:
+            self.register_callback('sqlite_writer_wait_seconds_total', lambda: sqlite_profile.stats()['writer_wait_seconds'])
+            self.register_callback('sqlite_writer_timeouts_total', lambda: sqlite_profile.stats()['writer_timeouts'])
+
+    # Request and template hooks
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+
+    def _finish_request(self, response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+        # Unmatched URLs share one label so scanners cannot grow the series count
+        endpoint = request.endpoint or 'unmatched'
+        self.observe('http_request_duration_seconds', time.perf_counter() - started,
+                     endpoint=endpoint, status=response.status_code)
+        stats = g.get('query_stats')
+        if stats:
+            self.observe('http_request_db_seconds', stats['seconds'], endpoint=endpoint)
+            self.inc('http_request_db_queries_total', stats['count'], endpoint=endpoint)
+        if time.monotonic() - self._last_flush >= self.flush_seconds:
+            self.flush()
+        return response
+
+    def _start_template(self, sender, template, context, **extra):
+        g.setdefault('metrics_templates', []).append(time.perf_counter())
+
+    def _finish_template(self, sender, template, context, **extra):
+        stack = g.get('metrics_templates')
+        if stack:
+            self.observe('template_render_seconds', time.perf_counter() - stack.pop(), template=template.name)
+
+    # Worker files
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'metrics-{pid}.json')
+
+    def _snapshot(self):
+        with self._lock:
+            self._check_fork()
+            counters = [[name, labels, value] for (name, labels), value in self._counters.items()]
+            histograms = [[name, labels, counts[:], total] for (name, labels), (counts, total) in self._histograms.items()]
+        gauges = []
+        for name, callback, label, mode in self._callbacks:
+            try:
+                value = callback()
+            except Exception as e:
+                logger.warning(f"Metric {name} unavailable: {e}")
+                continue
+            samples = value.items() if label else [(None, value)]
+            target = counters if METRICS[name][0] == 'counter' else gauges
+            for label_value, sample in samples:
+                labels = ((label, str(label_value)),) if label else ()
+                target.append([name, labels, sample, mode] if target is gauges else [name, labels, sample])
+        return {'pid': os.getpid(), 'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def flush(self):
+        """Write this worker's file"""
+        if not self.enabled:
+            return
+        self._last_flush = time.monotonic()
+        snapshot = self._snapshot()
+        path = self._path(snapshot['pid'])
+        temporary = f'{path}.tmp'
+        try:
+            with open(temporary, 'w') as metrics_file:
+                json.dump(snapshot, metrics_file)
+            os.replace(temporary, path)
+        except OSError as e:
+            logger.warning(f"Could not write metrics file {path}: {e}")
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _read(self, path):
+        try:
+            with open(path) as metrics_file:
+                return json.load(metrics_file)
+        except (OSError, ValueError):
+            return None
+
+    def collect(self):
+        """
+        Merge every worker's file
+
+        Returns:
+            dict: counters {(name, labels): value}, histograms {(name, labels): [counts, sum]},
+                  gauges {(name, labels): value}
+        """
+        self.flush()
+        gauges = {}
+        archive_path = os.path.join(self.directory, 'metrics-archive.json')
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            archive = self._read(archive_path) or {'counters': [], 'histograms': []}
+            live, folded = [], []
+            for filename in sorted(os.listdir(self.directory)):
+                if not filename.startswith('metrics-') or not filename.endswith('.json') or filename == 'metrics-archive.json':
+                    continue
+                snapshot = self._read(os.path.join(self.directory, filename))
+                if snapshot is None:
+                    continue
+                if self._alive(snapshot['pid']):
+                    live.append(snapshot)
+                else:
+                    folded.append(filename)
+                    archive['counters'].extend(snapshot['counters'])
+                    archive['histograms'].extend(snapshot['histograms'])
+            if folded:
+                # Keep the archive compact: one entry per series
+                archive = {
+                    'counters': [[name, labels, value] for (name, labels), value in self._merge_counters(archive['counters']).items()],
+                    'histograms': [[name, labels, counts, total] for (name, labels), (counts, total) in
+                                   self._merge_histograms(archive['histograms']).items()],
+                }
+                with open(f'{archive_path}.tmp', 'w') as archive_file:
+                    json.dump(archive, archive_file)
+                os.replace(f'{archive_path}.tmp', archive_path)
+                for filename in folded:
+                    try:
+                        os.remove(os.path.join(self.directory, filename))
+                    except OSError:
+                        pass
+
+        for snapshot in live:
+            for name, labels, value, mode in snapshot['gauges']:
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = max(gauges.get(key, value), value) if mode == 'max' else gauges.get(key, 0) + value
+        snapshots = [archive] + live
+        return {
+            'counters': self._merge_counters([entry for snapshot in snapshots for entry in snapshot['counters']]),
+            'histograms': self._merge_histograms([entry for snapshot in snapshots for entry in snapshot['histograms']]),
+            'gauges': gauges,
+        }
+
+    @staticmethod
+    def _merge_counters(entries):
+        merged = defaultdict(float)
+        for name, labels, value in entries:
+            merged[(name, tuple(map(tuple, labels)))] += value
+        return merged
+
+    @staticmethod
+    def _merge_histograms(entries):
+        merged = {}
+        for name, labels, counts, total in entries:
+            histogram = merged.setdefault((name, tuple(map(tuple, labels))), [[0] * (len(BUCKETS) + 1), 0.0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+            histogram[1] += total
+        return merged
+
+    # Output
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (0.0.4)"""
+        collected = self.collect()
+        series = defaultdict(list)
+        for kind in ('counters', 'gauges', 'histograms'):
+            for (name, labels), value in collected[kind].items():
+                series[name].append((labels, value))
+        lines = []
+        for name in sorted(series):
+            kind, help_text = METRICS.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(series[name]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float('inf'),), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", _format_value(bound))])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def route_latency(self):
+        """Requests, mean, p50, p95 and p99 latency (ms) per endpoint across all workers, slowest p99 first"""
+        per_endpoint = self._merge_histograms(
+            ['http_request_duration_seconds', (('endpoint', dict(labels).get('endpoint')),), counts, total]
+            for (name, labels), (counts, total) in self.collect()['histograms'].items()
+            if name == 'http_request_duration_seconds'
+        )
+        routes = []
+        for (_, labels), (counts, total) in per_endpoint.items():
+            requests = sum(counts)
+            routes.append({
+                'endpoint': labels[0][1],
+                'requests': requests,
+                'mean_ms': round(total / requests * 1000, 1),
+                **{f'p{int(q * 100)}_ms': round(quantile(q, counts) * 1000, 1) for q in (0.5, 0.95, 0.99)}
+            })
+        return sorted(routes, key=lambda route: route['p99_ms'], reverse=True)
+
+    # Sync hooks - count rows only once their transaction commits
+
+    def _count_insert(self, target, name, **labels):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('metrics_pending', []).append((name, labels))
+
+    def _after_commit(self, session):
+        for name, labels in session.info.pop('metrics_pending', ()):
+            self.inc(name, **labels)
+
+    def _after_rollback(self, session):
+        session.info.pop('metrics_pending', None)
+
+
+# Global metrics
+metrics = Metrics()
+
+event.listen(Like, 'after_insert', lambda mapper, connection, like: metrics._count_insert(like, 'likes_total'))
+event.listen(Comment, 'after_insert', lambda mapper, connection, comment: metrics._count_insert(comment, 'comments_total'))
+event.listen(Notification, 'after_insert', lambda mapper, connection, notification: metrics._count_insert(
+    notification, 'notifications_created_total', type=notification.type))
+event.listen(Session, 'after_commit', metrics._after_commit)
+event.listen(Session, 'after_rollback', metrics._after_rollback)
@@ -2,9 +2,11 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from sqlalchemy import event
 import re
+from read_replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -32,6 +34,16 @@ class User(UserMixin, db.Model):
     two_factor_enabled = db.Column(db.Boolean, default=False)
     data_sharing_consent = db.Column(db.Boolean, default=False)
     
+    # Denormalized unread notification count (maintained by Notification insert/delete events)
+    unread_notification_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Denormalized follower count (maintained by Follow insert/delete events)
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
+    __table_args__ = (
+        db.Index('idx_users_created', 'created_at'),
+        db.Index('idx_users_follower_count', 'follower_count'),
+    )
+    
     poems = db.relationship('Poem', backref='author', lazy=True)
     comments = db.relationship('Comment', backref='author', lazy=True)
     saved_poems = db.relationship('SavedPoem', backref='user', lazy=True, cascade='all, delete-orphan')
@@ -43,6 +55,89 @@ class User(UserMixin, db.Model):
     following = db.relationship('Follow', foreign_keys='Follow.follower_id', backref='follower', lazy='dynamic', cascade='all, delete-orphan')
     followers = db.relationship('Follow', foreign_keys='Follow.followed_id', backref='followed', lazy='dynamic', cascade='all, delete-orphan')
     
+    def mark_notifications_read(self):
+        """
+        Mark all of this user's notifications read with one bulk UPDATE
+        
+        The counter is decremented by the number of rows actually flipped, so a
+        notification created concurrently stays counted. Caller commits.
+        
+        Returns:
+            int: Number of notifications marked read
+        """
+        result = db.session.execute(
+            Notification.__table__.update().where(
+                Notification.__table__.c.user_id == self.id,
+                Notification.__table__.c.is_read.is_(False)
+            ).values(is_read=True)
+        )
+        marked = result.rowcount
+        if marked:
+            users = User.__table__
+            db.session.execute(
+                users.update().where(users.c.id == self.id).values(
+                    unread_notification_count=db.case(
+                        (users.c.unread_notification_count > marked, users.c.unread_notification_count - marked),
+                        else_=0
+                    )
+                )
+            )
+        return marked
+    
+    @staticmethod
+    def reconcile_unread_counts():
+        """
+        Recompute every user's unread notification counter from the notifications table
+        
+        Returns:
+            int: Number of users corrected
+        """
+        actual = dict(db.session.query(Notification.user_id, db.func.count(Notification.id)).filter(
+            Notification.is_read.is_(False)
+        ).group_by(Notification.user_id).all())
+        
+        updates = [
+            {'user_id': user_id, 'new_count': actual.get(user_id, 0)}
+            for user_id, stored in db.session.query(User.id, User.unread_notification_count).all()
+            if stored != actual.get(user_id, 0)
+        ]
+        if updates:
+            users = User.__table__
+            db.session.execute(
+                users.update().where(users.c.id == db.bindparam('user_id')).values(
+                    unread_notification_count=db.bindparam('new_count')
+                ),
+                updates
+            )
+        db.session.commit()
+        return len(updates)
+    
+    @staticmethod
+    def reconcile_follower_counts():
+        """
+        Recompute every user's follower counter from the follows table
+        
+        Returns:
+            int: Number of users corrected
+        """
+        actual = dict(db.session.query(Follow.followed_id, db.func.count(Follow.id)).group_by(Follow.followed_id).all())
+        
+        updates = [
+            {'user_id': user_id, 'new_count': actual.get(user_id, 0)}
+            for user_id, stored in db.session.query(User.id, User.follower_count).all()
+            if stored != actual.get(user_id, 0)
+        ]
+        if updates:
+            users = User.__table__
+            db.session.execute(
+                users.update().where(users.c.id == db.bindparam('user_id')).values(
+                    follower_count=db.bindparam('new_count')
+                ),
+                updates
+            )
+        db.session.commit()
+        return len(updates)
+    
     def set_password(self, password):
         """Set hashed password with validation"""
         if not password or len(password) < 6:
@@ -135,9 +230,7 @@ class User(UserMixin, db.Model):
                 }
             
             from data_protection import data_protection
-            decrypted = data_protection.decrypt_sensitive_data(self.privacy_settings)
-            import json
-            return json.loads(decrypted) if decrypted else {}
+            return data_protection.decrypt_privacy_settings(self.id, self.privacy_settings)
         except:
             return {
                 'profile_visibility': 'public',
@@ -158,6 +251,7 @@ class User(UserMixin, db.Model):
             import json
             self.privacy_settings = data_protection.encrypt_sensitive_data(settings)
             db.session.commit()
+            data_protection.invalidate_privacy_settings(self.id)
             return True
         except:
             return False
@@ -202,6 +296,20 @@ class Poem(db.Model):
     is_flagged = db.Column(db.Boolean, default=False)  # Flagged for review
     flag_reason = db.Column(db.String(500), nullable=True)  # Reason for flagging
     
+    # Denormalized counters, maintained in the same transaction as the Like/Comment/SavedPoem rows
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    save_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    spam_score = db.Column(db.Float, nullable=True)  # Set by spam_filter on insert/edit and by bulk rescoring
+    
+    __table_args__ = (
+        db.Index('idx_poems_user_created', 'user_id', 'created_at', 'id'),  # Profile pages
+        # Discovery feed: non-classic poems newest first; the predicate matches filter_by(is_classic=False)
+        db.Index('idx_poems_recent', 'created_at', 'id',
+                 sqlite_where=is_classic == db.false(), postgresql_where=is_classic == db.false()),
+        db.Index('idx_poems_created', 'created_at'),  # Rollup time ranges
+    )
+    
     comments = db.relationship('Comment', backref='poem', lazy=True, cascade='all, delete-orphan')
     saved_by = db.relationship('SavedPoem', backref='poem', lazy=True, cascade='all, delete-orphan')
     likes = db.relationship('Like', backref='poem', lazy=True, cascade='all, delete-orphan')
@@ -228,11 +336,57 @@ class Poem(db.Model):
     
     def get_like_count(self):
         """Get number of likes"""
-        return Like.query.filter_by(poem_id=self.id).count()
+        return self.like_count or 0
     
     def get_comment_count(self):
         """Get number of comments"""
-        return Comment.query.filter_by(poem_id=self.id).count()
+        return self.comment_count or 0
+    
+    def get_save_count(self):
+        """Get number of saves"""
+        return self.save_count or 0
+    
+    @staticmethod
+    def reconcile_counters():
+        """
+        Recompute like/comment/save counters for every poem
+        
+        One GROUP BY pass per child table, then a bulk UPDATE of only the poems whose
+        stored counters drifted (e.g. after bulk deletes that bypass ORM events).
+        
+        Returns:
+            int: Number of poems corrected
+        """
+        actual = {}
+        for counter, model in (('like_count', Like), ('comment_count', Comment), ('save_count', SavedPoem)):
+            rows = db.session.query(model.poem_id, db.func.count(model.id)).group_by(model.poem_id).all()
+            for poem_id, count in rows:
+                actual.setdefault(poem_id, {})[counter] = count
+        
+        updates = []
+        stored = db.session.query(Poem.id, Poem.like_count, Poem.comment_count, Poem.save_count).all()
+        for poem_id, like_count, comment_count, save_count in stored:
+            counts = actual.get(poem_id, {})
+            correct = {
+                'like_count': counts.get('like_count', 0),
+                'comment_count': counts.get('comment_count', 0),
+                'save_count': counts.get('save_count', 0)
+            }
+            if (like_count, comment_count, save_count) != (correct['like_count'], correct['comment_count'], correct['save_count']):
+                updates.append({'poem_id': poem_id, **{f'new_{key}': value for key, value in correct.items()}})
+        
+        if updates:
+            poems = Poem.__table__
+            db.session.execute(
+                poems.update().where(poems.c.id == db.bindparam('poem_id')).values(
+                    like_count=db.bindparam('new_like_count'),
+                    comment_count=db.bindparam('new_comment_count'),
+                    save_count=db.bindparam('new_save_count')
+                ),
+                updates
+            )
+        db.session.commit()
+        return len(updates)
     
     def is_liked_by(self, user):
         """Check if user has liked this poem"""
@@ -248,6 +402,22 @@ class Poem(db.Model):
             return "Anonymous"
         return self.author.username if self.author else "Unknown"
     
+    def to_dict(self, preview_length=300):
+        """Serialize for JSON feed endpoints"""
+        return {
+            'id': self.id,
+            'title': self.title,
+            'content': self.content[:preview_length] if preview_length else self.content,
+            'category': self.category,
+            'mood': self.mood,
+            'theme': self.theme,
+            'author': self.get_author_display_name(),
+            'author_id': None if self.is_anonymous else self.user_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'like_count': self.get_like_count(),
+            'comment_count': self.get_comment_count()
+        }
+    
     def __repr__(self):
         return f'<Poem {self.title}>'
 
@@ -264,6 +434,13 @@ class Comment(db.Model):
     is_protected = db.Column(db.Boolean, default=False)  # User-protected content
     is_flagged = db.Column(db.Boolean, default=False)  # Flagged for review
     flag_reason = db.Column(db.String(500), nullable=True)  # Reason for flagging
+    spam_score = db.Column(db.Float, nullable=True)  # Set by spam_filter on insert/edit and by bulk rescoring
+    
+    __table_args__ = (
+        db.Index('idx_comments_poem_created', 'poem_id', 'created_at', 'id'),
+        db.Index('idx_comments_user', 'user_id'),
+        db.Index('idx_comments_created', 'created_at'),
+    )
     
     @staticmethod
     def validate_content(content):
@@ -285,7 +462,10 @@ class SavedPoem(db.Model):
     poem_id = db.Column(db.Integer, db.ForeignKey('poems.id'), nullable=False)
     saved_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    __table_args__ = (db.UniqueConstraint('user_id', 'poem_id', name='unique_user_poem'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'poem_id', name='unique_user_poem'),
+        db.Index('idx_saved_poems_poem', 'poem_id'),
+    )
 
 class Like(db.Model):
     __tablename__ = 'likes'
@@ -295,7 +475,11 @@ class Like(db.Model):
     poem_id = db.Column(db.Integer, db.ForeignKey('poems.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    __table_args__ = (db.UniqueConstraint('user_id', 'poem_id', name='unique_user_poem_like'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'poem_id', name='unique_user_poem_like'),
+        db.Index('idx_likes_poem', 'poem_id'),
+        db.Index('idx_likes_created', 'created_at'),
+    )
 
 class Notification(db.Model):
     __tablename__ = 'notifications'
@@ -308,9 +492,17 @@ class Notification(db.Model):
     is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('idx_notifications_user_created', 'user_id', 'created_at', 'id'),
+        # Unread per user; the predicate matches filter_by(is_read=False)
+        db.Index('idx_notifications_unread', 'user_id', 'created_at',
+                 sqlite_where=is_read == db.false(), postgresql_where=is_read == db.false()),
+        db.Index('idx_notifications_poem', 'poem_id'),
+    )
+    
     @staticmethod
     def create_notification(user_id, notif_type, message, poem_id=None):
-        """Factory method to create notifications safely"""
+        """Factory method to create notifications safely (the recipient's unread counter is bumped on insert)"""
         try:
             if not user_id or not notif_type or not message:
                 return None
@@ -326,6 +518,17 @@ class Notification(db.Model):
             print(f"Error creating notification: {e}")
             return None
     
+    def to_dict(self):
+        """Serialize for JSON notification endpoints"""
+        return {
+            'id': self.id,
+            'type': self.type,
+            'message': self.message,
+            'poem_id': self.poem_id,
+            'is_read': bool(self.is_read),
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+    
     def __repr__(self):
         return f'<Notification {self.type} for User {self.user_id}>'
 
@@ -337,7 +540,24 @@ class Follow(db.Model):
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)  # User being followed
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    __table_args__ = (db.UniqueConstraint('follower_id', 'followed_id', name='unique_follow'),)
+    __table_args__ = (
+        db.UniqueConstraint('follower_id', 'followed_id', name='unique_follow'),
+        db.Index('idx_follows_followed', 'followed_id', 'follower_id'),
+    )
+
+class TimelineEntry(db.Model):
+    """Materialized home feed row: poem `poem_id` appears in the timeline of `user_id`"""
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)  # Timeline owner
+    poem_id = db.Column(db.Integer, db.ForeignKey('poems.id', ondelete='CASCADE'), primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)  # Copy of the poem's created_at (feed sort key)
+
+    __table_args__ = (
+        db.Index('idx_timeline_user_created', 'user_id', 'created_at', 'poem_id'),
+        db.Index('idx_timeline_author', 'author_id', 'user_id'),
+    )
 
 class Highlight(db.Model):
     __tablename__ = 'highlights'
@@ -347,6 +567,8 @@ class Highlight(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (db.Index('idx_highlights_user', 'user_id'),)
+    
     poems = db.relationship('HighlightPoem', backref='highlight', lazy=True, cascade='all, delete-orphan')
 
 class HighlightPoem(db.Model):
@@ -357,7 +579,10 @@ class HighlightPoem(db.Model):
     poem_id = db.Column(db.Integer, db.ForeignKey('poems.id'), nullable=False)
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    __table_args__ = (db.UniqueConstraint('highlight_id', 'poem_id', name='unique_highlight_poem'),)
+    __table_args__ = (
+        db.UniqueConstraint('highlight_id', 'poem_id', name='unique_highlight_poem'),
+        db.Index('idx_highlight_poems_poem', 'poem_id'),
+    )
 
 class UserActivity(db.Model):
     __tablename__ = 'user_activities'
@@ -371,6 +596,11 @@ class UserActivity(db.Model):
     referrer = db.Column(db.String(255), nullable=True)  # Where they came from (Instagram, direct, etc.)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('idx_user_activities_created', 'created_at'),
+        db.Index('idx_user_activities_user', 'user_id', 'created_at'),
+    )
+    
     # Relationship to User
     user = db.relationship('User', backref='activities', foreign_keys=[user_id])
 
@@ -386,6 +616,40 @@ class Visitor(db.Model):
     first_visit = db.Column(db.DateTime, default=datetime.utcnow)
     last_visit = db.Column(db.DateTime, default=datetime.utcnow)
     visit_count = db.Column(db.Integer, default=1)
+    visitor_key = db.Column(db.String(64), nullable=True)  # Salted hash of the IP - upsert conflict target
+    
+    __table_args__ = (
+        db.Index('uq_visitors_visitor_key', 'visitor_key', unique=True),
+        db.Index('idx_visitors_last_visit', 'last_visit'),
+        db.Index('idx_visitors_first_visit', 'first_visit'),
+    )
+
+class AnalyticsRollup(db.Model):
+    """Pre-aggregated analytics: per-hour/per-day counters and periodic gauge snapshots"""
+    __tablename__ = 'analytics_rollups'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(10), nullable=False)  # 'hour', 'day' or 'gauge'
+    bucket_start = db.Column(db.DateTime, nullable=False)  # Bucket start (gauges: time of the snapshot)
+    metric = db.Column(db.String(50), nullable=False)  # 'activity', 'new_users', 'visitors_by_source', ...
+    dimension = db.Column(db.String(100), nullable=False, default='')  # Activity type, source, or ''
+    value = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (db.UniqueConstraint('period', 'bucket_start', 'metric', 'dimension', name='unique_rollup_bucket'),)
+
+class UniqueSketch(db.Model):
+    """Per-day HyperLogLog registers for unique counts, one row per writer process (shard)"""
+    __tablename__ = 'unique_sketches'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(50), nullable=False)  # 'active_users' or 'visitors'
+    day = db.Column(db.Date, nullable=False)
+    shard = db.Column(db.String(100), nullable=False)  # host-pid of the writer, 'merged' or 'backfill'
+    precision = db.Column(db.Integer, nullable=False, default=14)
+    registers = db.Column(db.LargeBinary, nullable=False)  # zlib-compressed register bytes
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.UniqueConstraint('metric', 'day', 'shard', name='unique_sketch_shard'),)
 
 class Collection(db.Model):
     __tablename__ = 'collections'
@@ -397,6 +661,8 @@ class Collection(db.Model):
     is_private = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (db.Index('idx_collections_user', 'user_id'),)
+    
     poems = db.relationship('CollectionPoem', backref='collection', lazy=True, cascade='all, delete-orphan')
     user = db.relationship('User', backref='collections')
 
@@ -409,7 +675,10 @@ class CollectionPoem(db.Model):
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     poem = db.relationship('Poem')
-    __table_args__ = (db.UniqueConstraint('collection_id', 'poem_id', name='unique_collection_poem'),)
+    __table_args__ = (
+        db.UniqueConstraint('collection_id', 'poem_id', name='unique_collection_poem'),
+        db.Index('idx_collection_poems_poem', 'poem_id'),
+    )
 
 class UserAnalytics(db.Model):
     __tablename__ = 'user_analytics'
@@ -423,5 +692,116 @@ class UserAnalytics(db.Model):
     most_popular_poem_id = db.Column(db.Integer, db.ForeignKey('poems.id'), nullable=True)
     last_updated = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (db.Index('idx_user_analytics_user', 'user_id'),)
+    
     user = db.relationship('User', backref='analytics')
     most_popular_poem = db.relationship('Poem')
+
+class DeletionJob(db.Model):
+    """Queued account deletion, processed in batches by account_deletion"""
+    __tablename__ = 'deletion_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)  # No foreign key - the user row is the last thing deleted
+    username = db.Column(db.String(80), nullable=False)
+    requested_by = db.Column(db.Integer, nullable=True)  # Admin id, or the user themselves
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    step = db.Column(db.String(30), nullable=True)  # Current (or failed) step
+    rows_deleted = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # Heartbeat while running
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'username': self.username,
+            'status': self.status,
+            'step': self.step,
+            'rows_deleted': self.rows_deleted,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class SpamRescoreJob(db.Model):
+    """Queued re-score of every poem and comment, processed in batches by spam_filter"""
+    __tablename__ = 'spam_rescore_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    requested_by = db.Column(db.Integer, nullable=True)  # Admin id
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    step = db.Column(db.String(30), nullable=True)  # Table being scored
+    last_id = db.Column(db.Integer, nullable=False, default=0)  # Last row scored in that table; a restart continues after it
+    total = db.Column(db.Integer, nullable=False, default=0)  # Poems and comments when the job was queued
+    scored = db.Column(db.Integer, nullable=False, default=0)
+    flagged = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # Heartbeat while running
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'step': self.step,
+            'total': self.total,
+            'scored': self.scored,
+            'flagged': self.flagged,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+# Denormalized counter maintenance - runs inside the flush, so counters commit atomically
+# with the row that changed them (including ORM cascades when a user or poem is deleted)
+COUNTER_COLUMNS = {Like: 'like_count', Comment: 'comment_count', SavedPoem: 'save_count'}
+
+
+def _adjust_poem_counter(connection, model, poem_id, delta):
+    column = getattr(Poem.__table__.c, COUNTER_COLUMNS[model])
+    connection.execute(
+        Poem.__table__.update().where(Poem.__table__.c.id == poem_id).values({column: column + delta})
+    )
+
+
+for _model in COUNTER_COLUMNS:
+    event.listen(_model, 'after_insert',
+                 lambda mapper, connection, target: _adjust_poem_counter(connection, mapper.class_, target.poem_id, 1))
+    event.listen(_model, 'after_delete',
+                 lambda mapper, connection, target: _adjust_poem_counter(connection, mapper.class_, target.poem_id, -1))
+
+
+# Unread notification counter on users - same flush-time maintenance as the poem counters
+def _adjust_unread_count(connection, user_id, delta):
+    users = User.__table__
+    connection.execute(
+        users.update().where(users.c.id == user_id).values(
+            unread_notification_count=users.c.unread_notification_count + delta
+        )
+    )
+
+
+event.listen(Notification, 'after_insert',
+             lambda mapper, connection, target: not target.is_read and _adjust_unread_count(connection, target.user_id, 1))
+event.listen(Notification, 'after_delete',
+             lambda mapper, connection, target: not target.is_read and _adjust_unread_count(connection, target.user_id, -1))
+
+
+# Follower counter on users - registered before timeline's Follow hooks, which read it
+def _adjust_follower_count(connection, user_id, delta):
+    users = User.__table__
+    connection.execute(
+        users.update().where(users.c.id == user_id).values(follower_count=users.c.follower_count + delta)
+    )
+
+
+event.listen(Follow, 'after_insert',
+             lambda mapper, connection, target: _adjust_follower_count(connection, target.followed_id, 1))
+event.listen(Follow, 'after_delete',
+             lambda mapper, connection, target: _adjust_follower_count(connection, target.followed_id, -1))
@@ -0,0 +1,254 @@
+"""
+Notification Streaming for Poetry Vault
+Server-Sent Events hub that pushes new notifications to open tabs
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+from models import db, Notification
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBackend:
+    """Single-process delivery - committed notifications go straight to the local hub"""
+
+    name = 'local'
+    publishes_locally = True
+
+    def start(self, hub):
+        pass
+
+
+class DatabasePollBackend:
+    """
+    Cross-worker delivery using the notifications table as the message log
+
+    One poller thread per process reads rows with id > last seen and hands them to the
+    local hub. It only runs while this process has open streams, so idle cost is zero
+    and busy cost is one indexed query per interval per process (not per tab).
+    """
+
+    name = 'database'
+    publishes_locally = False
+
+    def __init__(self, interval=2.0, batch_size=500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_id = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self, hub):
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            if self.last_id is None:
+                # Start from the current tail; older rows reach clients through their backlog
+                with db.engine.connect() as connection:
+                    self.last_id = connection.execute(select(db.func.max(Notification.id))).scalar() or 0
+            self._thread = threading.Thread(target=self._poll, args=(hub,), name='notification-poller', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _poll(self, hub):
+        while True:
+            hub.wait_for_subscribers()
+            try:
+                with hub.app.app_context():
+                    with db.engine.connect() as connection:
+                        rows = connection.execute(
+                            select(Notification.__table__).where(Notification.id > self.last_id)
+                            .order_by(Notification.id).limit(self.batch_size)
+                        ).mappings().all()
+                for row in rows:
+                    self.last_id = row['id']
+                    hub.dispatch(row['user_id'], serialize(row))
+            except Exception as e:
+                logger.error(f"Notification poller error: {e}")
+            time.sleep(self.interval)
+
+
+STREAM_FIELDS = ('id', 'type', 'message', 'poem_id', 'created_at')
+
+
+def serialize(row):
+    """Notification (ORM object or row mapping) as the JSON payload sent to clients"""
+    if not hasattr(row, 'keys'):
+        row = {field: getattr(row, field) for field in STREAM_FIELDS}
+    payload = {field: row[field] for field in STREAM_FIELDS}
+    if payload['created_at'] is not None:
+        payload['created_at'] = payload['created_at'].isoformat()
+    return payload
+
+
+class NotificationHub:
+    """In-process pub/sub: one bounded queue per open stream, grouped by user"""
+
+    BACKENDS = {
+        'local': LocalBackend,
+        'database': DatabasePollBackend
+    }
+
+    def __init__(self):
+        self.app = None
+        self.backend = LocalBackend()
+        self.heartbeat = 20
+        self.max_duration = 300
+        self.retry_ms = 5000
+        self.queue_size = 100
+        self.max_open = 8
+        self._open = 0
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._has_subscribers = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.heartbeat = int(app.config.get('NOTIFICATION_STREAM_HEARTBEAT', 20))
+        self.max_duration = int(app.config.get('NOTIFICATION_STREAM_MAX_SECONDS', 300))
+        self.retry_ms = int(app.config.get('NOTIFICATION_STREAM_RETRY_MS', 5000))
+        self.max_open = int(app.config.get('NOTIFICATION_STREAM_MAX_OPEN', 8))
+        backend_name = app.config.get('NOTIFICATION_STREAM_BACKEND', 'database')
+        if backend_name == 'database':
+            self.backend = DatabasePollBackend(float(app.config.get('NOTIFICATION_STREAM_POLL_SECONDS', 2.0)))
+        else:
+            self.backend = self.BACKENDS.get(backend_name, LocalBackend)()
+        logger.info(f"Notification stream backend: {self.backend.name}")
+
+    # Stream slots - every open stream holds a request thread for up to max_duration
+
+    def reserve(self):
+        """Claim a stream slot in this process; False when max_open streams are already open"""
+        with self._lock:
+            if self._open >= self.max_open:
+                return False
+            self._open += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._open -= 1
+
+    # Subscriptions
+
+    def subscribe(self, user_id):
+        """Register a stream for a user and return its queue"""
+        subscription = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            self._has_subscribers.set()
+        self.backend.start(self)
+        return subscription
+
+    def unsubscribe(self, user_id, subscription):
+        with self._lock:
+            streams = self._subscribers.get(user_id)
+            if streams is not None:
+                streams.discard(subscription)
+                if not streams:
+                    del self._subscribers[user_id]
+            if not self._subscribers:
+                self._has_subscribers.clear()
+
+    def open_streams(self):
+        """Streams currently open in this process"""
+        with self._lock:
+            return sum(len(streams) for streams in self._subscribers.values())
+
+    def wait_for_subscribers(self):
+        self._has_subscribers.wait()
+
+    def dispatch(self, user_id, payload):
+        """Deliver a payload to every open stream of a user in this process"""
+        with self._lock:
+            streams = list(self._subscribers.get(user_id, ()))
+        for subscription in streams:
+            try:
+                subscription.put_nowait(payload)
+            except queue.Full:
+                # A stalled client drops its oldest event rather than blocking publishers
+                try:
+                    subscription.get_nowait()
+                    subscription.put_nowait(payload)
+                except (queue.Empty, queue.Full):
+                    pass
+
+    # Streaming
+
+    @staticmethod
+    def format_event(payload):
+        return f"id: {payload['id']}\nevent: notification\ndata: {json.dumps(payload)}\n\n"
+
+    def format_refusal(self):
+        """Frames for a client over the stream cap: poll, and try streaming again after max_duration"""
+        # EventSource cannot read the headers of a refused response, so the delay travels in the body
+        return f"retry: {self.max_duration * 1000}\nevent: busy\ndata: {json.dumps({'retry_after': self.max_duration})}\n\n"
+
+    def stream(self, user_id, load_backlog=None):
+        """
+        Generator of SSE frames for one client
+
+        Subscribes first, then sends missed notifications from `load_backlog()`, then
+        live ones, with a comment line as heartbeat. Closes after max_duration so the
+        client reconnects (with Last-Event-ID) and long-lived connections spread
+        across workers.
+        """
+        subscription = self.subscribe(user_id)
+        last_id = 0
+        try:
+            backlog = load_backlog() if load_backlog else []
+            yield f"retry: {self.retry_ms}\nevent: ready\ndata: {{}}\n\n"
+            for payload in backlog:
+                last_id = max(last_id, payload['id'])
+                yield self.format_event(payload)
+
+            deadline = time.monotonic() + self.max_duration
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    payload = subscription.get(timeout=min(self.heartbeat, remaining))
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                if payload['id'] <= last_id:
+                    continue
+                last_id = payload['id']
+                yield self.format_event(payload)
+        finally:
+            self.unsubscribe(user_id, subscription)
+
+    # Sync hooks - publish only after the notification is committed
+
+    def _after_notification_insert(self, mapper, connection, notification):
+        session = object_session(notification)
+        if session is not None and self.backend.publishes_locally:
+            session.info.setdefault('notifications_pending', []).append(
+                (notification.user_id, serialize(notification))
+            )
+
+    def _after_commit(self, session):
+        for user_id, payload in session.info.pop('notifications_pending', ()):
+            self.dispatch(user_id, payload)
+
+    def _after_rollback(self, session):
+        session.info.pop('notifications_pending', None)
+
+
+# Global notification hub
+notification_hub = NotificationHub()
+
+event.listen(Notification, 'after_insert', notification_hub._after_notification_insert)
+event.listen(Session, 'after_commit', notification_hub._after_commit)
+event.listen(Session, 'after_rollback', notification_hub._after_rollback)
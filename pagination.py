@@ -0,0 +1,118 @@
+"""
+Keyset (cursor) Pagination for Poetry Vault
+Seeks past the last row seen instead of OFFSET, so deep pages cost the same as page 1
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import request, url_for
+from models import db
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client sends a cursor that cannot be decoded"""
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row of a page as an opaque URL-safe token"""
+    payload = []
+    for value in values:
+        if isinstance(value, datetime):
+            payload.append({'dt': value.isoformat()})
+        else:
+            payload.append(value)
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Decode a cursor produced by encode_cursor into a list of `size` key values"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(payload, list) or len(payload) != size:
+            raise InvalidCursor('Cursor does not match this listing')
+        values = []
+        for value in payload:
+            if isinstance(value, dict):
+                values.append(datetime.fromisoformat(value['dt']))
+            elif value is None or isinstance(value, (int, float, str)):
+                values.append(value)
+            else:
+                raise InvalidCursor('Unsupported cursor value')
+        return values
+    except InvalidCursor:
+        raise
+    except (binascii.Error, ValueError, KeyError, TypeError) as e:
+        raise InvalidCursor(f'Malformed cursor: {e}')
+
+
+class KeysetPage:
+    """One page of results plus the cursor for the next page"""
+
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_more(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_paginate(query, columns, cursor=None, per_page=20, descending=True, key=None):
+    """
+    Fetch one page of `query` ordered by `columns` (e.g. created_at, id)
+
+    Args:
+        query: SQLAlchemy query without ORDER BY/LIMIT
+        columns: Sort key columns; the last one must be unique (usually the primary key)
+        cursor: Opaque cursor from a previous page, or None for the first page
+        per_page: Page size
+        descending: Newest-first when True
+        key: Optional function returning the sort key values of a result row
+             (defaults to reading each column's attribute from the row)
+
+    Returns:
+        KeysetPage
+
+    Raises:
+        InvalidCursor: If the cursor is malformed
+    """
+    if cursor:
+        values = decode_cursor(cursor, len(columns))
+        row_key = db.tuple_(*columns)
+        bound = db.tuple_(*[db.literal(value, column.type) for column, value in zip(columns, values)])
+        query = query.filter(row_key < bound if descending else row_key > bound)
+
+    ordering = [column.desc() if descending else column.asc() for column in columns]
+    # Fetch one extra row to learn whether another page exists
+    rows = query.order_by(*ordering).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        if key is None:
+            values = [getattr(last, column.key) for column in columns]
+        else:
+            values = key(last)
+        next_cursor = encode_cursor(values)
+
+    return KeysetPage(rows, next_cursor)
+
+
+def next_page_url(page):
+    """URL of the current view with the page's next cursor, keeping other query args"""
+    if not page.has_more:
+        return None
+    args = request.args.to_dict()
+    args['cursor'] = page.next_cursor
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
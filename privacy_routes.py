@@ -3,11 +3,13 @@ Privacy and security routes for Poetry Vault
 Provides user privacy controls and data management
 """
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
-from flask_login import login_required, current_user
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
+from flask_login import login_required, current_user, logout_user
 from models import db, User, Poem, Comment
 from security_middleware import security_manager, require_permission, protect_user_data
 from data_protection import data_protection, get_user_data_summary
+from data_export import export_user_data
+from datetime import datetime
 import json
 
 privacy_bp = Blueprint('privacy', __name__)
@@ -69,20 +71,14 @@ def update_privacy_settings():
 @login_required
 @require_permission('download_data')
 def download_data():
-    """Allow user to download their data"""
-    try:
-        backup_file = data_protection.backup_user_data(current_user.id)
-        
-        if backup_file:
-            security_manager.log_security_event('data_download', current_user.id)
-            flash('Your data backup has been created. Check your downloads.', 'success')
-        else:
-            flash('Error creating data backup', 'error')
-            
-    except Exception as e:
-        flash('Error downloading data', 'error')
-    
-    return redirect(url_for('privacy.privacy_dashboard'))
+    """Stream the user's data as a gzip-compressed NDJSON download"""
+    security_manager.log_security_event('data_download', current_user.id)
+    filename = f"poetry-vault-{current_user.username}-{datetime.utcnow().strftime('%Y%m%d')}.ndjson.gz"
+    response = Response(stream_with_context(export_user_data(current_user.id)), mimetype='application/gzip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @privacy_bp.route('/delete-account', methods=['GET', 'POST'])
 @login_required
@@ -112,7 +108,8 @@ def delete_account():
             
             if success:
                 security_manager.log_security_event('account_deleted', current_user.id)
-                flash('Your account has been deleted successfully', 'success')
+                logout_user()
+                flash('Your account is being deleted', 'success')
                 return redirect(url_for('index'))
             else:
                 flash(f'Error deleting account: {message}', 'error')
@@ -0,0 +1,148 @@
+"""
+SQL Query Statistics for Poetry Vault
+Per-request query counts and DB time, plus a structured slow-query log
+"""
+import heapq
+import json
+import logging
+import re
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def redact(parameters, executemany=False):
+    """Parameter shapes without values (types only), safe to log"""
+    if executemany:
+        return f'{len(parameters)} rows'
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class QueryStats:
+    """
+    Cursor-level timing for every engine (primary and replicas)
+
+    Each request keeps its query count, total DB time and the slowest statements
+    (parameters redacted). In development these come back as X-Query-Count,
+    X-Query-Time-Ms and Server-Timing headers; everywhere, a request issuing more than
+    QUERY_COUNT_WARN statements - the signature of an N+1 loop in a template - is
+    logged with its slowest queries, and any statement over SLOW_QUERY_MS is logged
+    as a JSON record.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_ms = 200.0
+        self.keep_slowest = 5
+        self.count_warn = 50
+        self.headers = False
+        self.statement_chars = 500
+        self.queries = 0
+        self.seconds = 0.0
+        self.slow_queries = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = bool(app.config.get('QUERY_STATS_ENABLED', True))
+        self.slow_ms = float(app.config.get('SLOW_QUERY_MS', 200))
+        self.keep_slowest = int(app.config.get('QUERY_STATS_SLOWEST', 5))
+        self.count_warn = int(app.config.get('QUERY_COUNT_WARN', 50))
+        self.headers = bool(app.config.get('QUERY_STATS_HEADERS', False)) or app.debug
+        if not self.enabled:
+            return
+        if not event.contains(Engine, 'before_cursor_execute', self._before_execute):
+            event.listen(Engine, 'before_cursor_execute', self._before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        app.after_request(self._finish_request)
+
+    # Engine hooks
+
+    def _before_execute(self, connection, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+
+    def _after_execute(self, connection, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_query_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.queries += 1
+            self.seconds += elapsed
+
+        statement = None
+        in_request = has_request_context()
+        if in_request:
+            stats = g.get('query_stats')
+            if stats is None:
+                stats = g.query_stats = {'count': 0, 'seconds': 0.0, 'slowest': []}
+            stats['count'] += 1
+            stats['seconds'] += elapsed
+            slowest = stats['slowest']
+            if len(slowest) < self.keep_slowest or elapsed > slowest[0][0]:
+                statement = self._statement(context.statement)
+                entry = (elapsed, stats['count'], statement, redact(parameters, executemany))
+                if len(slowest) < self.keep_slowest:
+                    heapq.heappush(slowest, entry)
+                else:
+                    heapq.heapreplace(slowest, entry)
+
+        if elapsed * 1000 >= self.slow_ms:
+            with self._lock:
+                self.slow_queries += 1
+            logger.warning("Slow query: " + json.dumps({
+                'ms': round(elapsed * 1000, 1),
+                'statement': statement or self._statement(context.statement),
+                'parameters': redact(parameters, executemany),
+                'database': connection.engine.url.database if connection.engine.url.get_backend_name() == 'sqlite'
+                else connection.engine.url.host,
+                'endpoint': request.endpoint if in_request else None,
+                'method': request.method if in_request else None,
+            }, default=str))
+
+    def _statement(self, statement):
+        return _WHITESPACE.sub(' ', statement).strip()[:self.statement_chars]
+
+    # Request hook
+
+    def _finish_request(self, response):
+        stats = g.get('query_stats')
+        count = stats['count'] if stats else 0
+        milliseconds = stats['seconds'] * 1000 if stats else 0.0
+        if self.headers:
+            response.headers['X-Query-Count'] = str(count)
+            response.headers['X-Query-Time-Ms'] = f'{milliseconds:.1f}'
+            response.headers['Server-Timing'] = f'db;dur={milliseconds:.1f};desc="{count} queries"'
+        if count > self.count_warn:
+            logger.warning(f"{request.method} {request.path} ({request.endpoint}) issued {count} queries "
+                           f"in {milliseconds:.1f}ms; slowest: {json.dumps(self.slowest(), default=str)}")
+        return response
+
+    def slowest(self):
+        """The current request's slowest statements, slowest first"""
+        stats = g.get('query_stats')
+        if not stats:
+            return []
+        return [
+            {'ms': round(elapsed * 1000, 1), 'position': position, 'statement': statement, 'parameters': parameters}
+            for elapsed, position, statement, parameters in sorted(stats['slowest'], reverse=True)
+        ]
+
+    def stats(self):
+        """Process-wide totals since start"""
+        with self._lock:
+            return {'queries': self.queries, 'seconds': round(self.seconds, 3), 'slow_queries': self.slow_queries}
+
+
+# Global query statistics
+query_stats = QueryStats()
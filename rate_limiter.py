@@ -0,0 +1,182 @@
+"""
+Rate Limiting for Poetry Vault
+Sliding-window counters with a bounded in-process store or a SQLite store shared by workers
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def sliding_window(state, limit, window, now):
+    """
+    Apply one hit to a sliding-window counter
+
+    The window is approximated from two fixed buckets: the previous bucket's count,
+    weighted by how much of it still overlaps the sliding window, plus the current
+    bucket's count. State is three integers per key, so checks are O(1).
+
+    Args:
+        state: (bucket, current, previous) or None for a new key
+        limit: Hits allowed per window
+        window: Window length in seconds
+        now: Current time in seconds
+
+    Returns:
+        tuple: (allowed, new_state, expires_at)
+    """
+    bucket = int(now // window)
+    stored_bucket, current, previous = state or (bucket, 0, 0)
+    if stored_bucket != bucket:
+        previous = current if stored_bucket == bucket - 1 else 0
+        current = 0
+    weight = 1.0 - (now % window) / window
+    allowed = previous * weight + current < limit
+    if allowed:
+        current += 1
+    # Once two buckets have passed the counts no longer matter
+    return allowed, (bucket, current, previous), (bucket + 2) * window
+
+
+class MemoryStore:
+    """Per-process store: an LRU-ordered dict with TTL eviction and a fixed key ceiling"""
+
+    name = 'memory'
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window, now):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            state = entry[0] if entry is not None and entry[1] > now else None
+            allowed, state, expires_at = sliding_window(state, limit, window, now)
+            self._entries[key] = (state, expires_at)
+            self._evict(now)
+            return allowed
+
+    def _evict(self, now):
+        # Least recently used keys sit at the front; drop expired ones and anything over the ceiling
+        while self._entries:
+            oldest_key, (_, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_keys:
+                break
+            del self._entries[oldest_key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStore:
+    """
+    Store shared by every worker on the host, in its own SQLite file (a local stand-in for Redis)
+
+    Each check is one short write transaction on an indexed primary key. Expired rows
+    are pruned every `prune_every` checks, which also trims the table back to max_keys by
+    dropping the keys that expire soonest.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS rate_limits ('
+        ' key TEXT PRIMARY KEY, bucket INTEGER NOT NULL, current INTEGER NOT NULL,'
+        ' previous INTEGER NOT NULL, expires_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS idx_rate_limits_expires ON rate_limits (expires_at)'
+    )
+
+    def __init__(self, path, max_keys=100000, prune_every=1000):
+        self.path = path
+        self.max_keys = max_keys
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._checks = 0
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    def _connect(self):
+        # sqlite3 connections belong to one thread and must not cross a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def hit(self, key, limit, window, now):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT bucket, current, previous, expires_at FROM rate_limits WHERE key = ?', (key,)
+            ).fetchone()
+            state = row[:3] if row is not None and row[3] > now else None
+            allowed, (bucket, current, previous), expires_at = sliding_window(state, limit, window, now)
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limits (key, bucket, current, previous, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (key, bucket, current, previous, expires_at)
+            )
+            self._checks += 1
+            if self._checks % self.prune_every == 0:
+                self._prune(connection, now)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return allowed
+
+    def _prune(self, connection, now):
+        connection.execute('DELETE FROM rate_limits WHERE expires_at <= ?', (now,))
+        excess = connection.execute('SELECT COUNT(*) FROM rate_limits').fetchone()[0] - self.max_keys
+        if excess > 0:
+            connection.execute(
+                'DELETE FROM rate_limits WHERE key IN (SELECT key FROM rate_limits ORDER BY expires_at LIMIT ?)',
+                (excess,)
+            )
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM rate_limits').fetchone()[0]
+
+
+class RateLimiter:
+    """Sliding-window rate limiter over a pluggable store"""
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else MemoryStore()
+
+    def init_app(self, app):
+        """Pick the store from RATE_LIMIT_STORE ('sqlite' shares limits across workers)"""
+        max_keys = int(app.config.get('RATE_LIMIT_MAX_KEYS', 100000))
+        if app.config.get('RATE_LIMIT_STORE', 'sqlite') == 'sqlite':
+            path = app.config.get('RATE_LIMIT_DB', 'instance/rate_limits.db')
+            try:
+                self.store = SQLiteStore(path, max_keys)
+            except sqlite3.Error as e:
+                logger.error(f"Rate limit store {path} unavailable, limiting per process: {e}")
+                self.store = MemoryStore(max_keys)
+        else:
+            self.store = MemoryStore(max_keys)
+        logger.info(f"Rate limit store: {self.store.name}")
+
+    def hit(self, key, limit, window_seconds):
+        """
+        Count one attempt for `key` if it is within the limit
+
+        Returns:
+            bool: True if allowed, False if `limit` attempts were already made in the window
+        """
+        try:
+            return self.store.hit(key, limit, window_seconds, time.time())
+        except sqlite3.Error as e:
+            # Fail open: a locked or broken store must not block users from posting
+            logger.error(f"Rate limit check failed for {key}: {e}")
+            return True
@@ -0,0 +1,162 @@
+"""
+Read Replica Routing for Poetry Vault
+Sends the SELECTs of read-only views to a replica that is keeping up, everything else to the primary
+"""
+import logging
+import random
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, text
+
+logger = logging.getLogger(__name__)
+
+# Seconds behind the primary; 0 when the replica has replayed everything it received
+POSTGRES_LAG_SQL = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_KEY = 'db_primary_until'
+
+
+def read_only(view):
+    """Mark a view as safe to serve from a read replica (place directly under @app.route)"""
+    view.read_only = True
+    return view
+
+
+class RoutingSession(Session):
+    """
+    Session that reads from the request's replica, if one was chosen
+
+    Only SELECTs are routed. Flushes and DML always go to the primary, and once a
+    request has written, its later reads go to the primary too so it sees its own rows.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or getattr(clause, 'is_dml', False):
+                g.db_wrote = True
+            elif getattr(clause, 'is_select', False) and not g.get('db_wrote'):
+                replica = g.get('db_replica')
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    Per-request replica choice with lag checks and read-your-writes stickiness
+
+    Views marked @read_only (or every GET, with READ_REPLICA_ROUTE_GETS) read from a
+    random replica whose last measured lag is within READ_REPLICA_MAX_LAG_SECONDS;
+    replicas that are behind or unreachable are skipped until the next check, and with
+    none left the request stays on the primary. A user whose request wrote anything is
+    pinned to the primary for READ_REPLICA_STICKY_SECONDS through their session cookie,
+    so the page after their own POST never shows the replica's older state.
+    """
+
+    def __init__(self):
+        self.replicas = []
+        self.max_lag = 5.0
+        self.check_seconds = 5.0
+        self.sticky_seconds = 10
+        self.route_gets = False
+        self.counts = {'replica': 0, 'primary_sticky': 0, 'primary_fallback': 0}
+        self._check_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_lag = float(app.config.get('READ_REPLICA_MAX_LAG_SECONDS', 5))
+        self.check_seconds = float(app.config.get('READ_REPLICA_CHECK_SECONDS', 5))
+        self.sticky_seconds = int(app.config.get('READ_REPLICA_STICKY_SECONDS', 10))
+        self.route_gets = bool(app.config.get('READ_REPLICA_ROUTE_GETS', False))
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        # Replicas are named by position: the name ends up in metric labels, the URL must not
+        self.replicas = [
+            {'name': f'replica-{index}', 'engine': create_engine(url, **options),
+             'lag': None, 'healthy': False, 'checked_at': 0.0}
+            for index, url in enumerate(app.config.get('READ_REPLICA_URLS', []))
+        ]
+        if not self.replicas:
+            return
+        app.before_request(self._route_request)
+        app.after_request(self._remember_writes)
+        for replica in self.replicas:
+            logger.info(f"Read replica {replica['name']}: {replica['engine'].url.render_as_string(hide_password=True)}")
+        logger.info(f"Routing read-only views across {len(self.replicas)} replica(s)")
+
+    @property
+    def enabled(self):
+        return bool(self.replicas)
+
+    # Replica health
+
+    def _measure_lag(self, engine):
+        with engine.connect() as connection:
+            if engine.dialect.name == 'postgresql':
+                return float(connection.execute(POSTGRES_LAG_SQL).scalar())
+            # Stand-ins without replication (e.g. a SQLite copy) only prove they answer
+            connection.execute(text('SELECT 1'))
+            return 0.0
+
+    def check(self, force=False):
+        """Refresh replica lag if the last check is older than check_seconds (one thread at a time)"""
+        now = time.monotonic()
+        if not force and all(now - replica['checked_at'] < self.check_seconds for replica in self.replicas):
+            return
+        # Other threads keep using the last known state while one checks
+        if not self._check_lock.acquire(blocking=force):
+            return
+        try:
+            for replica in self.replicas:
+                if not force and now - replica['checked_at'] < self.check_seconds:
+                    continue
+                try:
+                    replica['lag'] = self._measure_lag(replica['engine'])
+                    replica['healthy'] = replica['lag'] <= self.max_lag
+                    if not replica['healthy']:
+                        logger.warning(f"Replica {replica['name']} is {replica['lag']:.1f}s behind; reading from the primary")
+                except Exception as e:
+                    replica['lag'], replica['healthy'] = None, False
+                    logger.warning(f"Replica {replica['name']} unavailable: {e}")
+                replica['checked_at'] = time.monotonic()
+        finally:
+            self._check_lock.release()
+
+    def choose(self):
+        """A replica engine within the lag limit, or None for the primary"""
+        self.check()
+        healthy = [replica['engine'] for replica in self.replicas if replica['healthy']]
+        return random.choice(healthy) if healthy else None
+
+    def status(self):
+        return [{
+            'replica': replica['name'],
+            'healthy': replica['healthy'],
+            'lag_seconds': replica['lag'],
+        } for replica in self.replicas]
+
+    # Request hooks
+
+    def _route_request(self):
+        view = current_app.view_functions.get(request.endpoint)
+        if not (getattr(view, 'read_only', False) or (self.route_gets and request.method in SAFE_METHODS)):
+            return
+        if session.get(STICKY_KEY, 0) > time.time():
+            self.counts['primary_sticky'] += 1
+            return
+        g.db_replica = self.choose()
+        self.counts['replica' if g.db_replica is not None else 'primary_fallback'] += 1
+
+    def _remember_writes(self, response):
+        if g.get('db_wrote') or request.method not in SAFE_METHODS:
+            session[STICKY_KEY] = time.time() + self.sticky_seconds
+        return response
+
+
+# Global replica router
+replica_router = ReplicaRouter()
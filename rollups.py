@@ -0,0 +1,324 @@
+"""
+Analytics Rollups for Poetry Vault
+Hourly and daily pre-aggregates so dashboards read O(days) rows instead of scanning raw events
+"""
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+
+from models import db, User, Poem, Comment, Like, UserActivity, Visitor, AnalyticsRollup
+
+logger = logging.getLogger(__name__)
+
+HOUR = timedelta(hours=1)
+DAY = timedelta(days=1)
+
+# Marker counter written for every rolled hour (even empty ones); a day with 24 is complete
+HOURS_METRIC = 'rollup_hours'
+
+
+def hour_start(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(moment):
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+EMPTY = db.literal_column("''")
+
+
+def hour_bucket(column):
+    """SQL expression truncating a timestamp column to its hour"""
+    # Inline constants, not bind parameters: GROUP BY must repeat the select expression exactly
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return db.func.date_trunc(db.literal_column("'hour'"), column)
+    if dialect == 'mysql':
+        return db.func.date_format(column, db.literal_column("'%Y-%m-%d %H:00:00'"))
+    return db.func.strftime(db.literal_column("'%Y-%m-%d %H:00:00'"), column)
+
+
+def parse_bucket(value):
+    # SQLite and MySQL return the truncated hour as text
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S') if isinstance(value, str) else value
+
+
+class AnalyticsRollups:
+    """
+    Incrementally maintained analytics aggregates
+
+    Counters (events per bucket) are rolled per hour once the hour is complete, then
+    summed into daily rows. Reads combine daily rows, hourly rows for days not yet
+    rolled, and a short raw tail since the last rolled hour.
+
+    Gauges (current totals) are recounted in full at most once per gauge_recount
+    interval. In between, a gauge is its last snapshot plus the rows created since
+    (an index range per table), and total_visits is kept current by the analytics
+    writer adding each batch of visits to the snapshot. Deletions show up at the next
+    recount.
+    """
+
+    # Counter metric -> (timestamp column, dimension column or None)
+    COUNTERS = {
+        'activity': (UserActivity.created_at, UserActivity.activity_type),
+        'new_visitors': (Visitor.first_visit, Visitor.source),
+        'new_users': (User.created_at, None),
+        'new_poems': (Poem.created_at, None),
+        'new_comments': (Comment.created_at, None),
+        'new_likes': (Like.created_at, None),
+    }
+
+    # Gauge metric -> (aggregate, dimension column or None)
+    GAUGES = {
+        'total_users': (db.func.count(User.id), None),
+        'total_poems': (db.func.count(Poem.id), None),
+        'total_comments': (db.func.count(Comment.id), None),
+        'total_visitors': (db.func.count(Visitor.id), None),
+        'total_visits': (db.func.coalesce(db.func.sum(Visitor.visit_count), 0), None),
+        'visitors_by_source': (db.func.count(Visitor.id), Visitor.source),
+    }
+
+    # Gauge -> counter whose raw tail brings the snapshot up to date
+    GAUGE_TAILS = {
+        'total_users': 'new_users',
+        'total_poems': 'new_poems',
+        'total_comments': 'new_comments',
+        'total_visitors': 'new_visitors',
+        'visitors_by_source': 'new_visitors',
+    }
+
+    def __init__(self):
+        self.grace = timedelta(minutes=2)
+        self.hourly_retention = timedelta(days=14)
+        self.backfill_days = 90
+        self.gauge_recount = DAY
+
+    def init_app(self, app):
+        self.grace = timedelta(seconds=int(app.config.get('ROLLUP_GRACE_SECONDS', 120)))
+        self.hourly_retention = timedelta(days=int(app.config.get('ROLLUP_HOURLY_RETENTION_DAYS', 14)))
+        self.backfill_days = int(app.config.get('ROLLUP_BACKFILL_DAYS', 90))
+        self.gauge_recount = timedelta(hours=int(app.config.get('ROLLUP_GAUGE_RECOUNT_HOURS', 24)))
+
+    # Maintenance
+
+    def run(self, now=None):
+        """
+        Roll every complete hour and day not yet aggregated, and recount gauges when due
+
+        Idempotent: each range is deleted before it is rewritten, so a crashed or
+        concurrent run only repeats work.
+
+        Returns:
+            dict: Number of hours and days rolled
+        """
+        now = now or datetime.utcnow()
+        hours = self._roll_hours(hour_start(now - self.grace))
+        days = self._roll_days()
+        self._snapshot_gauges(now)
+        self._prune(now)
+        db.session.commit()
+        return {'hours': hours, 'days': days}
+
+    def _hourly_watermark(self):
+        """Start of the first hour that has not been rolled yet (None if nothing has)"""
+        latest = db.session.query(db.func.max(AnalyticsRollup.bucket_start)).filter(
+            AnalyticsRollup.period == 'hour', AnalyticsRollup.metric == HOURS_METRIC
+        ).scalar()
+        if latest is not None:
+            return latest + HOUR
+        latest_day = self._daily_watermark()
+        return latest_day
+
+    def _daily_watermark(self):
+        """Start of the first day that has not been rolled yet (None if nothing has)"""
+        latest = db.session.query(db.func.max(AnalyticsRollup.bucket_start)).filter(
+            AnalyticsRollup.period == 'day'
+        ).scalar()
+        return latest + DAY if latest is not None else None
+
+    def _roll_hours(self, end):
+        start = self._hourly_watermark() or day_start(end - timedelta(days=self.backfill_days))
+        if start >= end:
+            return 0
+
+        rows = Counter()
+        for metric, (timestamp, dimension) in self.COUNTERS.items():
+            # One grouped range query per metric: a row per (hour, dimension), not per event
+            truncated = hour_bucket(timestamp)
+            label = db.func.coalesce(dimension, EMPTY) if dimension is not None else EMPTY
+            result = db.session.execute(
+                db.select(truncated, label, db.func.count()).where(timestamp >= start, timestamp < end).group_by(truncated, label)
+            )
+            for hour, dimension_value, count in result:
+                rows[(parse_bucket(hour), metric, dimension_value)] += count
+
+        bucket = start
+        while bucket < end:
+            rows[(bucket, HOURS_METRIC, '')] = 1
+            bucket += HOUR
+
+        self._replace('hour', start, end, rows)
+        return int((end - start) / HOUR)
+
+    def _roll_days(self):
+        hourly_end = self._hourly_watermark()
+        if hourly_end is None:
+            return 0
+        end = day_start(hourly_end)
+        start = self._daily_watermark()
+        if start is None:
+            first_hour = db.session.query(db.func.min(AnalyticsRollup.bucket_start)).filter(
+                AnalyticsRollup.period == 'hour'
+            ).scalar()
+            start = day_start(first_hour)
+        if start >= end:
+            return 0
+
+        rows = Counter()
+        hourly = db.session.query(
+            AnalyticsRollup.bucket_start, AnalyticsRollup.metric, AnalyticsRollup.dimension, AnalyticsRollup.value
+        ).filter(
+            AnalyticsRollup.period == 'hour', AnalyticsRollup.bucket_start >= start, AnalyticsRollup.bucket_start < end
+        )
+        for bucket, metric, dimension, value in hourly:
+            rows[(day_start(bucket), metric, dimension)] += value
+
+        self._replace('day', start, end, rows)
+        return (end - start).days
+
+    def _replace(self, period, start, end, rows):
+        table = AnalyticsRollup.__table__
+        db.session.execute(table.delete().where(
+            table.c.period == period, table.c.bucket_start >= start, table.c.bucket_start < end
+        ))
+        if rows:
+            db.session.execute(table.insert(), [
+                {'period': period, 'bucket_start': bucket, 'metric': metric, 'dimension': dimension, 'value': value}
+                for (bucket, metric, dimension), value in rows.items()
+            ])
+
+    def _gauge_taken_at(self):
+        return db.session.query(db.func.max(AnalyticsRollup.bucket_start)).filter(
+            AnalyticsRollup.period == 'gauge'
+        ).scalar()
+
+    def _snapshot_gauges(self, now):
+        taken_at = self._gauge_taken_at()
+        if taken_at is not None and now - taken_at < self.gauge_recount:
+            return
+        values = []
+        for metric, (aggregate, dimension) in self.GAUGES.items():
+            if dimension is None:
+                values.append({'metric': metric, 'dimension': '', 'value': db.session.execute(db.select(aggregate)).scalar() or 0})
+                continue
+            grouped = Counter()
+            for key, value in db.session.execute(db.select(dimension, aggregate).group_by(dimension)):
+                grouped[key or ''] += value
+            values.extend({'metric': metric, 'dimension': key, 'value': value} for key, value in grouped.items())
+        db.session.execute(AnalyticsRollup.__table__.insert(), [
+            dict(value, period='gauge', bucket_start=now) for value in values
+        ])
+
+    def _prune(self, now):
+        table = AnalyticsRollup.__table__
+        # Gauges are only read at their latest snapshot
+        taken_at = self._gauge_taken_at()
+        if taken_at is not None:
+            db.session.execute(table.delete().where(table.c.period == 'gauge', table.c.bucket_start < taken_at))
+        # Hourly rows are kept for recent charts; older ones live on in the daily rows
+        daily_end = self._daily_watermark()
+        if daily_end is not None:
+            cutoff = min(daily_end, day_start(now - self.hourly_retention))
+            db.session.execute(table.delete().where(table.c.period == 'hour', table.c.bucket_start < cutoff))
+
+    # Reads
+
+    def totals(self, metric, since):
+        """
+        Counter totals by dimension from the start of `since`'s day until now
+
+        Returns:
+            Counter: dimension -> count ('' for metrics without a dimension)
+        """
+        since = day_start(since)
+        daily_end = self._daily_watermark()
+        hourly_end = self._hourly_watermark()
+        result = Counter()
+
+        ranges = []
+        if daily_end is not None and daily_end > since:
+            ranges.append(('day', since, daily_end))
+        if hourly_end is not None:
+            hour_from = max(since, daily_end) if daily_end is not None else since
+            if hourly_end > hour_from:
+                ranges.append(('hour', hour_from, hourly_end))
+        for period, start, end in ranges:
+            rows = db.session.query(AnalyticsRollup.dimension, db.func.sum(AnalyticsRollup.value)).filter(
+                AnalyticsRollup.period == period, AnalyticsRollup.metric == metric,
+                AnalyticsRollup.bucket_start >= start, AnalyticsRollup.bucket_start < end
+            ).group_by(AnalyticsRollup.dimension)
+            for dimension, value in rows:
+                result[dimension] += int(value or 0)
+
+        tail_from = max(since, hourly_end) if hourly_end is not None else since
+        result.update(self._raw_counts(metric, tail_from))
+        return result
+
+    def _raw_counts(self, metric, since):
+        """Live counts for events at or after `since` (the short unrolled tail)"""
+        timestamp, dimension = self.COUNTERS[metric]
+        if dimension is None:
+            return Counter({'': db.session.query(db.func.count()).select_from(timestamp.class_).filter(timestamp >= since).scalar()})
+        rows = db.session.query(dimension, db.func.count()).select_from(timestamp.class_).filter(
+            timestamp >= since
+        ).group_by(dimension)
+        counts = Counter()
+        for key, count in rows:
+            counts[key or ''] += count
+        return counts
+
+    def gauge(self, metric):
+        """
+        Current value of a gauge: latest snapshot plus rows created since it
+
+        Returns:
+            Counter: dimension -> value ('' for metrics without a dimension)
+        """
+        taken_at = self._gauge_taken_at()
+        if taken_at is None:
+            # Nothing rolled yet - compute live
+            aggregate, dimension = self.GAUGES[metric]
+            if dimension is None:
+                return Counter({'': db.session.execute(db.select(aggregate)).scalar() or 0})
+            values = Counter()
+            for key, value in db.session.execute(db.select(dimension, aggregate).group_by(dimension)):
+                values[key or ''] += value
+            return values
+
+        values = Counter({dimension: value for dimension, value in db.session.query(
+            AnalyticsRollup.dimension, AnalyticsRollup.value
+        ).filter(
+            AnalyticsRollup.period == 'gauge', AnalyticsRollup.bucket_start == taken_at, AnalyticsRollup.metric == metric
+        )})
+        tail = self.GAUGE_TAILS.get(metric)
+        if tail:
+            counts = self._raw_counts(tail, taken_at)
+            if self.GAUGES[metric][1] is None:
+                # e.g. total_visitors from new_visitors, which is split by source
+                values[''] += sum(counts.values())
+            else:
+                values.update(counts)
+        return values
+
+    def count_visits(self, connection, visits):
+        """Add a written batch of visits to the latest total_visits snapshot (in the writer's transaction)"""
+        table = AnalyticsRollup.__table__
+        latest = db.select(db.func.max(table.c.bucket_start)).where(table.c.period == 'gauge').scalar_subquery()
+        connection.execute(table.update().where(
+            table.c.period == 'gauge', table.c.metric == 'total_visits', table.c.bucket_start == latest
+        ).values(value=table.c.value + visits))
+
+
+# Global analytics rollups
+analytics_rollups = AnalyticsRollups()
@@ -0,0 +1,93 @@
+"""
+Background Job Scheduler for Poetry Vault
+Runs periodic maintenance jobs in one process per host, elected with a file lock
+"""
+import logging
+import os
+import threading
+import time
+
+import schedule
+
+try:
+    import fcntl
+except ImportError:  # Windows - every process runs the jobs
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class JobScheduler:
+    """
+    Periodic jobs on a daemon thread
+
+    Every gunicorn worker starts the thread, but only the one holding the lock file
+    runs jobs; the others retry the lock so a replacement takes over if the leader exits.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.scheduler = schedule.Scheduler()
+        self.lock_path = None
+        self.poll_seconds = 30
+        self._lock_file = None
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.lock_path = app.config.get('SCHEDULER_LOCK_FILE', 'instance/scheduler.lock')
+        self.poll_seconds = int(app.config.get('SCHEDULER_POLL_SECONDS', 30))
+
+    def every(self, minutes, job, name=None):
+        """Register `job` (called inside an app context) to run every `minutes`"""
+        name = name or job.__name__
+        self.scheduler.every(minutes).minutes.do(self._run_job, name, job).tag(name)
+
+    def start(self):
+        """Start the scheduler thread in this process (no-op if already running)"""
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._thread = threading.Thread(target=self._loop, name='job-scheduler', daemon=True)
+        self._pid = os.getpid()
+        self._thread.start()
+
+    def _acquire_leadership(self):
+        if fcntl is None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        logger.info(f"Job scheduler leader: pid {os.getpid()}")
+        return True
+
+    def _loop(self):
+        leader = False
+        while True:
+            try:
+                if not leader and self._acquire_leadership():
+                    leader = True
+                    # Catch up on anything missed while no process was leader
+                    self.scheduler.run_all()
+                elif leader:
+                    self.scheduler.run_pending()
+            except Exception as e:
+                logger.error(f"Job scheduler error: {e}")
+            time.sleep(min(self.poll_seconds, max(self.scheduler.idle_seconds or self.poll_seconds, 1)))
+
+    def _run_job(self, name, job):
+        started = time.perf_counter()
+        try:
+            with self.app.app_context():
+                result = job()
+            logger.info(f"Job {name} finished in {time.perf_counter() - started:.2f}s: {result}")
+        except Exception as e:
+            logger.error(f"Job {name} failed: {e}")
+
+
+# Global job scheduler
+job_scheduler = JobScheduler()
@@ -0,0 +1,268 @@
+"""
+Schema Maintenance for Poetry Vault
+Adds columns and indexes introduced after a database was first created (db.create_all never alters tables)
+"""
+import logging
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex
+from models import db, User, Poem, Comment, Like, SavedPoem, Notification, Follow, UserActivity, Visitor
+
+try:
+    import fcntl
+except ImportError:  # Windows - migrations are not serialized across processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key shared by every process migrating the same database
+MIGRATION_LOCK_KEY = 0x706F656D
+
+# (table, column, DDL type and default) - the DDL must be valid for both SQLite and PostgreSQL
+MANAGED_COLUMNS = [
+    ('poems', 'like_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('poems', 'comment_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('poems', 'save_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('users', 'unread_notification_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('visitors', 'visitor_key', 'VARCHAR(64)'),
+    ('poems', 'spam_score', 'FLOAT'),
+    ('comments', 'spam_score', 'FLOAT'),
+    ('users', 'follower_count', 'INTEGER NOT NULL DEFAULT 0'),
+]
+
+# (table, index name, CREATE INDEX statement) - created after the columns above exist
+MANAGED_INDEXES = [
+    ('visitors', 'uq_visitors_visitor_key', 'CREATE UNIQUE INDEX IF NOT EXISTS uq_visitors_visitor_key ON visitors (visitor_key)'),
+]
+
+
+@contextmanager
+def migration_lock(lock_path='instance/schema.lock'):
+    """
+    Let one process at a time migrate the schema
+
+    Every gunicorn worker runs the startup migrations; the others wait here and then
+    find nothing left to do. PostgreSQL takes a session advisory lock, so workers on
+    other hosts wait too; SQLite locks a file next to the database.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            try:
+                yield
+            finally:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        return
+    if fcntl is None or not lock_path:
+        yield
+        return
+    os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def ensure_schema():
+    """
+    Add any managed columns and indexes missing from existing tables
+    
+    Run it inside migration_lock(); the DDL is idempotent either way (IF NOT EXISTS on
+    PostgreSQL, a duplicate column on SQLite is skipped).
+    
+    Returns:
+        list: Names ('table.column') of the columns that were added
+    """
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    if_not_exists = 'IF NOT EXISTS ' if db.engine.dialect.name == 'postgresql' else ''
+    existing = {}
+    added = []
+    
+    for table, column, ddl in MANAGED_COLUMNS:
+        if table not in tables:
+            continue
+        if table not in existing:
+            existing[table] = {col['name'] for col in inspector.get_columns(table)}
+        if column in existing[table]:
+            continue
+        
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {if_not_exists}{column} {ddl}'))
+        except OperationalError as e:
+            # SQLite has no ADD COLUMN IF NOT EXISTS; another process got there first
+            if 'duplicate column' not in str(e):
+                raise
+            existing[table].add(column)
+            continue
+        existing[table].add(column)
+        added.append(f'{table}.{column}')
+        logger.info(f"Added column {table}.{column}")
+    
+    for table, index, ddl in MANAGED_INDEXES:
+        if table not in tables:
+            continue
+        if index in {idx['name'] for idx in inspector.get_indexes(table)}:
+            continue
+        with db.engine.begin() as connection:
+            connection.execute(text(ddl))
+        logger.info(f"Created index {index} on {table}")
+    
+    return added
+
+
+# Indexes left behind by a CREATE INDEX CONCURRENTLY that failed or was cancelled; PostgreSQL
+# keeps updating them on every write but never uses them for reads
+POSTGRES_INVALID_INDEXES_SQL = text(
+    "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+    "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE NOT i.indisvalid AND n.nspname = current_schema()"
+)
+
+
+def ensure_model_indexes():
+    """
+    Create indexes declared in the models' __table_args__ that an existing database lacks
+    
+    A deploy step (`flask create-indexes`), not part of startup: on a large table the
+    build takes minutes. DDL comes from SQLAlchemy, so partial-index predicates render
+    for the dialect. On PostgreSQL the index is built CONCURRENTLY (outside a
+    transaction) so writes are not blocked while it builds, and an index an earlier
+    build left invalid is dropped and built again.
+    
+    Returns:
+        dict: Names of the indexes 'created' and 'rebuilt'
+    """
+    dialect = db.engine.dialect
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    invalid = set()
+    if dialect.name == 'postgresql':
+        with db.engine.connect() as connection:
+            invalid = set(connection.execute(POSTGRES_INVALID_INDEXES_SQL).scalars())
+    
+    result = {'created': [], 'rebuilt': []}
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {idx['name'] for idx in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing and index.name not in invalid:
+                continue
+            ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect))
+            if dialect.name == 'postgresql':
+                ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1).replace(
+                    'CREATE UNIQUE INDEX', 'CREATE UNIQUE INDEX CONCURRENTLY', 1)
+                with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    if index.name in invalid:
+                        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}'))
+                    connection.execute(text(ddl))
+            else:
+                with db.engine.begin() as connection:
+                    connection.execute(text(ddl))
+            result['rebuilt' if index.name in invalid else 'created'].append(index.name)
+            logger.info(f"{'Rebuilt invalid' if index.name in invalid else 'Created'} index {index.name} on {table.name}")
+    
+    if result['created'] or result['rebuilt']:
+        with db.engine.begin() as connection:
+            connection.execute(text('ANALYZE'))
+    return result
+
+
+# Hot query -> statement built like the route that runs it; check_query_plans() requires each
+# to be answered from an index
+HOT_QUERIES = {
+    'discovery feed': lambda: Poem.query.filter_by(is_classic=False).order_by(
+        Poem.created_at.desc(), Poem.id.desc()).limit(21).statement,
+    'profile poems': lambda: Poem.query.filter_by(user_id=1, is_classic=False).order_by(
+        Poem.created_at.desc(), Poem.id.desc()).limit(21).statement,
+    'poem comments': lambda: Comment.query.filter_by(poem_id=1).order_by(
+        Comment.created_at.desc(), Comment.id.desc()).statement,
+    'poem likers': lambda: select(Like.user_id).where(Like.poem_id == 1),
+    'poem savers': lambda: select(SavedPoem.user_id).where(SavedPoem.poem_id == 1),
+    'notifications page': lambda: Notification.query.filter_by(user_id=1).order_by(
+        Notification.created_at.desc(), Notification.id.desc()).limit(51).statement,
+    'unread notifications': lambda: Notification.query.filter_by(user_id=1, is_read=False).order_by(
+        Notification.created_at.desc()).limit(5).statement,
+    'followers': lambda: select(db.func.count()).select_from(Follow).where(Follow.followed_id == 1),
+    'pull authors': lambda: select(User.id).where(User.follower_count >= 5000),
+    'recent activity': lambda: select(UserActivity.activity_type, db.func.count()).where(
+        UserActivity.created_at >= datetime.utcnow()).group_by(UserActivity.activity_type),
+    'new poems': lambda: select(db.func.count()).select_from(Poem).where(Poem.created_at >= datetime.utcnow()),
+    'recent visitors': lambda: Visitor.query.order_by(Visitor.last_visit.desc()).limit(20).statement,
+    'active visitors': lambda: select(db.func.count()).select_from(Visitor).where(
+        Visitor.last_visit >= datetime.utcnow()),
+    'newest users': lambda: User.query.order_by(User.created_at.desc()).limit(100).statement,
+}
+
+# Top-N queries where walking an index in order and stopping at the LIMIT is the intended plan
+ORDERED_SCANS = {'discovery feed', 'recent visitors', 'newest users'}
+
+# SQLite: "SCAN poems" reads the whole table ("SCAN TABLE poems" before 3.36), "SCAN poems USING
+# [COVERING] INDEX ..." the whole index; SEARCH is a seek
+SQLITE_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)$')
+SQLITE_INDEX_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+) USING ')
+POSTGRES_FULL_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+def explain(connection, statement):
+    """Query plan lines for a statement"""
+    compiled = statement.compile(dialect=connection.dialect)
+    if connection.dialect.name == 'sqlite':
+        params = tuple(compiled.params[name] for name in compiled.positiontup or ())
+        return [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled.string}', params)]
+    return [row[0] for row in connection.exec_driver_sql(f'EXPLAIN {compiled.string}', compiled.params)]
+
+
+def check_query_plans():
+    """
+    EXPLAIN every hot query and flag full table scans
+    
+    Plans depend on table statistics, and on a small database a scan is the right
+    choice, so the check asks whether an index *can* serve each query: SQLite plans
+    come from an empty in-memory copy of the schema (no statistics), PostgreSQL plans
+    from the live database with sequential scans disabled. Declared indexes missing
+    from the live database are reported as failures too.
+    
+    Returns:
+        list: (name, ok, plan lines) per query, then per missing index
+    """
+    results = []
+    if db.engine.dialect.name == 'sqlite':
+        engine = create_engine('sqlite://')
+        db.metadata.create_all(engine)
+        with engine.connect() as connection:
+            for name, build in HOT_QUERIES.items():
+                plan = explain(connection, build())
+                # A sort step means the index did not supply the ORDER BY either
+                ok = not any(
+                    SQLITE_FULL_SCAN.match(line.strip()) or 'TEMP B-TREE FOR ORDER BY' in line
+                    or (name not in ORDERED_SCANS and SQLITE_INDEX_SCAN.match(line.strip()))
+                    for line in plan
+                )
+                results.append((name, ok, plan))
+        engine.dispose()
+    else:
+        with db.engine.connect() as connection, connection.begin():
+            connection.exec_driver_sql('SET LOCAL enable_seqscan = off')
+            for name, build in HOT_QUERIES.items():
+                plan = explain(connection, build())
+                results.append((name, not any(POSTGRES_FULL_SCAN.search(line) for line in plan), plan))
+    
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {idx['name'] for idx in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                results.append((f'index {index.name}', False, [f'missing from {table.name}']))
+    return results
@@ -0,0 +1,316 @@
+"""
+Full-Text Search Index for Poetry Vault
+Pluggable search backends (SQLite FTS5, PostgreSQL tsvector) kept in sync with poems
+"""
+import logging
+import re
+
+from sqlalchemy import bindparam, event, inspect, text
+from models import db, User, Poem
+
+logger = logging.getLogger(__name__)
+
+# Words are runs of letters/digits in any script (Latin, Arabic, ...)
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+MAX_QUERY_TOKENS = 8
+
+
+def tokenize_query(query):
+    """Split a raw search box query into safe search tokens"""
+    if not query:
+        return []
+    return [token.lower() for token in TOKEN_PATTERN.findall(query)][:MAX_QUERY_TOKENS]
+
+
+class LikeSearchBackend:
+    """Fallback backend - substring ILIKE scans, no index to maintain"""
+
+    name = 'like'
+
+    def ensure_index(self, connection):
+        pass
+
+    def rebuild(self, connection):
+        return 0
+
+    def index_poem(self, connection, poem_id):
+        pass
+
+    def index_user_poems(self, connection, user_id):
+        pass
+
+    def remove_poem(self, connection, poem_id):
+        pass
+
+    def remove_poems(self, connection, poem_ids):
+        pass
+
+    def match(self, query, tokens):
+        author_ids = db.session.query(User.id).filter(User.username.ilike(f'%{query}%'))
+        return db.or_(
+            Poem.title.ilike(f'%{query}%'),
+            Poem.content.ilike(f'%{query}%'),
+            db.and_(Poem.user_id.in_(author_ids), Poem.is_anonymous.isnot(True))
+        )
+
+    def ranked(self, query, tokens, weights):
+        # No term statistics without an index - score by which field matched
+        score = (
+            db.case((Poem.title.ilike(f'%{query}%'), weights['title']), else_=0) +
+            db.case((Poem.content.ilike(f'%{query}%'), weights['content']), else_=0)
+        )
+        return db.session.query(Poem.id.label('poem_id'), score.label('score')).filter(
+            self.match(query, tokens)
+        ).subquery()
+
+
+class SQLiteFTSBackend:
+    """SQLite FTS5 virtual table keyed by poem id (rowid)"""
+
+    name = 'sqlite_fts5'
+
+    # Anonymous poems are indexed without an author so search cannot unmask them
+    SELECT_DOCUMENTS = '''
+        SELECT p.id, p.title, p.content,
+               CASE WHEN p.is_anonymous THEN '' ELSE COALESCE(u.username, '') END
+        FROM poems p LEFT JOIN users u ON u.id = p.user_id
+    '''
+
+    def ensure_index(self, connection):
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'poems_fts'"
+        )).first()
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS poems_fts "
+            "USING fts5(title, content, author, tokenize = 'unicode61 remove_diacritics 2')"
+        ))
+        if not exists:
+            count = self.rebuild(connection)
+            logger.info(f"Built poems_fts search index with {count} poems")
+
+    def rebuild(self, connection):
+        connection.execute(text('DELETE FROM poems_fts'))
+        connection.execute(text(
+            f'INSERT INTO poems_fts (rowid, title, content, author) {self.SELECT_DOCUMENTS}'
+        ))
+        return connection.execute(text('SELECT COUNT(*) FROM poems_fts')).scalar()
+
+    def index_poem(self, connection, poem_id):
+        # Delete first: SQLite may reuse the rowid of a previously deleted poem
+        self.remove_poem(connection, poem_id)
+        connection.execute(text(
+            f'INSERT INTO poems_fts (rowid, title, content, author) {self.SELECT_DOCUMENTS} WHERE p.id = :poem_id'
+        ), {'poem_id': poem_id})
+
+    def index_user_poems(self, connection, user_id):
+        connection.execute(text(
+            'DELETE FROM poems_fts WHERE rowid IN (SELECT id FROM poems WHERE user_id = :user_id)'
+        ), {'user_id': user_id})
+        connection.execute(text(
+            f'INSERT INTO poems_fts (rowid, title, content, author) {self.SELECT_DOCUMENTS} WHERE p.user_id = :user_id'
+        ), {'user_id': user_id})
+
+    def remove_poem(self, connection, poem_id):
+        connection.execute(text('DELETE FROM poems_fts WHERE rowid = :poem_id'), {'poem_id': poem_id})
+
+    def remove_poems(self, connection, poem_ids):
+        connection.execute(text('DELETE FROM poems_fts WHERE rowid IN :poem_ids').bindparams(
+            bindparam('poem_ids', expanding=True)
+        ), {'poem_ids': list(poem_ids)})
+
+    @staticmethod
+    def build_query(tokens):
+        # Quoted prefix terms, implicitly ANDed: "moon"* "sil"*
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    def match(self, query, tokens):
+        matches = text('SELECT rowid FROM poems_fts WHERE poems_fts MATCH :fts_query').bindparams(
+            fts_query=self.build_query(tokens)
+        ).columns(rowid=db.Integer)
+        return Poem.id.in_(matches)
+
+    def ranked(self, query, tokens, weights):
+        # bm25() uses FTS5's per-column term statistics; lower is better, so negate it
+        return text(
+            'SELECT rowid AS poem_id, -bm25(poems_fts, :w_title, :w_content, :w_author) AS score '
+            'FROM poems_fts WHERE poems_fts MATCH :fts_query'
+        ).bindparams(
+            w_title=weights['title'], w_content=weights['content'], w_author=weights['author'],
+            fts_query=self.build_query(tokens)
+        ).columns(poem_id=db.Integer, score=db.Float).subquery()
+
+
+class PostgresSearchBackend:
+    """PostgreSQL tsvector column on poems with a GIN index"""
+
+    name = 'postgres_tsvector'
+
+    # Title, author and content carry separate weights (A, B, D)
+    VECTOR_EXPRESSION = '''
+        setweight(to_tsvector('simple', COALESCE(poems.title, '')), 'A') ||
+        setweight(to_tsvector('simple', CASE WHEN poems.is_anonymous THEN '' ELSE COALESCE(users.username, '') END), 'B') ||
+        setweight(to_tsvector('simple', COALESCE(poems.content, '')), 'D')
+    '''
+
+    def ensure_index(self, connection):
+        connection.execute(text('ALTER TABLE poems ADD COLUMN IF NOT EXISTS search_vector tsvector'))
+        connection.execute(text(
+            'CREATE INDEX IF NOT EXISTS idx_poems_search_vector ON poems USING GIN (search_vector)'
+        ))
+        result = connection.execute(text(
+            f'UPDATE poems SET search_vector = {self.VECTOR_EXPRESSION} '
+            'FROM users WHERE users.id = poems.user_id AND poems.search_vector IS NULL'
+        ))
+        if result.rowcount:
+            logger.info(f"Backfilled search_vector for {result.rowcount} poems")
+
+    def rebuild(self, connection):
+        result = connection.execute(text(
+            f'UPDATE poems SET search_vector = {self.VECTOR_EXPRESSION} FROM users WHERE users.id = poems.user_id'
+        ))
+        return result.rowcount
+
+    def index_poem(self, connection, poem_id):
+        connection.execute(text(
+            f'UPDATE poems SET search_vector = {self.VECTOR_EXPRESSION} '
+            'FROM users WHERE users.id = poems.user_id AND poems.id = :poem_id'
+        ), {'poem_id': poem_id})
+
+    def index_user_poems(self, connection, user_id):
+        connection.execute(text(
+            f'UPDATE poems SET search_vector = {self.VECTOR_EXPRESSION} '
+            'FROM users WHERE users.id = poems.user_id AND poems.user_id = :user_id'
+        ), {'user_id': user_id})
+
+    def remove_poem(self, connection, poem_id):
+        # The vector lives on the poem row and is deleted with it
+        pass
+
+    def remove_poems(self, connection, poem_ids):
+        pass
+
+    @staticmethod
+    def build_query(tokens):
+        return ' & '.join(f'{token}:*' for token in tokens)
+
+    def match(self, query, tokens):
+        return text("poems.search_vector @@ to_tsquery('simple', :ts_query)").bindparams(
+            ts_query=self.build_query(tokens)
+        )
+
+    def ranked(self, query, tokens, weights):
+        # ts_rank weight array is ordered {D, C, B, A}; normalization 1 divides by log(document length)
+        top = max(weights.values()) or 1.0
+        weight_array = '{%f, 0, %f, %f}' % (weights['content'] / top, weights['author'] / top, weights['title'] / top)
+        return text(
+            "SELECT id AS poem_id, ts_rank(CAST(:weight_array AS float4[]), search_vector, "
+            "to_tsquery('simple', :ts_query), 1) AS score "
+            "FROM poems WHERE search_vector @@ to_tsquery('simple', :ts_query)"
+        ).bindparams(
+            weight_array=weight_array, ts_query=self.build_query(tokens)
+        ).columns(poem_id=db.Integer, score=db.Float).subquery()
+
+
+class SearchIndex:
+    """Chooses a search backend for the configured database and keeps it in sync"""
+
+    BACKENDS = {
+        'sqlite': SQLiteFTSBackend,
+        'postgresql': PostgresSearchBackend
+    }
+
+    def __init__(self):
+        self.backend = LikeSearchBackend()
+        self.fallback = LikeSearchBackend()
+        self.ready = False
+        self.weights = {'title': 10.0, 'author': 4.0, 'content': 1.0}
+
+    def init_app(self, app):
+        """Create/backfill the index for the app's database (call inside an app context)"""
+        requested = app.config.get('SEARCH_BACKEND', 'auto')
+        self.weights = {
+            'title': float(app.config.get('SEARCH_TITLE_BOOST', 10.0)),
+            'author': float(app.config.get('SEARCH_AUTHOR_BOOST', 4.0)),
+            'content': float(app.config.get('SEARCH_CONTENT_BOOST', 1.0))
+        }
+        dialect = db.engine.dialect.name
+        backend_class = self.BACKENDS.get(dialect) if requested == 'auto' else None
+
+        if backend_class is None:
+            self.backend = LikeSearchBackend()
+            self.ready = False
+            logger.info(f"Search index disabled (backend={requested}, dialect={dialect}); using ILIKE")
+            return
+
+        backend = backend_class()
+        try:
+            with db.engine.begin() as connection:
+                backend.ensure_index(connection)
+            self.backend = backend
+            self.ready = True
+            logger.info(f"Search index ready: {backend.name}")
+        except Exception as e:
+            self.backend = LikeSearchBackend()
+            self.ready = False
+            logger.error(f"Search index unavailable, falling back to ILIKE: {e}")
+
+    def rebuild(self):
+        """Rebuild the whole index from the poems table"""
+        with db.engine.begin() as connection:
+            return self.backend.rebuild(connection)
+
+    def remove_poems(self, connection, poem_ids):
+        """Drop index entries for poems removed with bulk DELETEs (which skip the ORM hooks)"""
+        if self.ready and poem_ids:
+            self.backend.remove_poems(connection, poem_ids)
+
+    def match(self, query):
+        """SQLAlchemy filter matching poems by title, content or author"""
+        tokens = tokenize_query(query)
+        if not tokens or not self.ready:
+            return self.fallback.match(query, tokens)
+        return self.backend.match(query, tokens)
+
+    def ranked(self, query):
+        """
+        Subquery of matching poems with a relevance score
+        
+        Returns:
+            Subquery with columns (poem_id, score) - higher score is more relevant.
+            Order by score with a LIMIT so the database keeps only the top-k rows
+            (SQLite's bounded sorter / PostgreSQL's top-N heapsort).
+        """
+        tokens = tokenize_query(query)
+        if not tokens or not self.ready:
+            return self.fallback.ranked(query, tokens, self.weights)
+        return self.backend.ranked(query, tokens, self.weights)
+
+    # Sync hooks - run inside the ORM flush so the index commits with the poem
+
+    def _after_poem_insert(self, mapper, connection, poem):
+        if self.ready:
+            self.backend.index_poem(connection, poem.id)
+
+    def _after_poem_update(self, mapper, connection, poem):
+        if not self.ready:
+            return
+        state = inspect(poem)
+        if any(state.attrs[attr].history.has_changes() for attr in ('title', 'content', 'user_id', 'is_anonymous')):
+            self.backend.index_poem(connection, poem.id)
+
+    def _after_poem_delete(self, mapper, connection, poem):
+        if self.ready:
+            self.backend.remove_poem(connection, poem.id)
+
+    def _after_user_update(self, mapper, connection, user):
+        if self.ready and inspect(user).attrs.username.history.has_changes():
+            self.backend.index_user_poems(connection, user.id)
+
+
+# Global search index
+search_index = SearchIndex()
+
+event.listen(Poem, 'after_insert', search_index._after_poem_insert)
+event.listen(Poem, 'after_update', search_index._after_poem_update)
+event.listen(Poem, 'after_delete', search_index._after_poem_delete)
+event.listen(User, 'after_update', search_index._after_user_update)
@@ -6,40 +6,28 @@ Protects user data, prevents spam, and adds security layers
 from functools import wraps
 from flask import request, jsonify, session, current_app
 from flask_login import current_user
-from datetime import datetime, timedelta
+from datetime import datetime
 import hashlib
 import re
 from models import db, User, Poem, Comment
+from rate_limiter import RateLimiter
+from spam_filter import spam_filter
 
 class SecurityManager:
     """Comprehensive security management for Poetry Vault"""
     
     def __init__(self):
-        self.rate_limits = {}
+        self.rate_limiter = RateLimiter()
         self.failed_attempts = {}
         self.suspicious_ips = set()
     
+    def init_app(self, app):
+        """Configure the rate limit store (shared across workers by default)"""
+        self.rate_limiter.init_app(app)
+    
     def rate_limit_check(self, user_id, action, limit=5, window_minutes=15):
         """Rate limiting for user actions"""
-        now = datetime.now()
-        key = f"{user_id}_{action}"
-        
-        if key not in self.rate_limits:
-            self.rate_limits[key] = []
-        
-        # Clean old attempts
-        self.rate_limits[key] = [
-            timestamp for timestamp in self.rate_limits[key]
-            if now - timestamp < timedelta(minutes=window_minutes)
-        ]
-        
-        # Check if limit exceeded
-        if len(self.rate_limits[key]) >= limit:
-            return False
-        
-        # Add current attempt
-        self.rate_limits[key].append(now)
-        return True
+        return self.rate_limiter.hit(f"{user_id}_{action}", limit, window_minutes * 60)
     
     def validate_content(self, content, content_type="general"):
         """Validate and sanitize user content"""
@@ -65,16 +53,9 @@ class SecurityManager:
             if len(content) > 200:
                 return False, "Title is too long (max 200 characters)"
         
-        # Check for spam patterns
-        spam_patterns = [
-            r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
-            r'\b(?:buy|sell|cheap|free|click|visit|www\.)\b',
-            r'(.)\1{10,}',  # Repeated characters
-        ]
-        
-        for pattern in spam_patterns:
-            if re.search(pattern, content, re.IGNORECASE):
-                return False, "Content appears to be spam"
+        # Weighted spam score (links, promo words, repeated characters)
+        if spam_filter.is_spam(content):
+            return False, "Content appears to be spam"
         
         return True, content
     
@@ -0,0 +1,268 @@
+"""
+SQLite Engine Profile for Poetry Vault
+Per-connection pragmas and a serialized writer lock for the SQLite fallback database
+"""
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+try:
+    import fcntl
+except ImportError:  # Windows - writers are only serialized within a process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+_HOLDS_WRITER = 'sqlite_profile.holds_writer'
+
+
+class _WriterLock:
+    """
+    One writer at a time per host
+
+    Threads queue on a re-entrant lock, then the winner takes an exclusive lock on a
+    file shared by every worker process. Unlike SQLite's busy handler, which sleeps
+    up to 100 ms between retries, a waiting thread wakes as soon as the lock is free.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+        self._pid = None
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self, timeout):
+        started = time.perf_counter()
+        deadline = started + timeout
+        if not self._lock.acquire(timeout=timeout):
+            self.timeouts += 1
+            return False
+        self._depth += 1
+        if self._depth == 1 and self.path and fcntl is not None and not self._lock_file(deadline):
+            self._depth -= 1
+            self._lock.release()
+            self.timeouts += 1
+            return False
+        self.acquired += 1
+        self.wait_seconds += time.perf_counter() - started
+        return True
+
+    def _lock_file(self, deadline):
+        # File locks do not survive a fork, so each process opens its own descriptor
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.path, 'a')
+            self._pid = os.getpid()
+        delay = 0.0005
+        while True:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.perf_counter() >= deadline:
+                    return False
+                time.sleep(delay)
+                delay = min(delay * 2, 0.005)
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self.path and fcntl is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._lock.release()
+
+
+class SQLiteProfile:
+    """
+    Tuning for the SQLite fallback database (no-op for other backends)
+
+    Every new connection is switched to WAL, so readers never block the writer or each
+    other, with synchronous=NORMAL (durable at checkpoints, safe with WAL), a larger
+    page cache, memory-mapped reads and a busy timeout.
+
+    Writes are serialized through a writer lock: the first INSERT/UPDATE/DELETE of a
+    transaction waits its turn, and the lock is handed on as soon as the transaction
+    commits or rolls back. SQLite only allows one writer anyway; queuing writers here
+    replaces "database is locked" errors and busy-handler back-off with an orderly line.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.journal_mode = 'WAL'
+        self.synchronous = 'NORMAL'
+        self.busy_timeout_ms = 5000
+        self.cache_size_kb = 16384
+        self.mmap_size = 256 * 1024 * 1024
+        self.writer_timeout = 10.0
+        self.writer_lock = None
+
+    def init_app(self, app):
+        """Attach the profile to the app's engine (call inside an app context, before the first query)"""
+        from models import db
+        self.journal_mode = app.config.get('SQLITE_JOURNAL_MODE', 'WAL')
+        self.synchronous = app.config.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+        self.busy_timeout_ms = int(app.config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+        self.cache_size_kb = int(app.config.get('SQLITE_CACHE_SIZE_KB', 16384))
+        self.mmap_size = int(app.config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+        self.writer_timeout = float(app.config.get('SQLITE_WRITER_TIMEOUT', 10.0))
+        lock_path = app.config.get('SQLITE_WRITER_LOCK_FILE', 'instance/sqlite_writer.lock')
+        self.configure(db.engine, lock_path if app.config.get('SQLITE_SERIALIZE_WRITES', True) else None)
+
+    def configure(self, engine, lock_path=None):
+        """Register the pragma and writer-lock hooks on a SQLite engine"""
+        if engine.url.get_backend_name() != 'sqlite':
+            return
+        memory = engine.url.database in (None, '', ':memory:')
+        event.listen(engine, 'connect', lambda dbapi_connection, record: self._apply_pragmas(dbapi_connection, memory))
+        # Connections opened before the hooks (there should be none) are replaced
+        engine.dispose()
+        self.enabled = True
+        # An in-memory database lives on a single shared connection, so there is nothing to serialize
+        if lock_path is None or memory:
+            return
+        os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+        self.writer_lock = _WriterLock(lock_path)
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'commit', self._on_commit)
+        event.listen(engine, 'rollback', self._on_rollback)
+        event.listen(engine.pool, 'checkin', self._release_record)
+
+    def _apply_pragmas(self, dbapi_connection, memory):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f'PRAGMA busy_timeout = {self.busy_timeout_ms}')
+            if not memory:
+                cursor.execute(f'PRAGMA journal_mode = {self.journal_mode}')
+                cursor.execute(f'PRAGMA mmap_size = {self.mmap_size}')
+            cursor.execute(f'PRAGMA synchronous = {self.synchronous}')
+            cursor.execute(f'PRAGMA cache_size = -{self.cache_size_kb}')
+            cursor.execute('PRAGMA temp_store = MEMORY')
+        finally:
+            cursor.close()
+
+    # Writer lock
+
+    def _before_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if connection.info.get(_HOLDS_WRITER) or not statement.lstrip()[:7].upper().startswith(_WRITE_PREFIXES):
+            return
+        if self.writer_lock.acquire(self.writer_timeout):
+            connection.info[_HOLDS_WRITER] = True
+        else:
+            # Carry on unqueued; SQLite's own busy timeout still applies
+            logger.warning(f"Waited {self.writer_timeout}s for the SQLite writer lock; writing without it")
+
+    def _on_commit(self, connection):
+        self._finish(connection, commit=True)
+
+    def _on_rollback(self, connection):
+        self._finish(connection, commit=False)
+
+    def _finish(self, connection, commit):
+        if not connection.info.pop(_HOLDS_WRITER, None):
+            return
+        # The hook runs just before SQLAlchemy's COMMIT/ROLLBACK; finishing the transaction
+        # here means the next writer never finds the file locked (the driver's call is then a no-op)
+        try:
+            dbapi_connection = connection.connection.dbapi_connection
+            if commit:
+                dbapi_connection.commit()
+            else:
+                dbapi_connection.rollback()
+        finally:
+            self.writer_lock.release()
+
+    def _release_record(self, dbapi_connection, record):
+        # A connection returned mid-transaction is rolled back by the pool; free its lock too
+        if record.info.pop(_HOLDS_WRITER, None):
+            self.writer_lock.release()
+
+    def stats(self):
+        lock = self.writer_lock
+        return {
+            'enabled': self.enabled,
+            'serialized_writes': lock is not None,
+            'writer_acquired': lock.acquired if lock else 0,
+            'writer_timeouts': lock.timeouts if lock else 0,
+            'writer_wait_seconds': round(lock.wait_seconds, 3) if lock else 0.0,
+        }
+
+
+# Global SQLite profile
+sqlite_profile = SQLiteProfile()
+
+
+def _benchmark_worker(url, lock_path, busy_timeout_ms, worker, transactions, results):
+    from sqlalchemy import create_engine, select
+    from models import Poem, Like, Comment
+    engine = create_engine(url)
+    if lock_path:
+        profile = SQLiteProfile()
+        profile.busy_timeout_ms = busy_timeout_ms
+        profile.configure(engine, lock_path)
+    poems, likes, comments = Poem.__table__, Like.__table__, Comment.__table__
+    done = errors = 0
+    for i in range(transactions):
+        # The shape of the like and comment routes: read the poem, write the row, bump its counter
+        user_id = 1000 + worker * transactions + i
+        try:
+            with engine.begin() as connection:
+                poem_id = connection.execute(select(poems.c.id).where(poems.c.id == 1 + i % 10)).scalar()
+                connection.execute(likes.insert().values(user_id=user_id, poem_id=poem_id))
+                connection.execute(poems.update().where(poems.c.id == poem_id).values(like_count=poems.c.like_count + 1))
+                connection.execute(comments.insert().values(user_id=user_id, poem_id=poem_id, content='Lovely'))
+                connection.execute(poems.update().where(poems.c.id == poem_id).values(comment_count=poems.c.comment_count + 1))
+            done += 1
+        except Exception:
+            errors += 1
+    results.put((done, errors))
+
+
+def benchmark(workers=8, transactions=200, busy_timeout_ms=1000):
+    """Concurrent like+comment transactions from worker processes, default SQLite against the profile"""
+    import multiprocessing
+    import tempfile
+    from sqlalchemy import create_engine
+    from models import db, Poem
+
+    for label, profiled in (('default', False), ('profile', True)):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.db')
+            url = f'sqlite:///{path}?timeout={busy_timeout_ms / 1000}'
+            engine = create_engine(url)
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(Poem.__table__.insert(), [
+                    {'title': f'Poem {n}', 'content': 'Verse', 'user_id': 1, 'like_count': 0, 'comment_count': 0}
+                    for n in range(10)
+                ])
+            engine.dispose()
+            lock_path = os.path.join(directory, 'writer.lock') if profiled else None
+
+            context = multiprocessing.get_context('fork')
+            results = context.Queue()
+            processes = [
+                context.Process(target=_benchmark_worker, args=(url, lock_path, busy_timeout_ms,
+                                                                worker, transactions, results))
+                for worker in range(workers)
+            ]
+            started = time.perf_counter()
+            for process in processes:
+                process.start()
+            totals = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+            seconds = time.perf_counter() - started
+            done = sum(total[0] for total in totals)
+            errors = sum(total[1] for total in totals)
+            print(f"{label:8} {done:6} transactions in {seconds:6.2f}s   {done / seconds:8.1f} tx/s   "
+                  f"{errors} 'database is locked' failures")
+
+
+if __name__ == '__main__':
+    benchmark()
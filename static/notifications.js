@@ -46,39 +46,115 @@ function showDesktopNotification(title, body, icon = '/static/images/feather.png
     };
 }
 
-// Check for new notifications periodically
+// Show a desktop notification for one notification payload
 let lastNotificationId = 0;
 
+function handleNotification(notif) {
+    if (notif.id <= lastNotificationId) return;
+    
+    let title = '📚 Poetry Vault';
+    let body = notif.message;
+    
+    if (notif.type === 'like') {
+        title = '❤️ New Like!';
+    } else if (notif.type === 'follow') {
+        title = '👤 New Follower!';
+    } else if (notif.type === 'comment') {
+        title = '💬 New Comment!';
+    }
+    
+    showDesktopNotification(title, body);
+    lastNotificationId = notif.id;
+}
+
+// Fallback for browsers without EventSource: poll every 30 seconds
 async function checkForNewNotifications() {
     try {
         const response = await fetch('/api/check-new-notifications');
         const data = await response.json();
         
         if (data.notifications && data.notifications.length > 0) {
-            data.notifications.forEach(notif => {
-                if (notif.id > lastNotificationId) {
-                    // Show desktop notification
-                    let title = '📚 Poetry Vault';
-                    let body = notif.message;
-                    
-                    if (notif.type === 'like') {
-                        title = '❤️ New Like!';
-                    } else if (notif.type === 'follow') {
-                        title = '👤 New Follower!';
-                    } else if (notif.type === 'comment') {
-                        title = '💬 New Comment!';
-                    }
-                    
-                    showDesktopNotification(title, body);
-                    lastNotificationId = notif.id;
-                }
-            });
+            data.notifications.slice().reverse().forEach(handleNotification);
         }
     } catch (error) {
         console.error('Error checking notifications:', error);
     }
 }
 
+// Server pushes new notifications over one long-lived connection (Server-Sent Events)
+const POLL_INTERVAL = 30000;
+const MAX_RECONNECT_DELAY = 300000;
+let notificationSource = null;
+let reconnectDelay = POLL_INTERVAL;
+let streamRetryTimer = null;
+
+function connectNotificationStream() {
+    const url = lastNotificationId ? `/api/notifications/stream?last_id=${lastNotificationId}` : '/api/notifications/stream';
+    notificationSource = new EventSource(url);
+    
+    notificationSource.addEventListener('ready', () => {
+        reconnectDelay = POLL_INTERVAL;
+        stopPolling();
+    });
+    
+    notificationSource.addEventListener('notification', (event) => {
+        handleNotification(JSON.parse(event.data));
+    });
+    
+    notificationSource.addEventListener('busy', (event) => {
+        // The server is at its stream limit: poll, and only try the stream again after its Retry-After
+        notificationSource.close();
+        notificationSource = null;
+        startPolling();
+        scheduleStreamRetry(JSON.parse(event.data).retry_after * 1000);
+    });
+    
+    notificationSource.onerror = () => {
+        // The server closes streams periodically; the browser reconnects on its own.
+        // If the connection failed outright (logged out, server down), poll meanwhile
+        // and try the stream again with exponential back-off.
+        if (notificationSource.readyState === EventSource.CLOSED) {
+            notificationSource = null;
+            startPolling();
+            scheduleStreamRetry(reconnectDelay);
+            reconnectDelay = Math.min(reconnectDelay * 2, MAX_RECONNECT_DELAY);
+        }
+    };
+}
+
+function scheduleStreamRetry(delay) {
+    // At most one pending attempt; until it fires the tab only polls
+    if (streamRetryTimer !== null) return;
+    streamRetryTimer = setTimeout(() => {
+        streamRetryTimer = null;
+        connectNotificationStream();
+    }, delay);
+}
+
+let pollTimer = null;
+
+function startPolling() {
+    if (pollTimer === null) {
+        checkForNewNotifications();
+        pollTimer = setInterval(checkForNewNotifications, POLL_INTERVAL);
+    }
+}
+
+function stopPolling() {
+    if (pollTimer !== null) {
+        clearInterval(pollTimer);
+        pollTimer = null;
+    }
+}
+
+function startNotificationUpdates() {
+    if ('EventSource' in window) {
+        connectNotificationStream();
+    } else {
+        startPolling();
+    }
+}
+
 // Initialize notifications
 async function initNotifications() {
     // Ask for permission on first visit
@@ -91,16 +167,16 @@ async function initNotifications() {
                 const granted = await requestNotificationPermission();
                 if (granted) {
                     console.log('✅ Notifications enabled!');
-                    // Start checking for notifications
-                    setInterval(checkForNewNotifications, 30000); // Check every 30 seconds
+                    // Start receiving notifications
+                    startNotificationUpdates();
                 }
             }
             localStorage.setItem('notificationAsked', 'true');
         }, 3000); // Ask after 3 seconds
     } else if (Notification.permission === 'granted') {
         notificationPermission = true;
-        // Start checking for notifications
-        setInterval(checkForNewNotifications, 30000); // Check every 30 seconds
+        // Start receiving notifications
+        startNotificationUpdates();
     }
 }
 
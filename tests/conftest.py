@@ -0,0 +1,27 @@
+"""
+Shared test settings
+Settings are read when app.py is imported, so they are set here before any test module imports it:
+a scratch database and nothing written to instance/
+"""
+import os
+import sys
+import tempfile
+
+_scratch = tempfile.mkdtemp(prefix='poetry-vault-tests-')
+os.environ.update({
+    'DATABASE_URL': f"sqlite:///{os.path.join(_scratch, 'test.db')}",
+    # A SQLite copy stands in for a replica; test_read_replicas.py fills it from the primary
+    'READ_REPLICA_URLS': f"sqlite:///{os.path.join(_scratch, 'replica.db')}",
+    'SCHEDULER_ENABLED': 'False',
+    'BACKUP_ENABLED': 'False',
+    'ANALYTICS_ASYNC': 'False',
+    'TIMELINE_FANOUT_ASYNC': 'False',
+    'RATE_LIMIT_STORE': 'memory',
+    'NOTIFICATION_STREAM_BACKEND': 'local',
+    'METRICS_DIR': os.path.join(_scratch, 'metrics'),
+    'SCHEMA_LOCK_FILE': os.path.join(_scratch, 'schema.lock'),
+    'SCHEDULER_LOCK_FILE': os.path.join(_scratch, 'scheduler.lock'),
+    'SQLITE_WRITER_LOCK_FILE': os.path.join(_scratch, 'sqlite_writer.lock'),
+    'LOG_FILE': os.path.join(_scratch, 'poetry_vault.log'),
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,87 @@
+"""
+Query-count tests for the home feed
+A feed page must cost the same number of statements whether it shows 5 poems or 50
+"""
+import itertools
+
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from app import app
+from models import db, User, Poem, Follow
+
+_reader_numbers = itertools.count(1)
+
+
+@pytest.fixture
+def reader(monkeypatch):
+    """A logged-in client whose feed page holds every poem seeded by the test"""
+    monkeypatch.setitem(app.config, 'POEMS_PER_PAGE', 100)
+    app.config['TESTING'] = True
+    client = app.test_client()
+    username = f'reader{next(_reader_numbers)}'
+    response = client.post('/register', data={'username': username, 'email': f'{username}@example.com',
+                                               'password': 'secret123'})
+    assert response.status_code == 302
+    with app.app_context():
+        client.user_id = User.query.filter_by(username=username).one().id
+    return client
+
+
+def seed_poems(prefix, start, stop, follower_id=None):
+    """One poem per new author, so per-author lazy loads would show up in the count"""
+    with app.app_context():
+        poem_ids = []
+        for n in range(start, stop):
+            author = User(username=f'{prefix}{n}', email=f'{prefix}{n}@example.com',
+                          password_hash=generate_password_hash('secret123'))
+            db.session.add(author)
+            db.session.flush()
+            if follower_id is not None:
+                db.session.add(Follow(follower_id=follower_id, followed_id=author.id))
+            poem = Poem(title=f'Poem {n} by {prefix}', content='Quiet verse about the evening tide',
+                        user_id=author.id, is_classic=False)
+            db.session.add(poem)
+            db.session.flush()
+            poem_ids.append(poem.id)
+        db.session.commit()
+        return poem_ids
+
+
+def count_queries(client, path):
+    """Statements executed while serving `path` (following redirects), after one warm-up request"""
+    client.get(path, follow_redirects=True)
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(path, follow_redirects=True)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return len(statements), response
+
+
+@pytest.mark.parametrize('following', [False, True], ids=['discovery', 'following'])
+def test_feed_query_count_does_not_grow_with_poems(reader, following):
+    prefix = 'follows' if following else 'discover'
+    follower_id = reader.user_id if following else None
+
+    seeded = seed_poems(prefix, 0, 5, follower_id)
+    home_small, _ = count_queries(reader, '/')
+    api_small, response = count_queries(reader, '/api/feed')
+    assert set(seeded) <= {poem['id'] for poem in response.get_json()['poems']}
+
+    seeded += seed_poems(prefix, 5, 50, follower_id)
+    home_large, _ = count_queries(reader, '/')
+    api_large, response = count_queries(reader, '/api/feed')
+    assert set(seeded) <= {poem['id'] for poem in response.get_json()['poems']}
+
+    assert home_large == home_small
+    assert api_large == api_small
@@ -0,0 +1,14 @@
+"""
+Query-plan tests
+Every hot query must be servable from an index, and every declared index must exist
+"""
+from app import app
+from schema import check_query_plans
+
+
+def test_hot_queries_use_indexes():
+    with app.app_context():
+        results = check_query_plans()
+    assert results
+    failed = {name: plan for name, ok, plan in results if not ok}
+    assert not failed, '\n'.join(f"{name}:\n  " + '\n  '.join(plan) for name, plan in failed.items())
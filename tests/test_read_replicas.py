@@ -0,0 +1,99 @@
+"""
+Read replica routing tests
+The primary and the replica are two SQLite files; a user added to the primary after the
+copy was taken shows which database a page was read from
+"""
+import itertools
+import shutil
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from werkzeug.security import generate_password_hash
+
+from app import app
+from models import db, User
+from read_replicas import replica_router, STICKY_KEY
+
+_names = itertools.count(1)
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    """Copy the primary into the replica file, then add a user only the primary has"""
+    app.config['TESTING'] = True
+    assert replica_router.enabled
+    engine = replica_router.replicas[0]['engine']
+    with app.app_context():
+        db.session.execute(db.text('PRAGMA wal_checkpoint(TRUNCATE)'))
+        db.session.commit()
+        engine.dispose()
+        shutil.copyfile(db.engine.url.database, engine.url.database)
+
+        late = f'primaryonly{next(_names)}'
+        db.session.add(User(username=late, email=f'{late}@example.com',
+                            password_hash=generate_password_hash('secret123')))
+        db.session.commit()
+    replica_router.check(force=True)
+    monkeypatch.setattr(replica_router, 'counts', dict.fromkeys(replica_router.counts, 0))
+    yield late
+    # The next test measures the replica again instead of trusting this test's result
+    for state in replica_router.replicas:
+        state['checked_at'] = 0.0
+
+
+@pytest.fixture
+def reader():
+    """A user present in both databases, logged in without a pending sticky window"""
+    app.config['TESTING'] = True
+    client = app.test_client()
+    username = f'replicareader{next(_names)}'
+    response = client.post('/register', data={'username': username, 'email': f'{username}@example.com',
+                                               'password': 'secret123'})
+    assert response.status_code == 302
+    # Registering is a write, so the session is pinned to the primary for a while
+    with client.session_transaction() as session:
+        assert session.pop(STICKY_KEY, None) is not None
+    return client
+
+
+def read_users_page(client):
+    response = client.get('/users')
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_read_only_view_reads_from_replica(reader, replica):
+    assert replica not in read_users_page(reader)
+    assert replica_router.counts['replica'] == 1
+
+
+def test_own_write_pins_reads_to_primary(reader, replica):
+    assert replica not in read_users_page(reader)
+
+    response = reader.post('/new-poem', data={'title': 'Sticky', 'content': 'Written on the primary just now',
+                                               'mood': 'calm'})
+    assert response.status_code == 302
+    with reader.session_transaction() as session:
+        assert STICKY_KEY in session
+
+    assert replica in read_users_page(reader)
+    assert replica_router.counts['primary_sticky'] == 1
+
+
+def test_lagging_replica_falls_back_to_primary(reader, replica, monkeypatch):
+    monkeypatch.setattr(replica_router, '_measure_lag', lambda engine: replica_router.max_lag + 1)
+    replica_router.check(force=True)
+
+    assert replica in read_users_page(reader)
+    assert replica_router.counts['primary_fallback'] == 1
+
+
+def test_unreachable_replica_falls_back_to_primary(reader, replica, monkeypatch):
+    def unreachable(engine):
+        raise OperationalError('SELECT 1', {}, Exception('unable to open database file'))
+
+    monkeypatch.setattr(replica_router, '_measure_lag', unreachable)
+    replica_router.check(force=True)
+
+    assert replica in read_users_page(reader)
+    assert replica_router.counts['primary_fallback'] == 1
@@ -0,0 +1,255 @@
+"""
+Home Timeline for Poetry Vault
+Fan-out-on-write timeline table with hybrid pull for high-follower authors
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from sqlalchemy import event, exists, select
+from sqlalchemy.orm import Session, object_session
+from models import db, User, Poem, Follow, TimelineEntry
+from pagination import KeysetPage, encode_cursor, keyset_paginate
+
+logger = logging.getLogger(__name__)
+
+
+class Timeline:
+    """
+    Materialized per-user home feeds
+
+    New poems are copied into each follower's timeline by a background worker after the
+    poem commits (fan-out on write), so reading a home page is one range scan of
+    idx_timeline_user_created. Authors with at least TIMELINE_FANOUT_THRESHOLD followers
+    are not fanned out; their poems are pulled at read time and merged into the page.
+    Writes and reads both decide pull mode from the live users.follower_count, so an
+    author is never skipped by fan-out while readers still expect them pushed.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.threshold = 5000
+        self.backfill_limit = 100
+        self.asynchronous = True
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read settings and seed the table on first run (call inside an app context)"""
+        self.app = app
+        self.threshold = int(app.config.get('TIMELINE_FANOUT_THRESHOLD', 5000))
+        self.backfill_limit = int(app.config.get('TIMELINE_BACKFILL_LIMIT', 100))
+        self.asynchronous = bool(app.config.get('TIMELINE_FANOUT_ASYNC', True))
+
+        # Existing installs: build timelines from the follow graph once
+        if db.session.query(TimelineEntry.user_id).first() is None and db.session.query(Follow.id).first() is not None:
+            count = self.rebuild()
+            logger.info(f"Built home timelines with {count} entries")
+
+    # Pull mode - authors whose poems are read at query time instead of fanned out
+
+    def pull_authors(self):
+        """Ids of authors with at least `threshold` followers, as a subquery"""
+        # Index range on the denormalized counter, not an aggregate over follows
+        return select(User.id).where(User.follower_count >= self.threshold)
+
+    def _is_pull_author(self, connection, author_id):
+        """Exact check for one author, from their follower counter (for writes)"""
+        followers = connection.execute(select(User.follower_count).where(User.id == author_id)).scalar()
+        return (followers or 0) >= self.threshold
+
+    def demoted(self, connection, author_ids):
+        """Of authors who just lost one follower each, those that dropped out of pull mode"""
+        return connection.execute(select(User.id).where(
+            User.id.in_(author_ids), User.follower_count == self.threshold - 1
+        )).scalars().all()
+
+    # Writes
+
+    def _recent_poem_ids(self, author_id):
+        return select(Poem.id).where(
+            Poem.user_id == author_id, Poem.is_classic.isnot(True)
+        ).order_by(Poem.created_at.desc(), Poem.id.desc()).limit(self.backfill_limit)
+
+    def _insert_entries(self, connection, *conditions):
+        """Set-based INSERT ... SELECT of (follower, poem) pairs not already in a timeline"""
+        entry = TimelineEntry.__table__
+        already = exists().where(entry.c.user_id == Follow.follower_id, entry.c.poem_id == Poem.id)
+        source = select(Follow.follower_id, Poem.id, Poem.user_id, Poem.created_at).join(
+            Poem, Poem.user_id == Follow.followed_id
+        ).where(Poem.is_classic.isnot(True), ~already, *conditions)
+        result = connection.execute(entry.insert().from_select(
+            ['user_id', 'poem_id', 'author_id', 'created_at'], source
+        ))
+        return result.rowcount
+
+    def fan_out(self, connection, poem_id):
+        """Copy one poem into the timelines of its author's followers"""
+        author_id = connection.execute(select(Poem.user_id).where(Poem.id == poem_id)).scalar()
+        if author_id is None or self._is_pull_author(connection, author_id):
+            return 0
+        return self._insert_entries(connection, Poem.id == poem_id)
+
+    def backfill_author(self, connection, author_id):
+        """Push an author's recent poems to all of their followers"""
+        return self._insert_entries(connection, Follow.followed_id == author_id,
+                                    Poem.id.in_(self._recent_poem_ids(author_id)))
+
+    def rebuild(self):
+        """Rebuild every timeline from the follow graph"""
+        with db.engine.begin() as connection:
+            connection.execute(TimelineEntry.__table__.delete())
+            return self._insert_entries(connection, Follow.followed_id.notin_(self.pull_authors()))
+
+    # Background fan-out worker
+
+    def _submit(self, job):
+        if not self.asynchronous or self.app is None:
+            self._run(job)
+            return
+        self._enqueue(job)
+
+    def _enqueue(self, job):
+        self._ensure_worker()
+        self._queue.put(job)
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            return
+        with self._worker_lock:
+            if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+                return
+            self._worker = threading.Thread(target=self._work, name='timeline-fanout', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job):
+        kind, target_id = job
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    if kind == 'poem':
+                        count = self.fan_out(connection, target_id)
+                    else:
+                        count = self.backfill_author(connection, target_id)
+            logger.debug(f"Timeline fan-out {kind} {target_id}: {count} entries")
+        except Exception as e:
+            # Missed entries are recovered by `flask rebuild-timelines`
+            logger.error(f"Timeline fan-out failed for {kind} {target_id}: {e}")
+
+    def shutdown(self, timeout=5.0):
+        """Drain queued fan-out jobs before the process exits"""
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            self._queue.put(None)
+            self._worker.join(timeout)
+
+    # Reads
+
+    def page(self, viewer, cursor=None, per_page=20):
+        """
+        One page of the viewer's home feed, newest first
+
+        Returns:
+            KeysetPage of Poem, or None when the viewer follows nobody
+        """
+        if db.session.query(Follow.id).filter(Follow.follower_id == viewer.id).first() is None:
+            return None
+
+        pushed = keyset_paginate(
+            Poem.query.join(TimelineEntry, TimelineEntry.poem_id == Poem.id).filter(TimelineEntry.user_id == viewer.id),
+            [TimelineEntry.created_at, TimelineEntry.poem_id], cursor, per_page,
+            key=lambda poem: [poem.created_at, poem.id]
+        )
+
+        followed_pull = db.session.query(Follow.followed_id).join(User, User.id == Follow.followed_id).filter(
+            Follow.follower_id == viewer.id, User.follower_count >= self.threshold
+        )
+        pulled = keyset_paginate(
+            Poem.query.filter(Poem.user_id.in_(followed_pull), Poem.is_classic.isnot(True)),
+            [Poem.created_at, Poem.id], cursor, per_page
+        )
+        if not pulled.items:
+            return pushed
+
+        # Merge both streams on the shared (created_at, id) key; an author who moved to
+        # pull mode can still have older poems in the table, so drop duplicates
+        merged = {poem.id: poem for poem in pushed.items + pulled.items}
+        poems = sorted(merged.values(), key=lambda poem: (poem.created_at, poem.id), reverse=True)
+        has_more = pushed.has_more or pulled.has_more or len(poems) > per_page
+        poems = poems[:per_page]
+        next_cursor = encode_cursor([poems[-1].created_at, poems[-1].id]) if has_more else None
+        return KeysetPage(poems, next_cursor)
+
+    # Sync hooks
+
+    def _after_poem_insert(self, mapper, connection, poem):
+        session = object_session(poem)
+        if session is not None:
+            session.info.setdefault('timeline_pending', set()).add(poem.id)
+
+    def _after_commit(self, session):
+        # Fan out only once the poem is committed and visible to the worker's connection
+        for poem_id in session.info.pop('timeline_pending', ()):
+            self._submit(('poem', poem_id))
+        for author_id in session.info.pop('timeline_demoted', ()):
+            self._submit(('author', author_id))
+
+    def _after_rollback(self, session):
+        session.info.pop('timeline_pending', None)
+        session.info.pop('timeline_demoted', None)
+
+    def _before_poem_delete(self, mapper, connection, poem):
+        connection.execute(TimelineEntry.__table__.delete().where(TimelineEntry.poem_id == poem.id))
+
+    # The follower counter was already adjusted by models.py's Follow hooks in this flush
+
+    def _after_follow_insert(self, mapper, connection, follow):
+        if self._is_pull_author(connection, follow.followed_id):
+            # Readers pull this author's poems from now on
+            return
+        self._insert_entries(connection, Follow.follower_id == follow.follower_id,
+                             Follow.followed_id == follow.followed_id,
+                             Poem.id.in_(self._recent_poem_ids(follow.followed_id)))
+
+    def _after_follow_delete(self, mapper, connection, follow):
+        connection.execute(TimelineEntry.__table__.delete().where(
+            TimelineEntry.user_id == follow.follower_id, TimelineEntry.author_id == follow.followed_id
+        ))
+        if self.demoted(connection, [follow.followed_id]):
+            # Back below the threshold: push their recent poems once the unfollow commits
+            session = object_session(follow)
+            if session is not None:
+                session.info.setdefault('timeline_demoted', set()).add(follow.followed_id)
+
+    def _before_user_delete(self, mapper, connection, user):
+        connection.execute(TimelineEntry.__table__.delete().where(
+            db.or_(TimelineEntry.user_id == user.id, TimelineEntry.author_id == user.id)
+        ))
+
+
+# Global timeline
+timeline = Timeline()
+
+event.listen(Poem, 'after_insert', timeline._after_poem_insert)
+event.listen(Poem, 'before_delete', timeline._before_poem_delete)
+event.listen(Follow, 'after_insert', timeline._after_follow_insert)
+event.listen(Follow, 'after_delete', timeline._after_follow_delete)
+event.listen(User, 'before_delete', timeline._before_user_delete)
+event.listen(Session, 'after_commit', timeline._after_commit)
+event.listen(Session, 'after_rollback', timeline._after_rollback)
+atexit.register(timeline.shutdown)